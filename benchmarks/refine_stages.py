@@ -0,0 +1,267 @@
+"""Per-stage benchmark of the refine_tei transformation chain.
+
+Runs create_new_xml_data on the page2tei output in tests/fixtures/corpus (three
+documents of every collection, small to large) without network access (the
+metadata store only reads the baserow dumps next to them, Goobi image lists are
+made up) and reports the time of every stage per document.
+
+The baseline stores the time of every stage per document together with the
+time of a calibration loop (building, serializing, parsing and searching a
+fixed lxml tree, the kind of work the stages do) measured in the same run. Two
+checks fail the run, each when a value grew beyond --threshold times the
+baseline:
+
+    the mean share of a stage in the time of its document (and by more than
+    --min-delta), which does not depend on the speed of the machine;
+    the time of a stage and of all stages summed over the documents, scaled
+    by the calibration time of this run over the one of the baseline (and by
+    more than --min-seconds), which catches a slowdown of all stages alike.
+
+Usage (from the repository root):
+    python benchmarks/refine_stages.py [--repeat N] [--docs PATTERN]
+    python benchmarks/refine_stages.py --save-baseline
+    python benchmarks/refine_stages.py --xpath-profile   # calls and time per named XPath
+"""
+
+import argparse
+import contextlib
+import copy
+import fnmatch
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_DIR, "benchmarks", "refine_stages_baseline.json")
+CORPUS_DIR = os.path.join(REPO_DIR, "tests", "fixtures", "corpus")
+
+
+def get_fake_img_names(bv_doc_id):
+    return [f"IMG_{number}" for number in range(1, 1000)]
+
+
+def import_refine_tei():
+    os.environ["METADATA_OFFLINE"] = "1"
+    os.environ["METADATA_DIR"] = CORPUS_DIR
+    sys.path.insert(0, os.path.join(REPO_DIR, "scripts"))
+    import refine_tei
+
+    refine_tei.TMP_DIR = CORPUS_DIR
+    refine_tei.get_img_names_from_goobi_mets = get_fake_img_names
+    refine_tei.PROJECT_MD = refine_tei.metadata_store.get_project_metadata()
+    return refine_tei
+
+
+def benchmark_document(refine_tei, xml_file_path, doc_metadata, repeat):
+    """returns the fastest time of every stage over repeat runs"""
+    best_times = {}
+    for _ in range(repeat):
+        times = {}
+
+        def timing_hook(stage_name, stage_func, *args, **kwargs):
+            start = time.perf_counter()
+            result = stage_func(*args, **kwargs)
+            times[stage_name] = times.get(stage_name, 0.0) + time.perf_counter() - start
+            return result
+
+        refine_tei.STAGE_HOOK = timing_hook
+        with contextlib.redirect_stdout(io.StringIO()):
+            doc = timing_hook("parse_source", refine_tei.get_xml_doc, xml_file_path)
+            doc_metadata_copy = refine_tei.resolve_types(copy.deepcopy(doc_metadata))
+            refine_tei.create_new_xml_data(doc, doc_metadata_copy)
+        refine_tei.STAGE_HOOK = None
+        for stage_name, seconds in times.items():
+            best_times[stage_name] = min(seconds, best_times.get(stage_name, seconds))
+    return best_times
+
+
+def run_benchmark(repeat, docs_pattern):
+    refine_tei = import_refine_tei()
+    metadata = refine_tei.load_metadata_from_dump()
+    results = {}
+    with tempfile.TemporaryDirectory() as tei_dir:
+        refine_tei.TEI_DIR = tei_dir
+        for xml_file_path, transkribus_collection_id in sorted(
+            refine_tei.collect_source_files(metadata)
+        ):
+            transkribus_doc_id = refine_tei.return_transkribus_doc_id(xml_file_path)
+            doc_metadata = metadata[transkribus_collection_id].get(transkribus_doc_id)
+            if doc_metadata is None:
+                continue
+            doc_key = f"{transkribus_collection_id}/{transkribus_doc_id}"
+            if docs_pattern and not fnmatch.fnmatch(doc_key, docs_pattern):
+                continue
+            results[doc_key] = benchmark_document(
+                refine_tei, xml_file_path, doc_metadata, repeat
+            )
+    if refine_tei.malformed_xml_docs:
+        print(f"{len(refine_tei.malformed_xml_docs)} malformed document(s) were skipped")
+    return results
+
+
+def calibrate(repeat=5, paragraphs=2000):
+    """the fastest of repeat runs of a fixed lxml workload, in seconds"""
+    import re
+
+    import lxml.etree as ET
+
+    number_pattern = re.compile(r"^ *[0-9]{1,2} *\.")
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        root = ET.Element("TEI")
+        body = ET.SubElement(root, "body")
+        for number in range(paragraphs):
+            p = ET.SubElement(body, "p", n=str(number))
+            p.text = f"{number % 40} . Absatz {number}"
+            ET.SubElement(p, "lb").tail = "Text der Zeile"
+        root = ET.fromstring(ET.tostring(root))
+        matches = sum(1 for p in root.iterfind(".//p") if number_pattern.match(p.text))
+        matches += len(root.xpath("//lb[following-sibling::text()]"))
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def print_report(results):
+    stage_totals = {}
+    for doc_key, times in results.items():
+        print(f"{doc_key}: " + ", ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in times.items()))
+        for stage_name, seconds in times.items():
+            stage_totals[stage_name] = stage_totals.get(stage_name, 0.0) + seconds
+    print(f"\n{'stage':<72} {'total':>10}")
+    for stage_name, seconds in sorted(stage_totals.items(), key=lambda item: -item[1]):
+        print(f"{stage_name:<72} {seconds * 1000:>8.1f}ms")
+    print(f"{'all stages':<72} {sum(stage_totals.values()) * 1000:>8.1f}ms")
+
+
+def get_stage_shares(times):
+    """the share of every stage in the time of the document"""
+    total = sum(times.values())
+    return {stage_name: seconds / total if total else 0.0 for stage_name, seconds in times.items()}
+
+
+def get_mean_shares(shares_by_doc, doc_keys):
+    mean_shares = {}
+    for doc_key in doc_keys:
+        for stage_name, share in shares_by_doc[doc_key].items():
+            mean_shares[stage_name] = mean_shares.get(stage_name, 0.0) + share / len(doc_keys)
+    return mean_shares
+
+
+def get_stage_totals(times_by_doc, doc_keys):
+    stage_totals = {}
+    for doc_key in doc_keys:
+        for stage_name, seconds in times_by_doc[doc_key].items():
+            stage_totals[stage_name] = stage_totals.get(stage_name, 0.0) + seconds
+    stage_totals["all stages"] = sum(stage_totals.values())
+    return stage_totals
+
+
+def find_share_regressions(results, baseline_times, doc_keys, threshold, min_delta):
+    """the stages whose mean share grew"""
+    mean_shares = get_mean_shares(
+        {doc_key: get_stage_shares(results[doc_key]) for doc_key in doc_keys}, doc_keys
+    )
+    baseline_shares = get_mean_shares(
+        {doc_key: get_stage_shares(baseline_times[doc_key]) for doc_key in doc_keys}, doc_keys
+    )
+    regressions = []
+    for stage_name, share in mean_shares.items():
+        baseline_share = baseline_shares.get(stage_name)
+        if baseline_share is None:
+            continue
+        if share > baseline_share * threshold and share - baseline_share > min_delta:
+            regressions.append((stage_name, baseline_share, share))
+    return regressions
+
+
+def find_time_regressions(results, baseline_times, doc_keys, speed_factor, threshold, min_seconds):
+    """the stages (and all stages) slower than the baseline scaled to this machine"""
+    stage_totals = get_stage_totals(results, doc_keys)
+    baseline_totals = get_stage_totals(baseline_times, doc_keys)
+    regressions = []
+    for stage_name, seconds in stage_totals.items():
+        if stage_name not in baseline_totals:
+            continue
+        expected_seconds = baseline_totals[stage_name] * speed_factor
+        if seconds > expected_seconds * threshold and seconds - expected_seconds > min_seconds:
+            regressions.append((stage_name, expected_seconds, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the stages of refine_tei")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per document, the fastest counts (default: 3)")
+    parser.add_argument("--docs", help="only documents matching this pattern, e.g. '195363/*'")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="allowed growth factor of the share and the scaled time of a stage (default: 1.5)")
+    parser.add_argument("--min-delta", type=float, default=0.02, help="ignore shares that grew by less than this (default: 0.02)")
+    parser.add_argument("--min-seconds", type=float, default=0.01, help="ignore scaled times that grew by less than this (default: 0.01)")
+    parser.add_argument("--xpath-profile", action="store_true", help="also list the calls and time of every registered XPath")
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    if args.xpath_profile:
+        # # has to be set before the scripts register their queries
+        os.environ["XPATH_PROFILE"] = "1"
+    calibration_seconds = calibrate()
+    results = run_benchmark(args.repeat, args.docs)
+    print_report(results)
+    print(f"{'calibration loop':<72} {calibration_seconds * 1000:>8.1f}ms")
+    if args.xpath_profile:
+        import xpath_registry
+
+        print(f"\nxpath calls over {args.repeat} run(s) per document:")
+        print(xpath_registry.format_profile(xpath_registry.take_profile()))
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as outfile:
+            json.dump(
+                {
+                    "calibration_seconds": round(calibration_seconds, 6),
+                    "seconds": {
+                        doc_key: {stage: round(seconds, 6) for stage, seconds in times.items()}
+                        for doc_key, times in results.items()
+                    },
+                },
+                outfile,
+                indent=1,
+                sort_keys=True,
+            )
+            outfile.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.isfile(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as infile:
+        baseline = json.load(infile)
+    baseline_times = baseline["seconds"]
+    doc_keys = [doc_key for doc_key in results if doc_key in baseline_times]
+    speed_factor = calibration_seconds / baseline["calibration_seconds"]
+    print(f"this machine takes {speed_factor:.2f} times the calibration time of the baseline")
+    share_regressions = find_share_regressions(
+        results, baseline_times, doc_keys, args.threshold, args.min_delta
+    )
+    for stage_name, baseline_share, share in share_regressions:
+        print(f"REGRESSION {stage_name}: {baseline_share:.1%} -> {share:.1%} of the document time")
+    time_regressions = find_time_regressions(
+        results, baseline_times, doc_keys, speed_factor, args.threshold, args.min_seconds
+    )
+    for stage_name, expected_seconds, seconds in time_regressions:
+        print(
+            f"REGRESSION {stage_name}: {expected_seconds * 1000:.1f}ms expected on this machine, "
+            f"took {seconds * 1000:.1f}ms"
+        )
+    if share_regressions or time_regressions:
+        return 1
+    print("no stage regressed beyond the threshold")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
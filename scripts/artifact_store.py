@@ -0,0 +1,178 @@
+"""Compressed, content-addressed storage of the intermediates in ./mets.
+
+METS, image name and page2tei TEI files are kept gzip compressed as
+<name>.gz. Every compressed file is a hard link to an object in
+ARTIFACT_STORE_DIR named after the sha256 of its content, so identical
+artifacts are stored once and an artifact that was already stored (in this
+or in an earlier run, the store lives in the cached ./cache) is linked
+instead of written again.
+
+The .gz files are committed like the uncompressed files before them (the
+same content always gives the same bytes, so an unchanged artifact leaves no
+diff). The dedup is local only: a checkout or a restored cache brings the
+files back as separate copies. Nothing depends on the links, a file that is
+not linked is read the same way, only the disk space is not shared; files
+written later are linked again.
+
+libxml2 decompresses .gz files while parsing them, so TeiReader, etree.parse
+and iterparse read the stored path as a stream; open_artifact does the same
+for plain python readers. Files are never changed in place (they are
+replaced), so a link never changes the content of another one.
+
+Usage:
+    python artifact_store.py store <file>...          # compress raw files into the store
+    python artifact_store.py extract --output-dir <dir> <file>...
+    python artifact_store.py prune [--max-age-days N] # drop objects nothing links to
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+ARTIFACT_STORE_DIR = os.environ.get("ARTIFACT_STORE_DIR", "./cache/artifacts")
+COMPRESSED_SUFFIX = ".gz"
+COMPRESS_LEVEL = 6
+
+
+def get_object_path(digest):
+    return os.path.join(ARTIFACT_STORE_DIR, digest[:2], f"{digest}{COMPRESSED_SUFFIX}")
+
+
+def compress(content):
+    # # no file name and no mtime in the header, the same content always gives the same bytes
+    return gzip.compress(content, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def link_or_copy(source, target):
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def put_object(content):
+    """stores content once, returns the path of its object"""
+    object_path = get_object_path(hashlib.sha256(content).hexdigest())
+    if not os.path.isfile(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(compress(content))
+        os.replace(tmp_path, object_path)
+    else:
+        # # prune goes by the time an object was last used
+        os.utime(object_path)
+    return object_path
+
+
+def write_artifact(file_path, content):
+    """
+    writes content as file_path.gz, linked to its object, and removes an
+    uncompressed file_path; returns the number of bytes on disk
+    """
+    file_path = get_raw_path(file_path)
+    object_path = put_object(content)
+    compressed_path = file_path + COMPRESSED_SUFFIX
+    link_or_copy(object_path, compressed_path)
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+    return os.path.getsize(compressed_path)
+
+
+def store_file(file_path):
+    """moves an uncompressed file into the store"""
+    with open(file_path, "rb") as infile:
+        content = infile.read()
+    return write_artifact(file_path, content)
+
+
+def get_raw_path(file_path):
+    return file_path.removesuffix(COMPRESSED_SUFFIX)
+
+
+def find_artifact(file_path):
+    """the existing file of an artifact, compressed or not, None if there is none"""
+    raw_path = get_raw_path(file_path)
+    for candidate in (raw_path + COMPRESSED_SUFFIX, raw_path):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def artifact_exists(file_path):
+    return find_artifact(file_path) is not None
+
+
+def remove_artifact(file_path):
+    raw_path = get_raw_path(file_path)
+    for candidate in (raw_path + COMPRESSED_SUFFIX, raw_path):
+        if os.path.isfile(candidate):
+            os.remove(candidate)
+
+
+def open_artifact(file_path):
+    """binary stream of the uncompressed content"""
+    found_path = find_artifact(file_path)
+    if found_path is None:
+        raise FileNotFoundError(file_path)
+    if found_path.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(found_path, "rb")
+    return open(found_path, "rb")
+
+
+def extract_artifact(file_path, output_dir):
+    """writes the uncompressed content to output_dir, returns its path"""
+    output_path = os.path.join(output_dir, os.path.basename(get_raw_path(file_path)))
+    with open_artifact(file_path) as infile, open(output_path, "wb") as outfile:
+        shutil.copyfileobj(infile, outfile)
+    return output_path
+
+
+def prune_objects(max_age_days=0):
+    """removes objects no file links to any more and not used for max_age_days"""
+    removed = 0
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    for directory, _, file_names in os.walk(ARTIFACT_STORE_DIR):
+        for file_name in file_names:
+            object_path = os.path.join(directory, file_name)
+            stat = os.stat(object_path)
+            if stat.st_nlink == 1 and stat.st_mtime < cutoff:
+                os.remove(object_path)
+                removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compressed store of the ./mets intermediates")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    store_parser = subparsers.add_parser("store", help="compress raw files into the store")
+    store_parser.add_argument("paths", nargs="*")
+    extract_parser = subparsers.add_parser("extract", help="write uncompressed copies")
+    extract_parser.add_argument("--output-dir", required=True)
+    extract_parser.add_argument("paths", nargs="*")
+    prune_parser = subparsers.add_parser("prune", help="remove objects nothing links to")
+    prune_parser.add_argument("--max-age-days", type=float, default=0)
+    args = parser.parse_args()
+
+    if args.command == "store":
+        raw_bytes = 0
+        stored_bytes = 0
+        for file_path in args.paths:
+            if file_path.endswith(COMPRESSED_SUFFIX) or not os.path.isfile(file_path):
+                continue
+            raw_bytes += os.path.getsize(file_path)
+            stored_bytes += store_file(file_path)
+        print(f"stored {raw_bytes} bytes as {stored_bytes} compressed bytes", file=sys.stderr)
+    elif args.command == "extract":
+        os.makedirs(args.output_dir, exist_ok=True)
+        for file_path in args.paths:
+            print(extract_artifact(file_path, args.output_dir))
+    else:
+        print(f"removed {prune_objects(args.max_age_days)} object(s)", file=sys.stderr)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+
+# # lives next to editions_source; maps every generated edition to a hash of its inputs
+BUILD_MANIFEST_PATH = "./editions_source_manifest.json"
+# # generators running in threads of one process (pipeline.py) save one after the other
+_manifest_lock = threading.Lock()
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# # hash over the code of a generator by its file list, built once per process
+code_hashes = {}
+
+
+def hash_file(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 16), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_inputs(*inputs):
+    """
+    returns one sha256 over all inputs, bytes are hashed as they are,
+    everything else as sorted json
+    """
+    sha = hashlib.sha256()
+    for item in inputs:
+        if not isinstance(item, bytes):
+            item = json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        sha.update(len(item).to_bytes(8, "big"))
+        sha.update(item)
+    return sha.hexdigest()
+
+
+def hash_code_files(*module_names):
+    """
+    one hash over the given modules of ./scripts, an edition is rebuilt
+    when the code of any module its output depends on changed
+    """
+    code_hash = code_hashes.get(module_names)
+    if code_hash is None:
+        code_hash = code_hashes[module_names] = hash_inputs(
+            *(hash_file(os.path.join(SCRIPTS_DIR, module_name)) for module_name in module_names)
+        )
+    return code_hash
+
+
+def read_build_manifest():
+    if not os.path.isfile(BUILD_MANIFEST_PATH):
+        return {}
+    with open(BUILD_MANIFEST_PATH, "r", encoding="utf-8") as infile:
+        return json.load(infile)
+
+
+def load_build_manifest(generator):
+    return read_build_manifest().get(generator, {})
+
+
+def save_build_manifest(generator, entries, claimed=()):
+    """
+    stores the section of generator; the editions in claimed were built or
+    found up to date by it in this run and are dropped from the other sections
+    (both generators write editions_source/<bv_id>.xml, a row can move from
+    one to the other)
+    """
+    with _manifest_lock:
+        manifest = read_build_manifest()
+        for section, section_entries in manifest.items():
+            if section != generator:
+                for bv_doc_id in claimed:
+                    section_entries.pop(bv_doc_id, None)
+        manifest[generator] = dict(sorted(entries.items()))
+        tmp_path = BUILD_MANIFEST_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(manifest, outfile, indent=1, sort_keys=True)
+            outfile.write("\n")
+        os.replace(tmp_path, BUILD_MANIFEST_PATH)
+
+
+def write_if_changed(file_path, content):
+    """
+    writes content to file_path unless the file already holds exactly these
+    bytes, returns the number of bytes written (0 for an unchanged file)
+    """
+    if os.path.isfile(file_path) and os.path.getsize(file_path) == len(content):
+        with open(file_path, "rb") as infile:
+            if infile.read() == content:
+                return 0
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as outfile:
+        outfile.write(content)
+    os.replace(tmp_path, file_path)
+    return len(content)
+
+
+def is_up_to_date(entry, input_hash, output_path):
+    return (
+        entry is not None
+        and entry.get("input_hash") == input_hash
+        and os.path.isfile(output_path)
+    )
+
+
+def keep_old_entry(old_entries, new_entries, bv_doc_id):
+    """an edition its generator still owns but failed to build keeps its file and entry"""
+    if bv_doc_id in old_entries:
+        new_entries[bv_doc_id] = old_entries[bv_doc_id]
+
+
+def remove_stale_outputs(tei_dir, generator, old_entries, new_entries):
+    """
+    deletes the editions of generator that it did not build in this run and
+    which no other generator claims, e.g. of a row that is gone from the
+    baserow dump or lost its transkribus id. A generator puts the old entry
+    of an edition it still owns but could not build (a failed download) into
+    new_entries to keep its file; an edition claimed by the other generator
+    is left to it and only loses its entry here.
+    """
+    other_claims = {
+        bv_doc_id
+        for section, section_entries in read_build_manifest().items()
+        if section != generator
+        for bv_doc_id in section_entries
+    }
+    removed = []
+    for bv_doc_id in old_entries:
+        if bv_doc_id in new_entries or bv_doc_id in other_claims:
+            continue
+        output_path = os.path.join(tei_dir, bv_doc_id + ".xml")
+        if os.path.isfile(output_path):
+            print("removing", output_path)
+            os.remove(output_path)
+        removed.append(bv_doc_id)
+    return removed
@@ -1,16 +1,92 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 from acdh_tei_pyutils.tei import TeiReader
 import lxml.builder as E
-import glob
+import lxml.etree as ET
+import export_report
+from xpath_registry import print_profile, register_xpath
 elementMaker = E.ElementMaker(namespace="http://www.tei-c.org/ns/1.0", nsmap={"tei": "http://www.tei-c.org/ns/1.0"})
 inputpath = "./editions_source/*.xml"
+tei_header_tag = "{http://www.tei-c.org/ns/1.0}teiHeader"
+origin_date_xpath = register_xpath("origin_date", ".//tei:msDesc/tei:history/tei:origin/@notBefore-iso")
+data_set_xpath = register_xpath("data_set", './/tei:idno[@type="bv_data_set"]/text()')
+series_stmts_xpath = register_xpath("series_stmts", "//tei:fileDesc/tei:seriesStmt")
+publication_stmt_xpath = register_xpath("publication_stmt", "//tei:fileDesc/tei:publicationStmt")
+# # sorts after every date, as the "None" the template wrote for a missing date did
+UNDATED = "None"
+
+def read_header(file):
+    """parses file up to the end of the teiHeader, the text is never read"""
+    for _, header in ET.iterparse(file, events=("end",), tag=tei_header_tag):
+        return header
+    raise ValueError(f"{file} has no teiHeader")
+
+def read_existing_header(file):
+    """the teiHeader of an edition written earlier, None if there is none or it does not parse"""
+    if not os.path.isfile(file):
+        return None
+    try:
+        return read_header(file)
+    except (ET.XMLSyntaxError, ValueError):
+        return None
+
+def keep_series_stmt(tree, header):
+    """
+    gives a rebuilt edition the seriesStmt of the edition it replaces (header),
+    so an unchanged edition comes out byte for byte as it is on disk; the
+    sorter still renumbers it if its place changed
+    """
+    if header is None or series_stmts_xpath(tree):
+        return
+    series_stmts = series_stmts_xpath(header)
+    if len(series_stmts) == 1:
+        publication_stmt_xpath(tree)[0].addnext(series_stmts[0])
+
+def make_series_stmt(dataset, ordernumber):
+    series_stmt = elementMaker.seriesStmt(
+        "\n",
+        elementMaker.title(dataset),
+        "\n",
+        elementMaker.biblScope(ordernumber,unit="part"),
+        "\n"
+    )
+    series_stmt.tail ="\n"
+    return series_stmt
+
+def describe(element):
+    """everything of element that ends up in the file"""
+    return (
+        element.tag,
+        dict(element.attrib),
+        element.text,
+        element.tail,
+        [describe(child) for child in element],
+    )
+
+def has_series_stmt(header, dataset, ordernumber):
+    """true if the file already has exactly the seriesStmt it would get"""
+    series_stmts = series_stmts_xpath(header)
+    if len(series_stmts) != 1:
+        return False
+    publicationStmt = publication_stmt_xpath(header)[0]
+    return (
+        publicationStmt.getnext() is series_stmts[0]
+        and describe(series_stmts[0]) == describe(make_series_stmt(dataset, ordernumber))
+    )
 
 def make_catalogue(inputpath):
     catalogue = {}
+    headers = {}
     for file in glob.glob(inputpath):
-        tr = TeiReader(file)
-        # get date of creation from teiHeader/fileDesc/publicationStmt
-        date = tr.any_xpath('.//tei:msDesc/tei:history/tei:origin/@notBefore-iso')[0].strip()
-        dataset = tr.any_xpath('.//tei:idno[@type="bv_data_set"]/text()')[0].strip()
+        header = read_header(file)
+        # get date of creation from teiHeader/fileDesc/publicationStmt,
+        # editions without a date in baserow have none and go last
+        dates = origin_date_xpath(header)
+        date = dates[0].strip() if dates else UNDATED
+        dataset = data_set_xpath(header)[0].strip()
         if not date or not dataset:
             print("dataset: ", dataset)
             print("date: ", date)
@@ -18,7 +94,8 @@ def make_catalogue(inputpath):
         if not dataset in catalogue:
             catalogue[dataset] = []
         catalogue[dataset].append((date, file))
-    return catalogue
+        headers[file] = header
+    return catalogue, headers
 
 def get_number_from_filename(filename):
     # get number from filename
@@ -27,26 +104,65 @@ def get_number_from_filename(filename):
     number = "-"+number.zfill(4)
     return number
 
-def sort_and_update_catalogue(catalogue):
+def sort_catalogue(catalogue, headers):
+    """returns (filepath, dataset, ordernumber) of every file whose seriesStmt has to change"""
+    updates = []
     for dataset in catalogue:
         print(f"Dataset: {dataset} with {len(catalogue[dataset])} files")
-        dataset = sorted(catalogue[dataset], key=lambda x: x[0]+get_number_from_filename(x[1]))
+        sorted_files = sorted(catalogue[dataset], key=lambda x: x[0]+get_number_from_filename(x[1]))
         current_index = 0
-        for date, filepath in dataset:
+        for date, filepath in sorted_files:
             current_index += 100
-            xmldoc = TeiReader(filepath)
             ordernumber = str(current_index).zfill(4)
-            series_stmt = elementMaker.seriesStmt(
-                "\n",
-                elementMaker.title(xmldoc.any_xpath("//tei:idno[@type='bv_data_set']/text()")[0].strip()),
-                "\n",
-                elementMaker.biblScope(ordernumber,unit="part"),
-                "\n"
-            )
-            series_stmt.tail ="\n"
-            publicationStmt = xmldoc.any_xpath("//tei:fileDesc/tei:publicationStmt")[0]
-            publicationStmt.addnext(series_stmt)
-            xmldoc.tree_to_file(filepath)
-
-catalogue = make_catalogue(inputpath)
-sort_and_update_catalogue(catalogue)
\ No newline at end of file
+            if not has_series_stmt(headers[filepath], dataset, ordernumber):
+                updates.append((filepath, dataset, ordernumber))
+    return updates
+
+def update_series_stmt(filepath, dataset, ordernumber):
+    xmldoc = TeiReader(filepath)
+    # editions kept from an earlier run already have one
+    for old_series_stmt in series_stmts_xpath(xmldoc.tree):
+        old_series_stmt.getparent().remove(old_series_stmt)
+    publicationStmt = publication_stmt_xpath(xmldoc.tree)[0]
+    publicationStmt.addnext(make_series_stmt(dataset, ordernumber))
+    xmldoc.tree_to_file(filepath)
+    return {"document": os.path.normpath(filepath), "bytes_written": os.path.getsize(filepath)}
+
+def update_catalogue(updates, workers, documents):
+    if workers > 1 and len(updates) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            documents.extend(executor.map(update_series_stmt, *zip(*updates)))
+    else:
+        for update in updates:
+            documents.append(update_series_stmt(*update))
+
+def sort_and_update_catalogue(catalogue, headers, workers=1, documents=None):
+    updates = sort_catalogue(catalogue, headers)
+    print(f"{len(updates)} of {len(headers)} file(s) get a new seriesStmt")
+    update_catalogue(updates, workers, [] if documents is None else documents)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="number the editions of every data set by date")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes writing changed files in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--search-index",
+        default=os.environ.get("SEARCH_INDEX_PATH", ""),
+        help="update the full text index of articles and legal sections in this SQLite file",
+    )
+    args = parser.parse_args()
+    with export_report.measure_stage("create_sorter_val") as documents:
+        catalogue, headers = make_catalogue(inputpath)
+        sort_and_update_catalogue(catalogue, headers, workers=args.workers, documents=documents)
+    print_profile("create_sorter_val")
+    if args.search_index:
+        # # the editions are final only now; both import this module
+        import refine_tei
+        import search_index
+
+        search_index.SEARCH_INDEX_PATH = args.search_index
+        refine_tei.update_search_index()
@@ -0,0 +1,310 @@
+"""Timing and counters of an export run, written to a JSON report.
+
+Instrumentation is only active if EXPORT_REPORT_PATH is set (the workflow
+points it to $RUNNER_TEMP/export_report.json, outside of the repository).
+Every pipeline script records its stage (wall time, HTTP requests, peak RSS of
+the process) and, where it works per document, one entry per document with the
+time and HTTP requests of every refine stage, the bytes written and the peak
+RSS of the process so far. ru_maxrss only grows, so that is the peak of the
+process up to and including the document, not the memory of the document
+itself; MEMORY_PROFILE gives the latter.
+
+With COUNT_ELEMENTS=1 the refine stages also get the number of elements of the
+tree they got. Counting walks the whole tree before every stage, so it is off
+by default.
+
+With MEMORY_PROFILE=1 the documents and refine stages also get the peak of
+the memory traced by tracemalloc (python objects and strings) and the RSS
+after them (which includes the lxml trees, libxml2 allocates them outside of
+tracemalloc). Tracing slows python down, it is meant for single runs.
+
+Usage:
+    python export_report.py record-stage <stage_name> --started-at <unix time>
+    python export_report.py summary    # markdown for $GITHUB_STEP_SUMMARY
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+REPORT_PATH = os.environ.get("EXPORT_REPORT_PATH", "")
+MEMORY_PROFILE = os.environ.get("MEMORY_PROFILE", "") not in ("", "0", "false")
+COUNT_ELEMENTS = os.environ.get("COUNT_ELEMENTS", "") not in ("", "0", "false")
+http_requests = 0
+
+
+def is_enabled():
+    return bool(REPORT_PATH)
+
+
+def install_http_counter():
+    """count every request sent through requests (requests.get uses a Session, too)"""
+    import requests
+
+    if getattr(requests.Session.send, "counts_requests", False):
+        return
+    send = requests.Session.send
+
+    def counting_send(self, request, **kwargs):
+        global http_requests
+        http_requests += 1
+        return send(self, request, **kwargs)
+
+    counting_send.counts_requests = True
+    requests.Session.send = counting_send
+
+
+def install_worker_http_counter():
+    """install_http_counter in a pool process, a count forked from the parent is dropped"""
+    global http_requests
+    install_http_counter()
+    http_requests = 0
+
+
+def take_http_requests():
+    """the requests of this process since the last call, for a pool process to return"""
+    global http_requests
+    count, http_requests = http_requests, 0
+    return count
+
+
+def add_http_requests(count):
+    """adds the requests a pool process returned to the ones of this process"""
+    global http_requests
+    http_requests += count
+
+
+def get_process_peak_rss_kb():
+    """peak resident set size of the process since it started, kilobytes on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_rss_kb():
+    """current resident set size, 0 without /proc"""
+    try:
+        with open("/proc/self/statm", "r") as infile:
+            return int(infile.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def record_memory_peak(metrics):
+    """folds the traced peak since the last reset into metrics and starts a new one"""
+    _, peak = tracemalloc.get_traced_memory()
+    metrics["peak_traced_kb"] = max(metrics.get("peak_traced_kb", 0), peak // 1024)
+    tracemalloc.reset_peak()
+
+
+def count_elements(subject):
+    tree = getattr(subject, "tree", subject)
+    if not hasattr(tree, "iter"):
+        return None
+    return sum(1 for _ in tree.iter())
+
+
+def make_stage_hook(doc_metrics):
+    """returns a refine_tei.STAGE_HOOK recording every stage into doc_metrics"""
+    stages = doc_metrics.setdefault("stages", {})
+
+    def stage_hook(stage_name, stage_func, *args, **kwargs):
+        if COUNT_ELEMENTS:
+            subject = args[0] if args else next(iter(kwargs.values()), None)
+            elements = count_elements(subject)
+        requests_before = http_requests
+        if MEMORY_PROFILE:
+            record_memory_peak(doc_metrics)
+        start = time.perf_counter()
+        result = stage_func(*args, **kwargs)
+        stage_metrics = stages[stage_name] = {
+            "seconds": round(time.perf_counter() - start, 6),
+            "http_requests": http_requests - requests_before,
+        }
+        if COUNT_ELEMENTS:
+            stage_metrics["elements"] = elements
+        if MEMORY_PROFILE:
+            record_memory_peak(stage_metrics)
+            stage_metrics["rss_kb"] = get_rss_kb()
+            doc_metrics["peak_traced_kb"] = max(
+                doc_metrics.get("peak_traced_kb", 0), stage_metrics["peak_traced_kb"]
+            )
+            doc_metrics["rss_kb"] = max(doc_metrics.get("rss_kb", 0), stage_metrics["rss_kb"])
+        return result
+
+    return stage_hook
+
+
+@contextlib.contextmanager
+def measure_document(document):
+    doc_metrics = {"document": document}
+    requests_before = http_requests
+    if MEMORY_PROFILE:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield doc_metrics
+    finally:
+        doc_metrics["seconds"] = round(time.perf_counter() - start, 6)
+        doc_metrics["http_requests"] = http_requests - requests_before
+        doc_metrics["process_peak_rss_kb"] = get_process_peak_rss_kb()
+        if MEMORY_PROFILE:
+            record_memory_peak(doc_metrics)
+            doc_metrics["rss_kb"] = max(doc_metrics.get("rss_kb", 0), get_rss_kb())
+
+
+def load_report():
+    if not os.path.isfile(REPORT_PATH):
+        return {"stages": {}, "documents": {}}
+    with open(REPORT_PATH, "r", encoding="utf-8") as infile:
+        return json.load(infile)
+
+
+def save_report(report):
+    report_directory, _ = os.path.split(REPORT_PATH)
+    if report_directory:
+        os.makedirs(report_directory, exist_ok=True)
+    with open(REPORT_PATH, "w", encoding="utf-8") as outfile:
+        json.dump(report, outfile, indent=1)
+        outfile.write("\n")
+
+
+def record_stage(stage_name, stage_metrics, documents=None):
+    if not is_enabled():
+        return
+    report = load_report()
+    report["stages"][stage_name] = stage_metrics
+    if documents is not None:
+        report["documents"][stage_name] = documents
+    save_report(report)
+
+
+@contextlib.contextmanager
+def measure_stage(stage_name):
+    """
+    records wall time, http requests and process peak rss of a pipeline stage,
+    documents appended to the yielded list are stored with it
+    """
+    if is_enabled():
+        install_http_counter()
+    documents = []
+    requests_before = http_requests
+    start = time.perf_counter()
+    try:
+        yield documents
+    finally:
+        stage_metrics = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "http_requests": http_requests - requests_before,
+            "process_peak_rss_kb": max(
+                [get_process_peak_rss_kb()]
+                + [doc.get("process_peak_rss_kb", 0) for doc in documents]
+            ),
+            "documents": len(documents),
+            "bytes_written": sum(doc.get("bytes_written", 0) for doc in documents),
+        }
+        record_stage(stage_name, stage_metrics, documents or None)
+
+
+def format_summary(report):
+    lines = [
+        "## Export run",
+        "",
+        "| stage | seconds | documents | HTTP requests | bytes written | process peak RSS (MB) |",
+        "|-------|--------:|----------:|--------------:|--------------:|----------------------:|",
+    ]
+    for stage_name, stage_metrics in report["stages"].items():
+        peak_rss_kb = stage_metrics.get("process_peak_rss_kb")
+        lines.append(
+            f"| {stage_name} | {stage_metrics.get('seconds', 0):.1f} "
+            f"| {stage_metrics.get('documents', '')} "
+            f"| {stage_metrics.get('http_requests', '')} "
+            f"| {stage_metrics.get('bytes_written', '')} "
+            f"| {'' if peak_rss_kb is None else f'{peak_rss_kb / 1024:.0f}'} |"
+        )
+    documents = [
+        (stage_name, doc)
+        for stage_name, docs in report["documents"].items()
+        for doc in docs
+    ]
+    documents.sort(key=lambda item: -item[1].get("seconds", 0))
+    if documents:
+        lines += [
+            "",
+            "### Slowest documents",
+            "",
+            "| stage | document | seconds | slowest step |",
+            "|-------|----------|--------:|--------------|",
+        ]
+        for stage_name, doc in documents[:10]:
+            steps = doc.get("stages", {})
+            slowest = max(steps, key=lambda step: steps[step]["seconds"], default="")
+            if slowest:
+                slowest = f"{slowest} ({steps[slowest]['seconds']:.2f}s)"
+            lines.append(
+                f"| {stage_name} | {doc['document']} | {doc.get('seconds', 0):.2f} | {slowest} |"
+            )
+    documents.sort(key=lambda item: -item[1].get("peak_traced_kb", -1))
+    if documents and "peak_traced_kb" in documents[0][1]:
+        lines += [
+            "",
+            "### Highest memory use",
+            "",
+            "| stage | document | peak traced (MB) | RSS (MB) | step with the highest peak |",
+            "|-------|----------|-----------------:|---------:|----------------------------|",
+        ]
+        for stage_name, doc in documents[:10]:
+            if "peak_traced_kb" not in doc:
+                break
+            steps = doc.get("stages", {})
+            highest = max(steps, key=lambda step: steps[step].get("peak_traced_kb", 0), default="")
+            if highest:
+                highest = f"{highest} ({steps[highest].get('peak_traced_kb', 0) / 1024:.1f} MB)"
+            lines.append(
+                f"| {stage_name} | {doc['document']} | {doc['peak_traced_kb'] / 1024:.1f} "
+                f"| {doc.get('rss_kb', 0) / 1024:.0f} | {highest} |"
+            )
+    xpath_queries = [
+        (stage_name, name, query)
+        for stage_name, queries in report.get("xpath_profile", {}).items()
+        for name, query in queries.items()
+    ]
+    xpath_queries.sort(key=lambda item: -item[2]["seconds"])
+    if xpath_queries:
+        lines += [
+            "",
+            "### Most expensive XPath queries",
+            "",
+            "| stage | query | calls | seconds |",
+            "|-------|-------|------:|--------:|",
+        ]
+        for stage_name, name, query in xpath_queries[:10]:
+            lines.append(f"| {stage_name} | {name} | {query['calls']} | {query['seconds']:.3f} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export run report")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record-stage", help="record a stage timed outside python")
+    record_parser.add_argument("stage_name")
+    record_parser.add_argument(
+        "--started-at", type=float, required=True, help="start of the stage, e.g. $(date +%%s.%%N)"
+    )
+    subparsers.add_parser("summary", help="print the report as markdown")
+    args = parser.parse_args()
+
+    if not is_enabled():
+        print("EXPORT_REPORT_PATH is not set", file=sys.stderr)
+        sys.exit(0)
+    if args.command == "record-stage":
+        record_stage(args.stage_name, {"seconds": round(time.time() - args.started_at, 3)})
+    elif os.path.isfile(REPORT_PATH):
+        print(format_summary(load_report()))
+    else:
+        print("No export report written.")
@@ -1,13 +1,305 @@
+"""Downloads the METS files of the transkribus collections in the baserow dump.
+
+By default only new or changed documents are downloaded: the documents of
+every collection are listed, and the listed metadata of each one is compared
+with ./mets/fetch_state.json. Only if it differs, or if the document was last
+checked more than FULLDOC_RECHECK_AGE seconds ago (the listing does not
+always change with a transcript), the fulldoc of the document is requested
+and its page and transcript versions are compared; METS and image name files
+are only written for documents whose version differs. The TEI of a changed
+document is deleted so transform.sh creates it again, unchanged METS and TEI
+files stay as they are. The files are written compressed through
+artifact_store. Documents gone from a collection are removed. Collections and
+documents are handled several at a time through one pooled session. The
+state is saved also if a download fails, with the documents handled so far.
+
+TRANSKRIBUS_BASE_URL points to the REST API, e.g. to a local stand-in of it.
+With --full every collection is downloaded again with collection_to_mets: the
+files of the collection (TEIs included, so all of them are transformed again)
+are removed first and the downloaded ones are compressed through
+artifact_store like in a delta run. A delta run requests the METS and the
+image names from the same endpoints and serializes them like
+collection_to_mets, so both write the same bytes for a document.
+"""
+
+import argparse
+import glob
+import json
 import os
-from transkribus_utils.transkribus_utils import ACDHTranskribusUtils
-from refine_tei import load_metadata_from_dump
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.etree as ET
+
+import export_report
+from artifact_store import artifact_exists, remove_artifact, store_file, write_artifact
+from build_manifest import hash_inputs
+from http_utils import HostRateLimiter, build_session
+from metadata_store import get_documents_by_transkribus_id
 
 user = os.environ.get("TR_USER")
 pw = os.environ.get("TR_PW")
-BASE_ROW_DUMP_URL = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/document.json"
+TRANSKRIBUS_BASE_URL = os.environ.get(
+    "TRANSKRIBUS_BASE_URL", "https://transkribus.eu/TrpServer/rest"
+).rstrip("/")
+TRANSKRIBUS_TIMEOUT = 120
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 8))
+TRANSKRIBUS_REQUESTS_PER_SECOND = float(os.environ.get("TRANSKRIBUS_REQUESTS_PER_SECOND", 5))
+METS_DIR = "./mets"
+FETCH_STATE_PATH = os.path.join(METS_DIR, "fetch_state.json")
+FULLDOC_RECHECK_AGE = int(os.environ.get("FULLDOC_RECHECK_AGE", 7 * 24 * 3600))
+# # files written for every document, keyed by their suffix
+DOCUMENT_FILE_SUFFIXES = ("_mets.xml", "_image_name.xml", "_tei.xml")
+
+transkribus_rate_limiter = HostRateLimiter(TRANSKRIBUS_REQUESTS_PER_SECOND)
+
+
+def get_document_path(collection_id, doc_id, suffix):
+    return os.path.join(METS_DIR, str(collection_id), f"{doc_id}{suffix}")
+
+
+def load_fetch_state():
+    try:
+        with open(FETCH_STATE_PATH, "r", encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_fetch_state(state):
+    os.makedirs(METS_DIR, exist_ok=True)
+    tmp_path = f"{FETCH_STATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(state, outfile, indent=1, sort_keys=True)
+        outfile.write("\n")
+    os.replace(tmp_path, FETCH_STATE_PATH)
+
+
+def login(session):
+    response = session.post(
+        f"{TRANSKRIBUS_BASE_URL}/auth/login",
+        data={"user": user, "pw": pw},
+        timeout=TRANSKRIBUS_TIMEOUT,
+    )
+    response.raise_for_status()
+    # # the session id is in the body, sent as cookie with every request like
+    # # ACDHTranskribusUtils does, whatever path a cookie of the response is set for
+    session_ids = ET.fromstring(response.content).xpath("/trpUserLogin/sessionId/text()")
+    if not session_ids:
+        raise ValueError(f"no session id in the login response of {TRANSKRIBUS_BASE_URL}")
+    session.cookies.set("JSESSIONID", session_ids[0])
+    return session
+
+
+def transkribus_get(session, path):
+    url = f"{TRANSKRIBUS_BASE_URL}{path}"
+    transkribus_rate_limiter.wait(url)
+    response = session.get(url, timeout=TRANSKRIBUS_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def list_documents(session, collection_id):
+    return transkribus_get(session, f"/collections/{collection_id}/list").json()
+
+
+def get_listing_version(listed_document):
+    """hash over what the collection listing says about a document"""
+    return hash_inputs(listed_document)
+
+
+def get_pages(fulldoc):
+    return fulldoc.get("pageList", {}).get("pages", [])
+
+
+def get_document_version(fulldoc):
+    """
+    hash over the document metadata, the images and every transcript of
+    every page, and the time of the newest transcript
+    """
+    pages = []
+    last_modified = 0
+    for page in get_pages(fulldoc):
+        transcripts = [
+            (transcript.get("tsId"), transcript.get("timestamp"))
+            for transcript in page.get("tsList", {}).get("transcripts", [])
+        ]
+        last_modified = max([last_modified] + [timestamp or 0 for _, timestamp in transcripts])
+        pages.append(
+            (page.get("pageId"), page.get("pageNr"), page.get("key"), page.get("imgFileName"), transcripts)
+        )
+    return hash_inputs(fulldoc.get("md", {}), pages), last_modified
+
+
+def serialize_mets(response):
+    """the METS of a /mets response as collection_to_mets (save_mets_to_file) writes it"""
+    return ET.tostring(ET.fromstring(response.text.encode("utf8")))
+
+
+def build_image_name_list(response):
+    """
+    the <list> of the image file names of an /imageNames response as
+    collection_to_mets (save_image_names_to_file) writes it
+    """
+    image_name_list = ET.Element("list")
+    for number, image_name in enumerate(response.text.split("\n"), 1):
+        item = ET.SubElement(image_name_list, "item", n=str(number))
+        item.text = image_name
+    return ET.tostring(image_name_list)
+
+
+def fetch_document(session, collection_id, doc_id, old_entry, listing_version=None):
+    """
+    returns the new state entry of the document and the bytes written,
+    nothing is written if its version did not change; the fulldoc is not
+    requested if the listing did not change since the last recent check
+    """
+    mets_path = get_document_path(collection_id, doc_id, "_mets.xml")
+    has_mets = artifact_exists(mets_path)
+    if (
+        old_entry is not None
+        and has_mets
+        and listing_version is not None
+        and old_entry.get("listing_version") == listing_version
+        and time.time() - old_entry.get("checked_at", 0) < FULLDOC_RECHECK_AGE
+    ):
+        return old_entry, 0
+    fulldoc = transkribus_get(session, f"/collections/{collection_id}/{doc_id}/fulldoc").json()
+    version, last_modified = get_document_version(fulldoc)
+    entry = {
+        "version": version,
+        "last_modified": last_modified,
+        "listing_version": listing_version,
+        "checked_at": int(time.time()),
+    }
+    if old_entry is not None and old_entry.get("version") == version and has_mets:
+        return entry, 0
+    # # the same requests and bytes as collection_to_mets, so --full and a delta
+    # # run store the same artifacts
+    mets = serialize_mets(transkribus_get(session, f"/collections/{collection_id}/{doc_id}/mets"))
+    image_name_list = build_image_name_list(
+        transkribus_get(session, f"/collections/{collection_id}/{doc_id}/imageNames")
+    )
+    os.makedirs(os.path.dirname(mets_path), exist_ok=True)
+    bytes_written = write_artifact(mets_path, mets)
+    bytes_written += write_artifact(
+        get_document_path(collection_id, doc_id, "_image_name.xml"), image_name_list
+    )
+    # # transform.sh only creates the TEIs that are missing
+    remove_artifact(get_document_path(collection_id, doc_id, "_tei.xml"))
+    return entry, bytes_written
+
+
+def remove_document_files(collection_id, doc_id):
+    for suffix in DOCUMENT_FILE_SUFFIXES:
+        remove_artifact(get_document_path(collection_id, doc_id, suffix))
+
+
+def fetch_changed_documents(collection_ids, state, workers=FETCH_WORKERS, on_document=None):
+    """
+    updates state in place and saves it, returns the metrics of every
+    collection; on_document(collection_id, doc_id, changed) is called for every
+    listed document as soon as it is handled, in listing order. If a document
+    fails the documents handled before it are saved and the error is raised.
+    """
+    session = login(build_session(pool_size=workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = dict(
+            zip(
+                collection_ids,
+                executor.map(lambda collection_id: list_documents(session, collection_id), collection_ids),
+            )
+        )
+        jobs = [
+            (collection_id, str(document["docId"]), get_listing_version(document))
+            for collection_id in collection_ids
+            for document in listings[collection_id]
+        ]
+        results = executor.map(
+            lambda job: fetch_document(
+                session, job[0], job[1], state.get(job[0], {}).get(job[1]), job[2]
+            ),
+            jobs,
+        )
+        new_state = {collection_id: {} for collection_id in collection_ids}
+        metrics = {
+            collection_id: {"document": collection_id, "fetched": 0, "unchanged": 0, "removed": 0, "bytes_written": 0}
+            for collection_id in collection_ids
+        }
+        try:
+            for (collection_id, doc_id, _), (entry, bytes_written) in zip(jobs, results):
+                new_state[collection_id][doc_id] = entry
+                collection_metrics = metrics[collection_id]
+                collection_metrics["fetched" if bytes_written else "unchanged"] += 1
+                collection_metrics["bytes_written"] += bytes_written
+                if on_document is not None:
+                    on_document(collection_id, doc_id, bool(bytes_written))
+        except BaseException:
+            # # keep what was downloaded, the documents not handled keep their old entries
+            for collection_id, entries in new_state.items():
+                state.setdefault(collection_id, {}).update(entries)
+            save_fetch_state(state)
+            raise
+    for collection_id in collection_ids:
+        for doc_id in set(state.get(collection_id, {})) - set(new_state[collection_id]):
+            remove_document_files(collection_id, doc_id)
+            metrics[collection_id]["removed"] += 1
+        print(
+            f"collection {collection_id}: {metrics[collection_id]['fetched']} document(s) fetched, "
+            f"{metrics[collection_id]['unchanged']} unchanged, {metrics[collection_id]['removed']} removed"
+        )
+    # # collections no longer in the baserow dump
+    for collection_id in set(state) - set(collection_ids):
+        shutil.rmtree(os.path.join(METS_DIR, collection_id), ignore_errors=True)
+    state.clear()
+    state.update(new_state)
+    save_fetch_state(state)
+    return list(metrics.values())
+
+
+def fetch_all_collections(collection_ids):
+    from transkribus_utils.transkribus_utils import ACDHTranskribusUtils
+
+    transkribus_client = ACDHTranskribusUtils(
+        user=user, password=pw, transkribus_base_url=TRANSKRIBUS_BASE_URL
+    )
+    collections = []
+    for collection_id in collection_ids:
+        collection_dir = os.path.join(METS_DIR, str(collection_id))
+        with export_report.measure_document(collection_id) as collection_metrics:
+            # # no stale METS or TEI (compressed or not) may survive the new download
+            shutil.rmtree(collection_dir, ignore_errors=True)
+            transkribus_client.collection_to_mets(collection_id, file_path=METS_DIR)
+            collection_metrics["bytes_written"] = sum(
+                store_file(file_path)
+                for file_path in glob.glob(os.path.join(collection_dir, "*.xml"))
+            )
+        collections.append(collection_metrics)
+    return collections
+
 
-transkribus_client = ACDHTranskribusUtils(
-    user=user, password=pw, transkribus_base_url="https://transkribus.eu/TrpServer/rest"
-)
-for collection_id in load_metadata_from_dump():
-    transkribus_client.collection_to_mets(collection_id, file_path="./mets")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="download the METS files of all collections")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="download every document with collection_to_mets, ignoring the fetch state",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=FETCH_WORKERS,
+        help=f"documents downloaded at a time (default: {FETCH_WORKERS})",
+    )
+    args = parser.parse_args()
+    collection_ids = list(get_documents_by_transkribus_id())
+    with export_report.measure_stage("fetch_mets") as collections:
+        if args.full:
+            collections.extend(fetch_all_collections(collection_ids))
+            if os.path.isfile(FETCH_STATE_PATH):
+                # # the next delta run starts from scratch
+                os.remove(FETCH_STATE_PATH)
+        else:
+            state = load_fetch_state()
+            collections.extend(fetch_changed_documents(collection_ids, state, args.workers))
@@ -1,23 +1,47 @@
+import argparse
 import copy
 import csv
 import datetime
-import json
 import os
 
 import jinja2
 import lxml.etree as ET
 from acdh_tei_pyutils.tei import TeiReader
+import export_report
+import metadata_store
+from goobi_images import (
+    build_goobi_iiif_base_url,
+    get_img_names_from_goobi_mets,
+    prefetch_img_names,
+)
+from build_manifest import (
+    hash_code_files,
+    hash_file,
+    hash_inputs,
+    is_up_to_date,
+    keep_old_entry,
+    load_build_manifest,
+    remove_stale_outputs,
+    save_build_manifest,
+    write_if_changed,
+)
+from create_sorter_val import keep_series_stmt, read_existing_header
+from xpath_registry import print_profile, register_xpath
 
 
 TEI_DIR = "./editions_source"
-TMP_DIR = "./mets/"
 MALFORMED_FILES_LOGPATH = "./logs/malformed_files.csv"
 TEMPLATE_PATH = "./scripts/templates"
-doc_base_row_dump_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/document.json"
-project_base_row_dump_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/project_data.json"
-doc_local_baserow_dump = TMP_DIR + "document.json"
-project_local_baserow_dump = TMP_DIR + "project_data.json"
 PROJECT_MD = {}
+BUILD_MANIFEST_SECTION = "generate_image_only_tei"
+# # the modules the image-only editions depend on, hashed into every input hash
+CODE_FILES = (
+    "generate_image_only_tei.py",
+    "goobi_images.py",
+    "create_sorter_val.py",
+    "metadata_store.py",
+    "xpath_registry.py",
+)
 malformed_xml_docs = []
 
 tei_ns = "http://www.tei-c.org/ns/1.0"
@@ -30,6 +54,9 @@ templateEnv = jinja2.Environment(
     loader=templateLoader, trim_blocks=True, lstrip_blocks=True
 )
 template = templateEnv.get_template("tei_template.j2")
+# # same placeholders as in refine_tei.py
+FAKSIMILE_PLACEHOLDER = '<facsimile xmlns="http://www.tei-c.org/ns/1.0"/>'
+BODY_PLACEHOLDER = "<body/>"
 
 
 def tei_qname(local_name):
@@ -68,35 +95,12 @@ def log_nonvalid_files():
         dict_writer.writerows(malformed_xml_docs)
 
 
-def fetch_metadata_dump(url, local_filepath):
-    import requests
-
-    print(f"downloading from {url}")
-    results = requests.get(url)
-    results.raise_for_status()
-    json_result = results.json()
-    log_directory, _ = os.path.split(local_filepath)
-    if log_directory and not os.path.exists(log_directory):
-        os.makedirs(log_directory)
-    with open(local_filepath, "w", encoding="utf-8") as outfile:
-        json.dump(json_result, outfile)
-    return json_result
-
-
 def load_project_metadata():
-    if os.path.isfile(project_local_baserow_dump):
-        with open(project_local_baserow_dump, "r", encoding="utf-8") as json_metadata_file:
-            return json.load(json_metadata_file)["1"]
-    return fetch_metadata_dump(
-        url=project_base_row_dump_url, local_filepath=project_local_baserow_dump
-    )["1"]
+    return metadata_store.get_project_metadata()
 
 
 def load_document_metadata():
-    if os.path.isfile(doc_local_baserow_dump):
-        with open(doc_local_baserow_dump, "r", encoding="utf-8") as infile:
-            return json.load(infile)
-    return fetch_metadata_dump(url=doc_base_row_dump_url, local_filepath=doc_local_baserow_dump)
+    return metadata_store.get_document_rows()
 
 
 def normalize_doc_metadata(doc_metadata):
@@ -120,37 +124,7 @@ def normalize_doc_metadata(doc_metadata):
     return normalized
 
 
-def get_goobi_imageName_from_url(image_url):
-    return image_url.split("/")[-1].split(".")[0]
-
-
-def build_goobi_iiif_base_url(bv_doc_id, image_name):
-    return f"https://viewer.acdh.oeaw.ac.at/viewer/api/v1/records/{bv_doc_id}/files/images/{image_name}"
-
-
-def get_img_names_from_goobi_mets(bv_doc_id):
-    request_target_url = (
-        f"https://viewer.acdh.oeaw.ac.at/viewer/sourcefile?id={bv_doc_id}"
-    )
-    mets_doc = TeiReader(request_target_url)
-    ns = mets_doc.nsmap
-    ns["mets"] = "http://www.loc.gov/METS/"
-    ns["xlink"] = "http://www.w3.org/1999/xlink"
-    image_links = mets_doc.tree.xpath(
-        "//mets:fileGrp[@USE='DEFAULT']//mets:FLocat[@LOCTYPE='URL']/@xlink:href",
-        namespaces=ns,
-    )
-    if not image_links:
-        raise ValueError(
-            f"No image links found for document {bv_doc_id} at {request_target_url}"
-        )
-    image_names = [get_goobi_imageName_from_url(img_link) for img_link in image_links]
-    image_names.sort(key=lambda image_name: int(image_name.removeprefix("IMG_")))
-    return image_names
-
-
-def build_facsimile(image_names, bv_doc_id):
-    facsimile = ET.Element(tei_qname("facsimile"), nsmap={None: tei_ns})
+def build_facsimile(facsimile, image_names, bv_doc_id):
     for index, image_name in enumerate(image_names, start=1):
         surface = ET.SubElement(facsimile, tei_qname("surface"))
         surface.set(f"{{{xml_ns}}}id", f"facs_{index}")
@@ -159,11 +133,9 @@ def build_facsimile(image_names, bv_doc_id):
             "url",
             build_goobi_iiif_base_url(bv_doc_id, image_name),
         )
-    return ET.tostring(facsimile, encoding="unicode")
 
 
-def build_body(image_names):
-    body = ET.Element(tei_qname("body"), nsmap={None: tei_ns})
+def build_body(body, image_names):
     div = ET.SubElement(body, tei_qname("div"))
     div.set("type", "main")
     for index, _image_name in enumerate(image_names, start=1):
@@ -172,33 +144,72 @@ def build_body(image_names):
         pb.set("n", str(index))
         pb.set(f"{{{xml_ns}}}id", f"img_{index:04d}")
         pb.set("break", "yes")
-    body_string = ET.tostring(body, encoding="unicode")
-    return body_string.replace('xmlns="http://www.tei-c.org/ns/1.0"', "")
+
+
+template_facsimile_xpath = register_xpath("template_facsimile", "./tei:facsimile")
+template_body_xpath = register_xpath("template_body", "./tei:text/tei:body")
+change_dates_xpath = register_xpath("change_dates", ".//tei:revisionDesc/tei:change/@when")
+
+
+def get_creation_date(header):
+    """
+    the date of the edition written earlier, image-only documents have no
+    source whose changes could date them; today for a new one
+    """
+    change_dates = change_dates_xpath(header) if header is not None else []
+    return change_dates[0] if change_dates else datetime.date.today().strftime("%Y-%m-%d")
 
 
 def create_new_xml_data(doc_metadata, image_names):
+    """returns the path of the edition and the bytes written, 0 if it was unchanged"""
     bv_doc_id = doc_metadata["bv_id"]
     print(f"processing {bv_doc_id}")
+    tei_file_path = os.path.join(TEI_DIR, bv_doc_id + ".xml")
+    old_header = read_existing_header(tei_file_path)
+    # # facsimile and body are built right into the parsed template
     context = {
         "project_md": PROJECT_MD,
         "doc_metadata": normalize_doc_metadata(doc_metadata),
-        "body": build_body(image_names),
-        "faksimile": build_facsimile(image_names, bv_doc_id=bv_doc_id),
-        "current_date": datetime.date.today().strftime("%Y-%m-%d"),
+        "body": BODY_PLACEHOLDER,
+        "faksimile": FAKSIMILE_PLACEHOLDER,
+        "current_date": get_creation_date(old_header),
     }
     xml_data = template.render(context)
     doc = get_xml_doc(xml_data)
     if doc is not None:
-        tei_file_path = os.path.join(TEI_DIR, bv_doc_id + ".xml")
-        print("writing", tei_file_path)
-        doc.tree_to_file(tei_file_path)
+        build_facsimile(template_facsimile_xpath(doc.tree)[0], image_names, bv_doc_id)
+        build_body(template_body_xpath(doc.tree)[0], image_names)
+        keep_series_stmt(doc.tree, old_header)
+        # # the bytes tree_to_file writes, only if they differ from the file on disk
+        bytes_written = write_if_changed(
+            tei_file_path, ET.tostring(doc.tree, xml_declaration=True, encoding="UTF-8")
+        )
+        print("writing" if bytes_written else "unchanged", tei_file_path)
+        return tei_file_path, bytes_written
+    return None, 0
+
+
+def compute_input_hash(doc_metadata, image_names):
+    return hash_inputs(
+        doc_metadata,
+        image_names,
+        PROJECT_MD,
+        hash_file(os.path.join(TEMPLATE_PATH, "tei_template.j2")),
+        hash_code_files(*CODE_FILES),
+    )
 
 
-def process_all_files():
+def process_all_files(full_rebuild=False, documents=None):
     metadata = load_document_metadata()
+    old_manifest = {} if full_rebuild else load_build_manifest(BUILD_MANIFEST_SECTION)
+    new_manifest = {}
     eligible_docs = 0
     processed_docs = 0
+    unchanged_docs = 0
     failed_docs = 0
+    prefetch_img_names(
+        row.get("bv_id") for row in metadata.values() if row.get("skip_transcription")
+    )
     for row in metadata.values():
         if not row.get("skip_transcription"):
             continue
@@ -212,17 +223,36 @@ def process_all_files():
             image_names = get_img_names_from_goobi_mets(bv_doc_id)
         except Exception as exception:
             record_malformed(bv_doc_id, exception)
+            keep_old_entry(old_manifest, new_manifest, bv_doc_id)
             failed_docs += 1
             continue
         if not image_names:
             record_malformed(bv_doc_id, "no images found")
+            keep_old_entry(old_manifest, new_manifest, bv_doc_id)
             failed_docs += 1
             continue
-        create_new_xml_data(row, image_names)
+        input_hash = compute_input_hash(row, image_names)
+        tei_file_path = os.path.join(TEI_DIR, bv_doc_id + ".xml")
+        if is_up_to_date(old_manifest.get(bv_doc_id), input_hash, tei_file_path):
+            new_manifest[bv_doc_id] = old_manifest[bv_doc_id]
+            unchanged_docs += 1
+            continue
+        with export_report.measure_document(bv_doc_id) as doc_metrics:
+            tei_file_path, doc_metrics["bytes_written"] = create_new_xml_data(row, image_names)
+        if documents is not None:
+            documents.append(doc_metrics)
+        if tei_file_path is None:
+            keep_old_entry(old_manifest, new_manifest, bv_doc_id)
+            failed_docs += 1
+            continue
+        new_manifest[bv_doc_id] = {"input_hash": input_hash}
         processed_docs += 1
+    claimed = list(new_manifest)
+    remove_stale_outputs(TEI_DIR, BUILD_MANIFEST_SECTION, old_manifest, new_manifest)
+    save_build_manifest(BUILD_MANIFEST_SECTION, new_manifest, claimed)
     if eligible_docs == 0:
         print("no image-only documents found")
-    elif processed_docs == 0:
+    elif processed_docs == 0 and unchanged_docs == 0:
         print(
             f"found {eligible_docs} image-only document(s), but none could be generated; "
             f"{failed_docs} failed (see {MALFORMED_FILES_LOGPATH})"
@@ -230,12 +260,21 @@ def process_all_files():
     else:
         print(
             f"generated {processed_docs} image-only TEI file(s) from {eligible_docs} eligible "
-            f"document(s); {failed_docs} failed"
+            f"document(s); {unchanged_docs} up to date, {failed_docs} failed"
         )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create TEIs for image-only documents")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="regenerate every document, ignoring the build manifest",
+    )
+    args = parser.parse_args()
     PROJECT_MD = load_project_metadata()
     os.makedirs(TEI_DIR, exist_ok=True)
-    process_all_files()
+    with export_report.measure_stage("generate_image_only_tei") as documents:
+        process_all_files(full_rebuild=args.full, documents=documents)
+    print_profile("generate_image_only_tei")
     log_nonvalid_files()
\ No newline at end of file
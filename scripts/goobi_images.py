@@ -0,0 +1,230 @@
+"""Image lists of the Goobi viewer METS files, cached on disk by bv_id.
+
+Cached lists are served without a request as long as they are younger than
+GOOBI_CACHE_TTL seconds, older ones are revalidated with a conditional request
+(ETag / Last-Modified). With GOOBI_OFFLINE=1 only the cache is used.
+
+prefetch_img_names resolves the lists of many documents concurrently through
+one pooled session, later calls of get_img_names_from_goobi_mets are answered
+from memory. Run this file to warm the cache for every document in the
+baserow dump.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.etree as ET
+
+from http_utils import HostRateLimiter, build_session
+
+GOOBI_CACHE_DIR = os.environ.get("GOOBI_CACHE_DIR", "./cache/goobi")
+GOOBI_CACHE_TTL = int(os.environ.get("GOOBI_CACHE_TTL", 12 * 60 * 60))
+GOOBI_OFFLINE = os.environ.get("GOOBI_OFFLINE", "") not in ("", "0", "false")
+GOOBI_TIMEOUT = 60
+GOOBI_PREFETCH_WORKERS = int(os.environ.get("GOOBI_PREFETCH_WORKERS", 8))
+GOOBI_REQUESTS_PER_SECOND = float(os.environ.get("GOOBI_REQUESTS_PER_SECOND", 10))
+
+METS_NS = "http://www.loc.gov/METS/"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
+goobi_rate_limiter = HostRateLimiter(GOOBI_REQUESTS_PER_SECOND)
+# # image lists (or the exception raised while loading them) by bv_id
+prefetched_image_names = {}
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_goobi_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session(pool_size=GOOBI_PREFETCH_WORKERS)
+        return _session
+
+
+def get_goobi_imageName_from_url(image_url):
+    return image_url.split("/")[-1].split(".")[0]
+
+
+def build_goobi_iiif_base_url(bv_doc_id, image_name):
+    return f"https://viewer.acdh.oeaw.ac.at/viewer/api/v1/records/{bv_doc_id}/files/images/{image_name}"
+
+
+def build_goobi_mets_url(bv_doc_id):
+    return f"https://viewer.acdh.oeaw.ac.at/viewer/sourcefile?id={bv_doc_id}"
+
+
+def sort_image_names(image_names):
+    image_names.sort(key=lambda image_name: int(image_name.removeprefix("IMG_")))
+    return image_names
+
+
+def parse_image_names(source):
+    """
+    streams //mets:fileGrp[@USE='DEFAULT']//mets:FLocat[@LOCTYPE='URL']/@xlink:href
+    from a METS file object, without building the whole tree
+    """
+    image_names = []
+    default_file_groups = []
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if element.tag == f"{{{METS_NS}}}fileGrp":
+            if event == "start":
+                default_file_groups.append(element.get("USE") == "DEFAULT")
+            else:
+                default_file_groups.pop()
+        elif element.tag == f"{{{METS_NS}}}FLocat" and event == "end":
+            if any(default_file_groups) and element.get("LOCTYPE") == "URL":
+                href = element.get(f"{{{XLINK_NS}}}href")
+                if href is not None:
+                    image_names.append(get_goobi_imageName_from_url(href))
+        if event == "end":
+            # # only attributes are needed, drop everything already seen
+            element.clear()
+    return image_names
+
+
+def get_cache_path(bv_doc_id):
+    return os.path.join(GOOBI_CACHE_DIR, f"{bv_doc_id}.json")
+
+
+def read_cache_entry(bv_doc_id):
+    try:
+        with open(get_cache_path(bv_doc_id), "r", encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache_entry(bv_doc_id, entry):
+    os.makedirs(GOOBI_CACHE_DIR, exist_ok=True)
+    cache_path = get_cache_path(bv_doc_id)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(entry, outfile)
+    os.replace(tmp_path, cache_path)
+
+
+def get_img_names_from_goobi_mets(bv_doc_id):
+    if bv_doc_id in prefetched_image_names:
+        result = prefetched_image_names[bv_doc_id]
+        if isinstance(result, Exception):
+            raise result
+        return list(result)
+    return load_img_names_from_goobi_mets(bv_doc_id)
+
+
+def load_img_names_from_goobi_mets(bv_doc_id):
+    request_target_url = build_goobi_mets_url(bv_doc_id)
+    entry = read_cache_entry(bv_doc_id)
+    if entry is not None and (
+        GOOBI_OFFLINE or time.time() - entry["checked_at"] < GOOBI_CACHE_TTL
+    ):
+        return list(entry["image_names"])
+    if GOOBI_OFFLINE:
+        raise ValueError(f"No cached image list for document {bv_doc_id} (offline mode)")
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    goobi_rate_limiter.wait(request_target_url)
+    with get_goobi_session().get(
+        request_target_url, headers=headers, stream=True, timeout=GOOBI_TIMEOUT
+    ) as response:
+        if response.status_code == 304 and entry is not None:
+            entry["checked_at"] = time.time()
+            write_cache_entry(bv_doc_id, entry)
+            return list(entry["image_names"])
+        response.raise_for_status()
+        response.raw.decode_content = True
+        image_names = parse_image_names(response.raw)
+        if not image_names:
+            raise ValueError(
+                f"No image links found for document {bv_doc_id} at {request_target_url}"
+            )
+        sort_image_names(image_names)
+        write_cache_entry(
+            bv_doc_id,
+            {
+                "bv_id": bv_doc_id,
+                "url": request_target_url,
+                "image_names": image_names,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "checked_at": time.time(),
+            },
+        )
+    return list(image_names)
+
+
+def load_img_names_or_exception(bv_doc_id):
+    try:
+        return load_img_names_from_goobi_mets(bv_doc_id)
+    except Exception as exception:
+        return exception
+
+
+def prefetch_img_names(bv_doc_ids, workers=GOOBI_PREFETCH_WORKERS):
+    """
+    loads the image lists of all bv_doc_ids concurrently, errors are kept
+    and raised again when the list of that document is asked for
+    """
+    bv_doc_ids = [
+        bv_doc_id
+        for bv_doc_id in dict.fromkeys(bv_doc_ids)
+        if bv_doc_id and bv_doc_id not in prefetched_image_names
+    ]
+    if not bv_doc_ids:
+        return prefetched_image_names
+    print(f"prefetching goobi image lists of {len(bv_doc_ids)} document(s)")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for bv_doc_id, result in zip(
+            bv_doc_ids, executor.map(load_img_names_or_exception, bv_doc_ids)
+        ):
+            prefetched_image_names[bv_doc_id] = result
+    failed = sum(
+        isinstance(prefetched_image_names[bv_doc_id], Exception)
+        for bv_doc_id in bv_doc_ids
+    )
+    if failed:
+        print(f"{failed} goobi image list(s) could not be loaded")
+    return prefetched_image_names
+
+
+def export_prefetched_img_names():
+    """
+    the prefetched lists for the initializer of a pool process, errors as
+    plain ValueErrors so they can be pickled
+    """
+    return {
+        bv_doc_id: ValueError(str(result)) if isinstance(result, Exception) else result
+        for bv_doc_id, result in prefetched_image_names.items()
+    }
+
+
+def import_prefetched_img_names(image_names):
+    prefetched_image_names.update(image_names)
+
+
+def collect_goobi_bv_ids(document_rows):
+    """bv_ids of all transcribed and all image-only documents"""
+    return [
+        row["bv_id"]
+        for row in document_rows
+        if row.get("bv_id")
+        and (
+            (row.get("transkribus_doc_id") or "").strip() or row.get("skip_transcription")
+        )
+    ]
+
+
+if __name__ == "__main__":
+    import export_report
+    from metadata_store import get_document_rows
+
+    with export_report.measure_stage("goobi_prefetch"):
+        prefetch_img_names(collect_goobi_bv_ids(get_document_rows().values()))
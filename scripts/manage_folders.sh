@@ -1,9 +1,11 @@
 #!/bin/bash
+# editions_source is kept, refine_tei.py only rebuilds documents whose inputs changed,
+# mets is kept, too: fetch_mets.py only downloads new or changed documents
 EDITIONSPATH="./editions_source"
 METSPATH="./mets"
 LOGPATH="./logs/malformed_files.csv"
-if [ -d "$EDITIONSPATH" ]; then rm -r "$EDITIONSPATH"; fi
-if [ -d "$METSPATH" ]; then rm -r "$METSPATH"; fi
+REPORTPATH="${EXPORT_REPORT_PATH:-./logs/export_report.json}"
 if [ -f "$LOGPATH" ]; then rm -r "$LOGPATH"; fi
+if [ -f "$REPORTPATH" ]; then rm -r "$REPORTPATH"; fi
 mkdir -p "$METSPATH"
-mkdir -p "$EDITIONSPATH"
\ No newline at end of file
+mkdir -p "$EDITIONSPATH"
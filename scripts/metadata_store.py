@@ -0,0 +1,203 @@
+"""Baserow dumps of bv-entities, loaded once on first use and shared by the scripts.
+
+Nothing is read or downloaded on import. The first access to a dump loads its
+local copy in ./mets; copies not checked for METADATA_CACHE_TTL seconds are
+revalidated with a conditional request (ETag / Last-Modified) and only
+downloaded again if they changed. With METADATA_OFFLINE=1 only the local
+copies are used.
+
+The indexes over the rows (by transkribus collection and document id, by
+bv_id, the type rows by bv_id) are built once per process, too.
+"""
+
+import json
+import os
+import threading
+import time
+
+DUMP_BASE_URL = os.environ.get(
+    "METADATA_DUMP_BASE_URL",
+    "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps",
+)
+METADATA_DIR = os.environ.get("METADATA_DIR", "./mets")
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 10 * 60))
+METADATA_OFFLINE = os.environ.get("METADATA_OFFLINE", "") not in ("", "0", "false")
+METADATA_TIMEOUT = 60
+# # file name of the dump in bv-entities, file name of the local copy
+DUMP_FILES = {
+    "document": ("document.json", "document.json"),
+    "project_data": ("project_data.json", "project_data.json"),
+    "type_of_document": ("type_of_document.json", "doc_types.json"),
+    "type_of_manifestation": ("type_of_manifestation.json", "manifestation_types.json"),
+    "data_set": ("data_set.json", "bv_data_sets.json"),
+}
+# # etag, last_modified and checked_at of every local copy
+VALIDATORS_FILE = "dump_validators.json"
+
+loaded_dumps = {}
+built_indexes = {}
+_load_lock = threading.Lock()
+
+
+def get_dump_url(dump_name):
+    return f"{DUMP_BASE_URL}/{DUMP_FILES[dump_name][0]}"
+
+
+def get_local_path(dump_name):
+    return os.path.join(METADATA_DIR, DUMP_FILES[dump_name][1])
+
+
+def read_validators():
+    try:
+        with open(os.path.join(METADATA_DIR, VALIDATORS_FILE), "r", encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_validators(dump_name, entry):
+    validators = read_validators()
+    validators[dump_name] = entry
+    validators_path = os.path.join(METADATA_DIR, VALIDATORS_FILE)
+    tmp_path = f"{validators_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(validators, outfile, indent=1)
+    os.replace(tmp_path, validators_path)
+
+
+def read_local_copy(local_path):
+    try:
+        with open(local_path, "r", encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def download_dump(dump_name, local_data):
+    """
+    returns the dump, local_data if the server says it did not change;
+    the local copy is replaced with the downloaded bytes
+    """
+    from http_utils import build_session
+
+    url = get_dump_url(dump_name)
+    local_path = get_local_path(dump_name)
+    validators = read_validators().get(dump_name, {}) if local_data is not None else {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    print(f"{'revalidating' if headers else 'downloading'} {url}")
+    with build_session(pool_size=1) as session:
+        response = session.get(url, headers=headers, timeout=METADATA_TIMEOUT)
+    if response.status_code == 304 and local_data is not None:
+        validators["checked_at"] = time.time()
+        write_validators(dump_name, validators)
+        return local_data
+    response.raise_for_status()
+    data = response.json()
+    os.makedirs(METADATA_DIR, exist_ok=True)
+    tmp_path = f"{local_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as outfile:
+        outfile.write(response.content)
+    os.replace(tmp_path, local_path)
+    write_validators(
+        dump_name,
+        {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked_at": time.time(),
+        },
+    )
+    return data
+
+
+def load_dump(dump_name):
+    local_path = get_local_path(dump_name)
+    local_data = read_local_copy(local_path)
+    if local_data is not None:
+        checked_at = read_validators().get(dump_name, {}).get("checked_at", 0)
+        if METADATA_OFFLINE or time.time() - checked_at < METADATA_CACHE_TTL:
+            return local_data
+    elif METADATA_OFFLINE:
+        raise ValueError(f"No local copy of the {dump_name} dump at {local_path} (offline mode)")
+    return download_dump(dump_name, local_data)
+
+
+def get_dump(dump_name):
+    """rows of a dump by row number, loaded on first access"""
+    dump = loaded_dumps.get(dump_name)
+    if dump is None:
+        with _load_lock:
+            dump = loaded_dumps.get(dump_name)
+            if dump is None:
+                dump = loaded_dumps[dump_name] = load_dump(dump_name)
+    return dump
+
+
+def get_index(index_name, build_index):
+    index = built_indexes.get(index_name)
+    if index is None:
+        index = built_indexes[index_name] = build_index()
+    return index
+
+
+def get_document_rows():
+    return get_dump("document")
+
+
+def get_project_metadata():
+    return get_dump("project_data")["1"]
+
+
+def get_doc_type_row(row_number: str):
+    return get_dump("type_of_document")[row_number]
+
+
+def get_manifestation_type_row(row_number: str):
+    return get_dump("type_of_manifestation")[row_number]
+
+
+def get_data_set_row(row_number: str):
+    return get_dump("data_set")[row_number]
+
+
+def index_by_bv_id(dump_name):
+    return get_index(
+        f"{dump_name}_by_bv_id",
+        lambda: {row["bv_id"]: row for row in get_dump(dump_name).values()},
+    )
+
+
+def get_doc_type_by_id(bv_id: str):
+    return index_by_bv_id("type_of_document")[bv_id]
+
+
+def get_manifestation_type_by_id(bv_id: str):
+    return index_by_bv_id("type_of_manifestation")[bv_id]
+
+
+def get_data_set_by_id(bv_id: str):
+    return index_by_bv_id("data_set")[bv_id]
+
+
+def get_document_by_bv_id(bv_id: str):
+    return index_by_bv_id("document").get(bv_id)
+
+
+def build_documents_by_transkribus_id():
+    documents_by_transkribus_id = {}
+    for row in get_document_rows().values():
+        transkribus_col_id = row["transkribus_col_id"]
+        if transkribus_col_id and transkribus_col_id.strip():
+            documents_by_transkribus_id.setdefault(transkribus_col_id, {})[
+                row["transkribus_doc_id"]
+            ] = row
+    return documents_by_transkribus_id
+
+
+def get_documents_by_transkribus_id():
+    """document rows by transkribus collection id and transkribus document id"""
+    return get_index("documents_by_transkribus_id", build_documents_by_transkribus_id)
@@ -9,22 +9,69 @@ locally, and writes a modified METS whose hrefs point to those local files.
 I HAVE NO CLUE WHY THIS IS NECESSARY, BUT IT SEEMS TO BE: Transkribus exports some PAGE XML files with TextRegion elements that lack 
 the required @custom attribute, and this causes the XSLT transformation to fail.
 
+All METS files of an export can be passed, the check replaces a
+hand-maintained list. Pages are scanned with iterparse and patched by
+inserting the attribute into the raw start tags, untouched pages are passed on
+byte for byte. Every METS gets a local copy pointing to the local pages, also
+if none of them needed a patch: the pages are downloaded anyway, so page2tei
+does not have to fetch them a second time.
+
+Pages are downloaded through one pooled session with retries, several at a
+time, and cached by URL and date of the METS (metsHdr/@LASTMODDATE), so
+re-runs skip pages that were already fetched and patched and a newly
+downloaded METS gets its pages fresh. Cached pages older than PAGE_CACHE_TTL
+seconds (default: one week) are fetched again and removed by a batch run.
+In batch mode (--output-dir) many METS files are handled by one invocation,
+each gets its own subdirectory of the output dir and one
+"<mets_file>\t<local_mets_file>\t<patched TextRegions>" line is printed per
+METS.
+
 Usage:
     python patch_page_xml.py <mets_file> <output_dir>
+    python patch_page_xml.py [--workers N] [--cache-dir DIR] --output-dir <output_dir> <mets_file>...
 """
 
+import argparse
+import hashlib
+import io
+import json
+import re
 import sys
 import os
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from lxml import etree
 
+from http_utils import build_session
+
 PAGEXML_NS = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15"
 PAGEXML_NS2 = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15"
 METS_NS = "http://www.loc.gov/METS/"
 XLINK_NS = "http://www.w3.org/1999/xlink"
+PAGE_CACHE_DIR = "./cache/page_xml"
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 7 * 24 * 3600))
+PAGE_TIMEOUT = 60
 
+TEXT_REGION_START_TAG = re.compile(rb"<((?:[\w.-]+:)?TextRegion)(?=[\s/>])([^>]*)>")
+CUSTOM_ATTRIBUTE = re.compile(rb"\scustom\s*=")
 
-def patch_page_xml(content):
+
+def count_regions_missing_custom(content):
+    """Stream through a PAGE XML file and count TextRegions without @custom."""
+    missing = 0
+    for _event, region in etree.iterparse(
+        io.BytesIO(content),
+        events=("start",),
+        tag=[f"{{{ns}}}TextRegion" for ns in [PAGEXML_NS, PAGEXML_NS2]],
+    ):
+        if "custom" not in region.attrib:
+            missing += 1
+    return missing
+
+
+def patch_page_xml_tree(content):
     """Add custom="" to TextRegion elements missing the attribute."""
     tree = etree.fromstring(content)
     patched = 0
@@ -36,10 +83,109 @@ def patch_page_xml(content):
     return etree.tostring(tree, xml_declaration=True, encoding="UTF-8"), patched
 
 
-def process_mets(mets_path, output_dir):
+def patch_page_xml(content):
+    """Add custom="" to TextRegion elements missing the attribute.
+
+    The attribute is inserted into the start tags of the raw document, so the
+    page is not re-serialized; pages that need no patch are returned as they are.
+    """
+    missing = count_regions_missing_custom(content)
+    if not missing:
+        return content, 0
+    patched = 0
+
+    def add_custom(match):
+        nonlocal patched
+        if CUSTOM_ATTRIBUTE.search(match.group(2)):
+            return match.group(0)
+        patched += 1
+        return b"<" + match.group(1) + b' custom=""' + match.group(2) + b">"
+
+    patched_content = TEXT_REGION_START_TAG.sub(add_custom, content)
+    if patched != missing:
+        # tags the pattern can't tell apart (e.g. inside comments or CDATA)
+        return patch_page_xml_tree(content)
+    return patched_content, patched
+
+
+def get_mets_version(root):
+    """the date Transkribus wrote the METS, "" if it has none"""
+    header = root.find(f"{{{METS_NS}}}metsHdr")
+    if header is None:
+        return ""
+    return header.get("LASTMODDATE") or header.get("CREATEDATE") or ""
+
+
+def get_cache_path(href, cache_dir, mets_version=""):
+    key = f"{href}\n{mets_version}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".xml")
+
+
+def is_fresh(cache_path, ttl=PAGE_CACHE_TTL):
+    try:
+        return time.time() - os.path.getmtime(cache_path + ".json") < ttl
+    except OSError:
+        return False
+
+
+def prune_page_cache(cache_dir=PAGE_CACHE_DIR, ttl=PAGE_CACHE_TTL):
+    """Remove the cached pages older than ttl seconds."""
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    removed = 0
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(".xml"):
+            continue
+        cache_path = os.path.join(cache_dir, file_name)
+        if not is_fresh(cache_path, ttl):
+            for path in (cache_path, cache_path + ".json"):
+                if os.path.isfile(path):
+                    os.remove(path)
+            removed += 1
+    if removed:
+        print(f"removed {removed} expired page(s) from {cache_dir}", file=sys.stderr)
+
+
+def fetch_patched_page(href, session, cache_dir=PAGE_CACHE_DIR, mets_version=""):
+    """Return the patched content of a PAGE XML file and the number of patched
+    TextRegions, from the cache if possible."""
+    cache_path = get_cache_path(href, cache_dir, mets_version) if cache_dir else None
+    if cache_path and os.path.isfile(cache_path) and is_fresh(cache_path):
+        with open(cache_path + ".json", "r", encoding="utf-8") as f:
+            n = json.load(f)["patched"]
+        with open(cache_path, "rb") as f:
+            return f.read(), n
+
+    print(f"  fetching {href}", file=sys.stderr)
+    resp = session.get(href, timeout=PAGE_TIMEOUT)
+    resp.raise_for_status()
+
+    patched_content, n = patch_page_xml(resp.content)
+    if n:
+        print(f"    -> patched {n} TextRegion(s) missing @custom", file=sys.stderr)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(patched_content)
+        os.replace(tmp_path, cache_path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"url": href, "mets_version": mets_version, "patched": n}, f)
+        os.replace(tmp_path, cache_path + ".json")
+    return patched_content, n
+
+
+def process_mets(mets_path, output_dir, session=None, executor=None, cache_dir=PAGE_CACHE_DIR):
+    """Write the (patched) pages and METS to output_dir and return the METS
+    path and the number of patched TextRegions."""
+    if session is None:
+        session = build_session(pool_size=1)
     tree = etree.parse(mets_path)
     root = tree.getroot()
+    mets_version = get_mets_version(root)
 
+    pages = []
     for flocat in root.findall(f".//{{{METS_NS}}}FLocat[@LOCTYPE='URL']"):
         href = flocat.get(f"{{{XLINK_NS}}}href")
         if not href:
@@ -47,15 +193,14 @@ def process_mets(mets_path, output_dir):
         parent = flocat.getparent()
         if parent.get("MIMETYPE") != "application/xml":
             continue
+        pages.append((flocat, parent, href))
 
-        print(f"  fetching {href}", file=sys.stderr)
-        resp = requests.get(href, timeout=60)
-        resp.raise_for_status()
-
-        patched_content, n = patch_page_xml(resp.content)
-        if n:
-            print(f"    -> patched {n} TextRegion(s) missing @custom", file=sys.stderr)
+    def fetch(page):
+        return fetch_patched_page(page[2], session, cache_dir, mets_version)
 
+    results = list(executor.map(fetch, pages) if executor is not None else map(fetch, pages))
+    os.makedirs(output_dir, exist_ok=True)
+    for (flocat, parent, _href), (patched_content, _n) in zip(pages, results):
         local_name = f"{parent.get('ID', 'page')}.xml"
         local_path = os.path.join(output_dir, local_name)
         with open(local_path, "wb") as f:
@@ -63,18 +208,67 @@ def process_mets(mets_path, output_dir):
 
         flocat.set(f"{{{XLINK_NS}}}href", f"file://{os.path.abspath(local_path)}")
 
-    output_mets = os.path.join(output_dir, os.path.basename(mets_path))
+    # # a compressed METS from the artifact store is written uncompressed
+    output_mets = os.path.join(output_dir, os.path.basename(mets_path).removesuffix(".gz"))
     tree.write(output_mets, xml_declaration=True, encoding="UTF-8")
-    return output_mets
+    return output_mets, sum(n for _content, n in results)
+
+
+def get_batch_subdir(mets_path):
+    """./mets/<collection>/<docid>_mets.xml -> <collection>-<docid>"""
+    collection = os.path.basename(os.path.dirname(os.path.abspath(mets_path)))
+    doc_id = os.path.basename(mets_path).split("_")[0]
+    return f"{collection}-{doc_id}"
+
+
+def process_mets_batch(mets_paths, output_dir, workers=8, cache_dir=PAGE_CACHE_DIR):
+    """Patch many METS files with one shared session and download pool, returns
+    {mets_path: (local_mets_path, patched TextRegions)}."""
+    prune_page_cache(cache_dir)
+    session = build_session(pool_size=workers, retries=5)
+    local_mets = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for mets_path in mets_paths:
+            mets_output_dir = os.path.join(output_dir, get_batch_subdir(mets_path))
+            try:
+                local_mets[mets_path] = process_mets(
+                    mets_path, mets_output_dir, session, executor, cache_dir
+                )
+            except Exception as exception:
+                # the document is transformed unpatched, as without this step
+                print(f"  could not patch {mets_path}: {exception}", file=sys.stderr)
+    patched = sum(1 for _output_mets, n in local_mets.values() if n)
+    print(f"{patched} of {len(mets_paths)} METS file(s) needed patching", file=sys.stderr)
+    return local_mets
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    parser = argparse.ArgumentParser(
+        description="patch PAGE XML files referenced in METS files for page2tei"
+    )
+    parser.add_argument("paths", nargs="+", help="<mets_file> <output_dir> or, with --output-dir, METS files")
+    parser.add_argument("--output-dir", help="batch mode: patch all given METS files into this directory")
+    parser.add_argument("--workers", type=int, default=8, help="parallel page downloads (default: 8)")
+    parser.add_argument(
+        "--cache-dir",
+        default=PAGE_CACHE_DIR,
+        help=f"cache of patched pages, empty to disable (default: {PAGE_CACHE_DIR})",
+    )
+    args = parser.parse_args()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for mets_path, (output_mets, n) in process_mets_batch(
+            args.paths, args.output_dir, args.workers, args.cache_dir
+        ).items():
+            print(f"{mets_path}\t{output_mets}\t{n}")
+        sys.exit(0)
+
+    if len(args.paths) != 2:
         print(f"Usage: {sys.argv[0]} <mets_file> <output_dir>", file=sys.stderr)
         sys.exit(1)
 
-    mets_path = sys.argv[1]
-    output_dir = sys.argv[2]
+    mets_path, output_dir = args.paths
     os.makedirs(output_dir, exist_ok=True)
 
-    print(process_mets(mets_path, output_dir))
+    print(process_mets(mets_path, output_dir, build_session(retries=5), cache_dir=args.cache_dir)[0])
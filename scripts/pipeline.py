@@ -0,0 +1,504 @@
+"""Runs the whole export with the stages overlapping, document by document.
+
+fetch_mets.py, transform.sh, refine_tei.py, generate_image_only_tei.py and
+create_sorter_val.py each wait for the one before to finish. Here every
+document is passed on as soon as a stage is done with it:
+
+    fetch -> patch PAGE XML -> XSLT (page2tei) -> refine -> editions_source
+
+Every stage runs in its own thread and hands the documents on through a
+bounded queue, a stage that falls behind makes the ones before it wait
+instead of piling up documents. The XSLT stage gathers what arrived while
+saxon was busy into one call (one JVM and one compiled stylesheet per batch),
+refine_tei runs in a pool of processes. Documents whose METS did not change
+and which still have a TEI skip patch and XSLT. The goobi image lists are
+prefetched alongside, the image-only TEIs are generated while the transcribed
+documents flow, the sorter values are set once all editions are written.
+Finally the editions are validated against the TEI schema (validate_tei.py),
+also if a stage failed, together with the log of the malformed documents.
+
+The busy time of every stage goes to the export report, a run takes about as
+long as its slowest stage.
+
+Usage:
+    python pipeline.py [--full] [--workers N] [--queue-size N] [--xslt-batch N] [--low-memory]
+                       [--search-index PATH]
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import create_sorter_val
+import export_report
+import fetch_mets
+import generate_image_only_tei
+import metadata_store
+import refine_tei
+import search_index
+import validate_tei
+from artifact_store import artifact_exists, extract_artifact, find_artifact, store_file
+from build_manifest import load_build_manifest
+from goobi_images import collect_goobi_bv_ids, prefetch_img_names
+from http_utils import build_session
+from patch_page_xml import process_mets, prune_page_cache
+from xpath_registry import merge_profile, print_profile
+
+XSL_PATH = "./page2tei/page2tei-0.xsl"
+SAXON_JAR = "./saxon/saxon9he.jar"
+SAXON_JAVA_OPTS = os.environ.get("SAXON_JAVA_OPTS", "").split()
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 16))
+XSLT_BATCH_SIZE = int(os.environ.get("XSLT_BATCH_SIZE", 32))
+# # how long the XSLT stage waits for more documents before it starts a batch
+XSLT_BATCH_WAIT = 0.5
+PATCH_WORKERS = 8
+# # marks the end of a queue
+DONE = None
+
+
+class Document:
+    """one transcribed document on its way through the stages"""
+
+    def __init__(self, collection_id, doc_id):
+        self.collection_id = collection_id
+        self.doc_id = doc_id
+        self.mets_path = fetch_mets.get_document_path(collection_id, doc_id, "_mets.xml")
+        self.tei_path = fetch_mets.get_document_path(collection_id, doc_id, "_tei.xml")
+        # # the METS page2tei reads, the local copy once the pages are downloaded
+        self.source_path = find_artifact(self.mets_path)
+        self.needs_transform = not artifact_exists(self.tei_path)
+
+
+class StageMetrics:
+    def __init__(self):
+        self.busy_seconds = 0.0
+        self.documents = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, documents=1):
+        with self.lock:
+            self.busy_seconds += seconds
+            self.documents += documents
+
+    def as_dict(self):
+        return {"seconds": round(self.busy_seconds, 3), "documents": self.documents}
+
+
+stage_metrics = {}
+stage_errors = []
+
+
+def get_stage_metrics(stage_name):
+    return stage_metrics.setdefault(stage_name, StageMetrics())
+
+
+def iterate_queue(inbox):
+    while True:
+        item = inbox.get()
+        if item is DONE:
+            return
+        yield item
+
+
+def run_stage(stage_name, stage_func, inbox, outbox, *args):
+    """
+    runs stage_func(inbox, outbox, *args) and always ends outbox, after an
+    error the rest of inbox is read and dropped so no stage before waits forever
+    """
+    try:
+        stage_func(inbox, outbox, *args)
+    except BaseException as exception:
+        print(f"stage {stage_name} failed: {exception!r}")
+        stage_errors.append((stage_name, exception))
+        if inbox is not None:
+            for _ in iterate_queue(inbox):
+                pass
+    finally:
+        if outbox is not None:
+            outbox.put(DONE)
+
+
+def start_stage(stage_name, stage_func, inbox, outbox, *args):
+    thread = threading.Thread(
+        target=run_stage, args=(stage_name, stage_func, inbox, outbox) + args, name=stage_name
+    )
+    thread.start()
+    return thread
+
+
+def fetch_stage(_inbox, outbox, collection_ids, state, workers):
+    metrics = get_stage_metrics("fetch_mets")
+    last_time = time.perf_counter()
+
+    def on_document(collection_id, doc_id, changed):
+        nonlocal last_time
+        now = time.perf_counter()
+        metrics.add(now - last_time)
+        outbox.put(Document(collection_id, doc_id))
+        # # waiting for a full queue is not work of this stage
+        last_time = time.perf_counter()
+
+    fetch_mets.fetch_changed_documents(collection_ids, state, workers, on_document)
+
+
+def patch_stage(inbox, outbox, patch_dir):
+    metrics = get_stage_metrics("patch_page_xml")
+    prune_page_cache()
+    session = build_session(pool_size=PATCH_WORKERS, retries=5)
+    with ThreadPoolExecutor(max_workers=PATCH_WORKERS) as executor:
+        for document in iterate_queue(inbox):
+            if document.needs_transform and document.source_path is not None:
+                start = time.perf_counter()
+                output_dir = os.path.join(
+                    patch_dir, f"{document.collection_id}-{document.doc_id}"
+                )
+                try:
+                    local_mets, patched = process_mets(
+                        document.source_path, output_dir, session, executor
+                    )
+                except Exception as exception:
+                    # # the document is transformed unpatched, as without this step
+                    print(f"  could not patch {document.source_path}: {exception}")
+                else:
+                    if patched:
+                        print(f"  (patched missing @custom attributes for {document.mets_path})")
+                    # # the pages are downloaded, page2tei reads the local ones
+                    document.source_path = local_mets
+                metrics.add(time.perf_counter() - start)
+            outbox.put(document)
+
+
+def take_batch(inbox, first, batch_size):
+    """first and what arrives in the next XSLT_BATCH_WAIT seconds, up to batch_size"""
+    batch = [first]
+    finished = False
+    while len(batch) < batch_size:
+        try:
+            item = inbox.get(timeout=XSLT_BATCH_WAIT)
+        except queue.Empty:
+            break
+        if item is DONE:
+            finished = True
+            break
+        batch.append(item)
+    return batch, finished
+
+
+def run_saxon(source, output, threads=None):
+    command = ["java"] + SAXON_JAVA_OPTS + [
+        "-jar",
+        SAXON_JAR,
+        f"-xsl:{XSL_PATH}",
+        f"-s:{source}",
+        f"-o:{output}",
+    ]
+    if threads:
+        command.append(f"-threads:{threads}")
+    # # what the shell passes for combine='true()' in transform.sh
+    command.append("combine=true()")
+    return subprocess.run(command).returncode
+
+
+def transform_batch(documents, threads):
+    """
+    transforms documents of one collection with one saxon call, keeping the
+    (uncompressed) METS file names page2tei sees in a single-file run
+    """
+    stage_in = tempfile.mkdtemp()
+    stage_out = tempfile.mkdtemp()
+    try:
+        staged = {}
+        for document in documents:
+            if document.source_path.endswith(".gz"):
+                staged_path = extract_artifact(document.source_path, stage_in)
+            else:
+                staged_path = os.path.join(stage_in, os.path.basename(document.mets_path))
+                os.symlink(os.path.abspath(document.source_path), staged_path)
+            staged[document] = staged_path
+        print(
+            f"transforming {len(documents)} file(s) of {documents[0].collection_id} "
+            f"with {threads} thread(s)"
+        )
+        run_saxon(stage_in, stage_out, threads)
+        for document, staged_path in staged.items():
+            result = os.path.join(stage_out, os.path.basename(staged_path))
+            if os.path.isfile(result):
+                shutil.move(result, document.tei_path)
+            else:
+                # # a failing document must not take the rest of the batch down with it
+                print(f"no batch result for {document.mets_path}, transforming it on its own")
+                run_saxon(staged_path, document.tei_path)
+            if os.path.isfile(document.tei_path):
+                store_file(document.tei_path)
+    finally:
+        shutil.rmtree(stage_in, ignore_errors=True)
+        shutil.rmtree(stage_out, ignore_errors=True)
+
+
+def xslt_stage(inbox, outbox, batch_size, threads):
+    metrics = get_stage_metrics("transform_xslt")
+    finished = False
+    while not finished:
+        item = inbox.get()
+        if item is DONE:
+            break
+        batch, finished = take_batch(inbox, item, batch_size)
+        pending = {}
+        for document in batch:
+            if document.needs_transform and document.source_path is not None:
+                pending.setdefault(document.collection_id, []).append(document)
+            else:
+                outbox.put(document)
+        for documents in pending.values():
+            start = time.perf_counter()
+            transform_batch(documents, threads)
+            metrics.add(time.perf_counter() - start, len(documents))
+            for document in documents:
+                outbox.put(document)
+
+
+def refine_in_worker(*args):
+    """refine_tei.refine_file_in_worker and the seconds it took"""
+    start = time.perf_counter()
+    result = refine_tei.refine_file_in_worker(*args)
+    return time.perf_counter() - start, result
+
+
+def refine_stage(inbox, _outbox, goobi_thread, workers, full_rebuild, documents):
+    metrics = get_stage_metrics("refine_tei")
+    # # the workers get the prefetched image lists instead of loading them again
+    goobi_thread.join()
+    metadata = refine_tei.load_metadata_from_dump()
+    old_manifest = {} if full_rebuild else load_build_manifest(refine_tei.BUILD_MANIFEST_SECTION)
+    new_manifest = {}
+    input_hashes = {}
+    written_files = {}
+    futures = []
+    # # forking a process that runs threads is not safe, the workers start from a fresh interpreter
+    executor = (
+        refine_tei.create_worker_pool(workers, multiprocessing.get_context("forkserver"))
+        if workers > 1
+        else None
+    )
+    try:
+        for document in iterate_queue(inbox):
+            xml_file_path = find_artifact(document.tei_path)
+            if xml_file_path is None:
+                continue
+            start = time.perf_counter()
+            if refine_tei.needs_refining(
+                xml_file_path,
+                document.collection_id,
+                metadata,
+                old_manifest,
+                new_manifest,
+                input_hashes,
+            ):
+                doc_metadata = refine_tei.get_doc_metadata(
+                    metadata, xml_file_path, document.collection_id
+                )
+                if executor is not None:
+                    futures.append(
+                        (
+                            xml_file_path,
+                            executor.submit(
+                                refine_in_worker,
+                                xml_file_path,
+                                document.collection_id,
+                                doc_metadata,
+                            ),
+                        )
+                    )
+                else:
+                    written_files[xml_file_path], doc_metrics = refine_tei.refine_document(
+                        xml_file_path, document.collection_id, doc_metadata
+                    )
+                    if doc_metrics is not None:
+                        documents.append(doc_metrics)
+            metrics.add(time.perf_counter() - start)
+        # # collect in the order the documents arrived, like process_files_in_pool
+        for xml_file_path, future in futures:
+            seconds, (tei_file_path, malformed_entries, doc_metrics, xpath_profile, http_requests) = (
+                future.result()
+            )
+            # # the time spent in the workers, summed up
+            metrics.add(seconds, 0)
+            written_files[xml_file_path] = tei_file_path
+            refine_tei.malformed_xml_docs.extend(malformed_entries)
+            merge_profile(xpath_profile)
+            export_report.add_http_requests(http_requests)
+            if doc_metrics is not None:
+                documents.append(doc_metrics)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(f"{len(input_hashes)} document(s) refined, {len(new_manifest)} up to date")
+    # # after an error before refine not every document arrived, nothing is pruned
+    refine_tei.update_build_manifest(
+        written_files, input_hashes, old_manifest, new_manifest, prune=not stage_errors
+    )
+
+
+def goobi_stage(_inbox, _outbox):
+    start = time.perf_counter()
+    prefetch_img_names(collect_goobi_bv_ids(metadata_store.get_document_rows().values()))
+    get_stage_metrics("goobi_prefetch").add(time.perf_counter() - start, 0)
+
+
+def image_only_stage(_inbox, _outbox, goobi_thread, full_rebuild, documents):
+    # # the image lists are prefetched by goobi_stage, not loaded twice
+    goobi_thread.join()
+    start = time.perf_counter()
+    generate_image_only_tei.process_all_files(full_rebuild=full_rebuild, documents=documents)
+    get_stage_metrics("generate_image_only_tei").add(time.perf_counter() - start, len(documents))
+
+
+def record_stages(documents_by_stage):
+    for stage_name, metrics in stage_metrics.items():
+        stage_documents = documents_by_stage.get(stage_name)
+        export_report.record_stage(
+            stage_name,
+            dict(
+                metrics.as_dict(),
+                bytes_written=sum(doc.get("bytes_written", 0) for doc in stage_documents or []),
+            ),
+            stage_documents or None,
+        )
+
+
+def run_pipeline(full_rebuild=False, workers=1, queue_size=PIPELINE_QUEUE_SIZE, xslt_batch=XSLT_BATCH_SIZE):
+    collection_ids = list(metadata_store.get_documents_by_transkribus_id())
+    project_md = metadata_store.get_project_metadata()
+    refine_tei.PROJECT_MD = project_md
+    generate_image_only_tei.PROJECT_MD = project_md
+    if full_rebuild:
+        shutil.rmtree(refine_tei.TEI_DIR, ignore_errors=True)
+    os.makedirs(refine_tei.TEI_DIR, exist_ok=True)
+    state = {} if full_rebuild else fetch_mets.load_fetch_state()
+    fetched = queue.Queue(maxsize=queue_size)
+    patched = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    refined_documents = []
+    image_only_documents = []
+    patch_dir = tempfile.mkdtemp()
+    try:
+        goobi_thread = start_stage("goobi_prefetch", goobi_stage, None, None)
+        threads = [
+            goobi_thread,
+            start_stage(
+                "generate_image_only_tei",
+                image_only_stage,
+                None,
+                None,
+                goobi_thread,
+                full_rebuild,
+                image_only_documents,
+            ),
+            start_stage("fetch_mets", fetch_stage, None, fetched, collection_ids, state, fetch_mets.FETCH_WORKERS),
+            start_stage("patch_page_xml", patch_stage, fetched, patched, patch_dir),
+            start_stage("transform_xslt", xslt_stage, patched, transformed, xslt_batch, workers),
+            start_stage(
+                "refine_tei",
+                refine_stage,
+                transformed,
+                None,
+                goobi_thread,
+                workers,
+                full_rebuild,
+                refined_documents,
+            ),
+        ]
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(patch_dir, ignore_errors=True)
+    record_stages(
+        {"refine_tei": refined_documents, "generate_image_only_tei": image_only_documents}
+    )
+    if stage_errors:
+        stage_name, exception = stage_errors[0]
+        raise RuntimeError(f"stage {stage_name} failed") from exception
+    # # the order numbers depend on every edition of a data set
+    with export_report.measure_stage("create_sorter_val") as documents:
+        catalogue, headers = create_sorter_val.make_catalogue(create_sorter_val.inputpath)
+        create_sorter_val.sort_and_update_catalogue(
+            catalogue, headers, workers=workers, documents=documents
+        )
+    # # indexed after the sorter, which may change the editions once more
+    refine_tei.update_search_index()
+
+
+def log_and_validate(full_rebuild, workers):
+    print_profile("pipeline")
+    refine_tei.log_nonvalid_files()
+    generate_image_only_tei.log_nonvalid_files()
+    # # after the logs above, refine_tei starts the log anew
+    with export_report.measure_stage("validate_tei") as documents:
+        validate_tei.validate_all_files(workers=workers, full=full_rebuild, documents=documents)
+
+
+def run_export(full_rebuild=False, workers=1, queue_size=PIPELINE_QUEUE_SIZE, xslt_batch=XSLT_BATCH_SIZE):
+    """
+    run_pipeline, then the log of the malformed documents and the validation;
+    both also run after a failed stage, for the editions written so far, and
+    the error of the stage is raised, not one of the logs or the validation
+    """
+    try:
+        with export_report.measure_stage("pipeline"):
+            run_pipeline(full_rebuild, workers, queue_size, xslt_batch)
+    except BaseException:
+        try:
+            log_and_validate(full_rebuild, workers)
+        except Exception as exception:
+            print(f"validation after the failed pipeline failed: {exception!r}")
+        raise
+    log_and_validate(full_rebuild, workers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fetch, transform and refine all documents")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="fetch and rebuild every document, ignoring the fetch state and the build manifest",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="refine processes and saxon threads (default: 1)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=PIPELINE_QUEUE_SIZE,
+        help=f"documents waiting between two stages at most (default: {PIPELINE_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--xslt-batch",
+        type=int,
+        default=XSLT_BATCH_SIZE,
+        help=f"documents transformed by one saxon call at most (default: {XSLT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="refine with refine_tei's bounded-memory mode",
+    )
+    parser.add_argument(
+        "--search-index",
+        default=search_index.SEARCH_INDEX_PATH,
+        help="update the full text index of articles and legal sections in this SQLite file",
+    )
+    args = parser.parse_args()
+    refine_tei.LOW_MEMORY = refine_tei.LOW_MEMORY or args.low_memory
+    search_index.SEARCH_INDEX_PATH = args.search_index
+    if not os.path.isfile(XSL_PATH):
+        raise SystemExit(f"xsl script {XSL_PATH} not found!")
+    run_export(args.full, args.workers, args.queue_size, args.xslt_batch)
@@ -1,5 +1,8 @@
 import os
+import argparse
+import ctypes
 import datetime
+import gc
 import glob
 import shutil
 import re
@@ -7,22 +10,57 @@ import lxml.etree as ET
 import lxml.builder as builder
 import jinja2
 import csv
-import json
+from concurrent.futures import ProcessPoolExecutor
 from acdh_tei_pyutils.tei import TeiReader
+import export_report
+from artifact_store import find_artifact
+import metadata_store
+import search_index
+from tree_rewriter import TreeRewriter
+from structure_rules import DIGIT_PATTERN, LABEL_PATTERN, RULE_SET
+from xpath_registry import merge_profile, print_profile, register_xpath, take_profile
+from goobi_images import (
+    build_goobi_iiif_base_url,
+    export_prefetched_img_names,
+    get_img_names_from_goobi_mets,
+    import_prefetched_img_names,
+    prefetch_img_names,
+)
+from build_manifest import (
+    hash_code_files,
+    hash_file,
+    hash_inputs,
+    is_up_to_date,
+    keep_old_entry,
+    load_build_manifest,
+    remove_stale_outputs,
+    save_build_manifest,
+    write_if_changed,
+)
+from create_sorter_val import keep_series_stmt, read_existing_header
 
 
 TEI_DIR = "./editions_source"
 TMP_DIR = "./mets/"
 MALFORMED_FILES_LOGPATH = "./logs/malformed_files.csv"
 TEMPLATE_PATH = "./scripts/templates"
-doc_base_row_dump_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/document.json"
-project_base_row_dump_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/project_data.json"
-doc_local_baserow_dump = TMP_DIR + "document.json"
-project_local_baserow_dump = TMP_DIR + "project_data.json"
-project_doc_types_dump = TMP_DIR + "doc_types.json"
-project_manifestation_types_dump = TMP_DIR + "manifestation_types.json"
-project_data_sets_dump = TMP_DIR + "bv_data_sets.json"
 PROJECT_MD = {}
+BUILD_MANIFEST_SECTION = "refine_tei"
+# # the modules the refined editions depend on, hashed into every input hash
+CODE_FILES = (
+    "refine_tei.py",
+    "structure_rules.py",
+    "tree_rewriter.py",
+    "xpath_registry.py",
+    "goobi_images.py",
+    "create_sorter_val.py",
+    "metadata_store.py",
+)
+# # called as STAGE_HOOK(stage_name, stage_func, *args, **kwargs) for every step of create_new_xml_data
+STAGE_HOOK = None
+# # drop the trees and strings of a document as soon as they are used and hand
+# # the memory back to the system after every document
+LOW_MEMORY = os.environ.get("REFINE_LOW_MEMORY", "") not in ("", "0", "false")
 
 
 # # load template
@@ -31,8 +69,15 @@ templateEnv = jinja2.Environment(
     loader=templateLoader, trim_blocks=True, lstrip_blocks=True
 )
 template = templateEnv.get_template("tei_template.j2")
+# # the facsimile used to be pasted in with its namespace declaration, the body without
+FAKSIMILE_PLACEHOLDER = '<facsimile xmlns="http://www.tei-c.org/ns/1.0"/>'
+BODY_PLACEHOLDER = "<body/>"
 file_rename_errors = 0
 nsmap = {"tei": "http://www.tei-c.org/ns/1.0"}
+lb_tag = f"{{{nsmap['tei']}}}lb"
+p_tag = f"{{{nsmap['tei']}}}p"
+# # what normalize-space() strips
+xml_whitespace = " \t\r\n"
 # # xml factory
 teiMaker = builder.ElementMaker(namespace="http://www.tei-c.org/ns/1.0", nsmap=nsmap)
 # logfile for defective docs
@@ -47,35 +92,6 @@ def remove_prefix(string, prefix):
     return string
 
 
-def get_goobi_imageName_from_url(image_url):
-    return image_url.split("/")[-1].split(".")[0]
-
-
-def build_goobi_iiif_base_url(bv_doc_id, image_name):
-    return f"https://viewer.acdh.oeaw.ac.at/viewer/api/v1/records/{bv_doc_id}/files/images/{image_name}"
-
-
-def get_img_names_from_goobi_mets(bv_doc_id):
-    request_target_url = (
-        f"https://viewer.acdh.oeaw.ac.at/viewer/sourcefile?id={bv_doc_id}"
-    )
-    mets_doc = TeiReader(request_target_url)
-    nsmap = mets_doc.nsmap
-    nsmap["mets"] = "http://www.loc.gov/METS/"
-    nsmap["xlink"] = "http://www.w3.org/1999/xlink"
-    image_links = mets_doc.tree.xpath(
-        "//mets:fileGrp[@USE='DEFAULT']//mets:FLocat[@LOCTYPE='URL']/@xlink:href",
-        namespaces=nsmap,
-    )
-    if not image_links:
-        raise ValueError(
-            f"No image links found for document {bv_doc_id} at {request_target_url}"
-        )
-    image_names = [get_goobi_imageName_from_url(img_link) for img_link in image_links]
-    image_names.sort(key=lambda image_name: int(image_name.removeprefix("IMG_")))
-    return image_names
-
-
 def replace_transkribus_images_with_goobi(graphic_elements, bv_doc_id):
     image_names = get_img_names_from_goobi_mets(bv_doc_id)
     # might need to delete one of the image_names due to remove_useless_elements
@@ -146,84 +162,111 @@ def log_nonvalid_files():
             dict_writer.writerows(malformed_xml_docs)
 
 
-def seed_div_elements(doc: TeiReader, xpath_expr, regex_test, type_val):
+def is_div(node):
+    return isinstance(node.tag, str) and ET.QName(node).localname == "div"
+
+
+def find_section_heads(parent_element: ET._Element, rule_set, found: list):
+    """
+    collects (node, rule) for every node whose tail follows an lb on the same
+    level and matches a section head rule, in document order of the tails
+    """
+    lb_seen = False
+    for child in parent_element:
+        if isinstance(child.tag, str) and len(child):
+            find_section_heads(child, rule_set, found)
+        if child.tag == lb_tag:
+            lb_seen = True
+        if lb_seen and child.tail:
+            rule = rule_set.match_head(child.tail)
+            if rule is not None:
+                found.append((child, rule))
+    return found
+
+
+def find_numbered_start_strings(parent_element: ET._Element, found: list):
+    """
+    collects (node, is_tail, text) for the texts after an lb on the same level
+    and the leading texts of the p elements below parent_element that contain
+    a number, in document order; what
+    .//tei:lb/following-sibling::text()[contains number]|.//tei:p/node()[1][self::text() and contains number]
+    selects, in one walk instead of a scan of the siblings of every lb
+    """
+    lb_seen = False
+    for child in parent_element:
+        if isinstance(child.tag, str):
+            if child.tag == p_tag and child.text and DIGIT_PATTERN.search(child.text):
+                found.append((child, False, child.text))
+            if len(child):
+                find_numbered_start_strings(child, found)
+            if child.tag == lb_tag:
+                lb_seen = True
+        if lb_seen and child.tail and DIGIT_PATTERN.search(child.tail):
+            found.append((child, True, child.tail))
+    return found
+
+
+body_xpath = register_xpath("body", ".//tei:body")
+
+
+def seed_div_elements(doc: TeiReader, rule_set):
     reverse_ordered_div_elements = []
-    section_head_strs = doc.any_xpath(xpath_expr)
-    section_head_strs.reverse()
-    for head_str in section_head_strs:
-        head_str: ET._ElementUnicodeResult
-        if re.match(regex_test, head_str.strip()):
-            head_element = head_str.getparent()
-            if head_str.is_tail:
-                head_element.tag = f"{{{nsmap['tei']}}}head"
-                head_element.text = head_str
-                head_element.tail = "\n"
-                section_div = teiMaker.div("\n", type=type_val)
-                section_div.tail = "\n"
-                head_element.addprevious(section_div)
-                section_div.append(head_element)
-                reverse_ordered_div_elements.append(section_div)
+    body_node = body_xpath(doc.tree)[0]
+    head_elements = find_section_heads(body_node, rule_set, [])
+    head_elements.reverse()
+    for head_element, rule in head_elements:
+        head_str = head_element.tail
+        head_element.tag = f"{{{nsmap['tei']}}}head"
+        head_element.text = head_str
+        head_element.tail = "\n"
+        section_div = teiMaker.div("\n", type=rule.type_val)
+        section_div.tail = "\n"
+        head_element.addprevious(section_div)
+        section_div.append(head_element)
+        reverse_ordered_div_elements.append(section_div)
     return reverse_ordered_div_elements
 
 
-def seed_item_elements(parent_element: ET._Element, xpath_expr, regex_test):
-    reverse_ordered_item_elements = []
-    start_strings = parent_element.xpath(xpath_expr, namespaces=nsmap)
-    start_strings.reverse()
-    for start_string in start_strings:
-        start_string: ET._ElementUnicodeResult
-        if re.match(regex_test, start_string.strip()):
-            parent_element = start_string.getparent()
-            if start_string.is_tail:
-                item_element = parent_element
-                item_element.tag = f"{{{nsmap['tei']}}}item"
-                item_element.text = start_string
-                item_element.tail = "\n"
-                item_element.attrib.clear()
-            else:
-                item_element = teiMaker.item(start_string)
-                parent_element.text = ""
-                parent_element.insert(0, item_element)
-            reverse_ordered_item_elements.append(item_element)
-    return reverse_ordered_item_elements
+def match_start_strings(parent_element: ET._Element, rule_set):
+    """
+    the numbered start strings below parent_element that match a legal
+    section rule as (node, is_tail, text, rule), last one first
+    """
+    matches = []
+    for node, is_tail, start_string in reversed(find_numbered_start_strings(parent_element, [])):
+        rule = rule_set.match_start(start_string)
+        if rule is not None:
+            matches.append((node, is_tail, start_string, rule))
+    return matches
+
+
+is_p_or_lb_xpath = register_xpath("is_p_or_lb", "local-name()='p' or local-name()='lb'")
 
 
-def seed_jur_p_elements(parent_element: ET._Element, xpath_expr, regex_test):
+def seed_jur_p_elements(start_strings):
     reverse_ordered_ps = []
-    start_strings = parent_element.xpath(xpath_expr, namespaces=nsmap)
-    start_strings.reverse()
-    for start_string in start_strings:
-        start_string: ET._ElementUnicodeResult
-        if re.match(regex_test, start_string.strip()):
-            parent_element = start_string.getparent()
-            if start_string.is_tail:
-                if not parent_element.xpath("local-name()='p' or local-name()='lb'"):
-                    dummy_element = teiMaker.lb()
-                    # dummy_element.tail = parent_element.tail
-                    # parent_element.tail = ""
-                    parent_element.addnext(dummy_element)
-                    parent_element.tail = ""
-                    item_element = dummy_element
-                else:
-                    item_element = parent_element
-                item_element.tag = f"{{{nsmap['tei']}}}p"
-                item_element.text = start_string
-                item_element.tail = "\n"
-                item_element.attrib.clear()
+    for parent_element, is_tail, start_string, rule in start_strings:
+        if is_tail:
+            if not is_p_or_lb_xpath(parent_element):
+                dummy_element = teiMaker.lb()
+                # dummy_element.tail = parent_element.tail
+                # parent_element.tail = ""
+                parent_element.addnext(dummy_element)
+                parent_element.tail = ""
+                item_element = dummy_element
             else:
                 item_element = parent_element
-            item_element.set("type", "legal_section")
-            reverse_ordered_ps.append(item_element)
+            item_element.tag = f"{{{nsmap['tei']}}}p"
+            item_element.text = start_string
+            item_element.tail = "\n"
+            item_element.attrib.clear()
+        else:
+            item_element = parent_element
+        item_element.set("type", rule.type_val)
+        reverse_ordered_ps.append(item_element)
     return reverse_ordered_ps
 
 
-def expand_item_element(item_element: ET._Element):
-    next_element = item_element.getnext()
-    while bool(next_element is not None and next_element.tag != "item"):
-        item_element.append(next_element)
-        next_element = item_element.getnext()
-
-
 def expand_jur_p_element(p_element: ET._Element):
     next_element = p_element.getnext()
     while bool(next_element is not None and next_element.tag != "p"):
@@ -231,37 +274,86 @@ def expand_jur_p_element(p_element: ET._Element):
         next_element = p_element.getnext()
 
 
-def raise_div_element(section_div: ET._Element):
-    parent_element = section_div.getparent()
-    while parent_element.xpath("local-name()") != "div":
-        if section_div.getprevious() is not None:
-            parent_split_element = teiMaker.stuff("\n")
-            parent_split_element.tag = parent_element.tag
-            siblings = section_div.xpath("following-sibling::*")
-            for element in siblings:
-                parent_split_element.append(element)
-            parent_element.addnext(parent_split_element)
-            parent_element.addnext(section_div)
+def split_at_div_elements(element: ET._Element, section_divs: set, split_elements: set):
+    """
+    returns the nodes taking the place of element once the section divs inside
+    of it are raised to its level: element keeps everything before the first
+    div, the content after every div goes to a new element with the same tag
+    """
+    nodes = [element]
+    segments = [(element, [])]
+    for child in list(element):
+        if child in split_elements:
+            child_nodes = split_at_div_elements(child, section_divs, split_elements)
         else:
-            if parent_element.text and parent_element.text.strip():
-                parent_split_element = teiMaker.randomTagShouldntExist("\n")
-                parent_split_element.tag = parent_element.tag
-                parent_split_element.text = parent_element.text
-                parent_element.text = ""
-                parent_element.addprevious(parent_split_element)
-            parent_element.addprevious(section_div)
+            child_nodes = [child]
+        for node in child_nodes:
+            if node not in section_divs:
+                segments[-1][1].append(node)
+            elif len(nodes) == 1 and not segments[0][1]:
+                # # div is the first child, only text stays in front of it
+                if element.text and element.text.strip():
+                    text_element = teiMaker(element.tag, element.text)
+                    element.text = ""
+                    nodes.insert(0, text_element)
+                nodes.insert(-1, node)
+            else:
+                split_element = teiMaker(element.tag, "\n")
+                segments.append((split_element, []))
+                nodes += [node, split_element]
+    for segment, children in segments:
+        for node in children:
+            segment.append(node)
+    return nodes
+
+
+def place_div_elements(section_divs: list):
+    """
+    moves every section div up to the child level of its closest div ancestor
+    and fills it with the following siblings up to the next div
+    """
+    section_div_set = set(section_divs)
+    split_elements = set()
+    container_divs = {}
+    for section_div in section_divs:
         parent_element = section_div.getparent()
+        while not is_div(parent_element):
+            split_elements.add(parent_element)
+            parent_element = parent_element.getparent()
+            if parent_element is None:
+                raise ValueError("section head outside of any div")
+        container_divs[parent_element] = None
+    for container_div in container_divs:
+        nodes = []
+        for child in list(container_div):
+            if child in split_elements:
+                nodes += split_at_div_elements(child, section_div_set, split_elements)
+            else:
+                nodes.append(child)
+        current_div = None
+        for node in nodes:
+            if is_div(node):
+                current_div = node if node in section_div_set else None
+                container_div.append(node)
+            elif current_div is not None:
+                current_div.append(node)
+            else:
+                container_div.append(node)
+
+
+pbs_after_p_xpath = register_xpath(
+    "pbs_after_p", "//tei:div/tei:pb[preceding-sibling::*[1][local-name()='p']]"
+)
+is_p_xpath = register_xpath("is_p", "local-name()='p'")
 
 
 def place_the_goddam_pb_inside_of_last_p_sibling_element_if_there_is_one(doc):
-    for pb in doc.any_xpath(
-        f"//tei:div/tei:pb[preceding-sibling::*[1][local-name()='p']]"
-    ):
+    for pb in pbs_after_p_xpath(doc.tree):
         p = pb.getprevious()
         if p.tail is None:
             p.tail = ""
         next_element = pb.getnext()
-        if next_element is not None and next_element.xpath("local-name()='p'"):
+        if next_element is not None and is_p_xpath(next_element):
             if next_element.tail:
                 p.tail += next_element.tail
             # this binds next_el.text to pb.tail
@@ -284,13 +376,6 @@ def place_the_goddam_pb_inside_of_last_p_sibling_element_if_there_is_one(doc):
             p.append(pb)
 
 
-def expand_div_element(section_div: ET._Element, append_test):
-    next_element = section_div.getnext()
-    while append_test(next_element):
-        section_div.append(next_element)
-        next_element = section_div.getnext()
-
-
 def expand_list_element(list_element: ET._Element):
     next_element = list_element.getnext()
     while bool(
@@ -302,8 +387,11 @@ def expand_list_element(list_element: ET._Element):
         next_element = list_element.getnext()
 
 
+first_labels_xpath = register_xpath("first_labels", ".//*/tei:label[1]")
+
+
 def make_lists(div: ET._Element):
-    labels = div.xpath(".//*/tei:label[1]", namespaces=nsmap)
+    labels = first_labels_xpath(div)
     list_elements = []
     for label in labels:
         list_element = teiMaker.list()
@@ -313,46 +401,18 @@ def make_lists(div: ET._Element):
         expand_list_element(list_element)
 
 
-def make_article_divs(doc):
-    article_type = "article"
-    # # make artikel-divs
-    article_divs = seed_div_elements(
-        doc,
-        # xpath_expr=r"//tei:body//tei:lb/following-sibling::text()[contains(., 'Art.') or contains(., 'Artikel')]",
-        xpath_expr=r"//tei:body//tei:lb/following-sibling::text()[contains(., 'Art')]",
-        regex_test=r"Art(?:ikel|\.)?(?: *[0-9]+| *[iIVvXxCcDdMmLl]+) *\.* *$",
-        # regex_test=r" *Art\. *$",
-        type_val=article_type,
-    )
-    # # move created divs to child-level of main div
-    for div in article_divs:
-        raise_div_element(div)
-
-    # # place content in article divs
-    for div in article_divs:
-        expand_div_element(
-            div,
-            append_test=lambda next_element: bool(
-                next_element is not None and next_element.xpath("local-name()!='div'")
-            ),
-        )
+def make_article_divs(doc, rule_set):
+    # # make artikel-divs (and the divs of any other section head rule)
+    article_divs = seed_div_elements(doc, rule_set)
+    # # move created divs to child-level of main div and place content in them
+    place_div_elements(article_divs)
     return article_divs
 
 
-def make_label(item: ET._Element):
-    if item.text is None:
-        return
-    match = re.match(r"^([ \[\]().0-9]+)(.*)", item.text)
-    if match:
-        label = teiMaker.label(match.group(1).strip())
-        item.text = item.text.removeprefix(match.group(1)).strip()
-        item.addprevious(label)
-
-
 def make_p_label(p_element: ET._Element):
     if p_element.text is None:
         return
-    match = re.match(r"^([ \[\]().0-9]+)(.*)", p_element.text)
+    match = LABEL_PATTERN.match(p_element.text)
     if match:
         label_text = match.group(1).rstrip()
         label = teiMaker.label(label_text)
@@ -362,70 +422,61 @@ def make_p_label(p_element: ET._Element):
         p_element.insert(0, label)
 
 
-contains_number_xpath = "boolean(translate(., '1234567890', '') != .)"
-
-
-def make_items_in_article(article_div: ET._Element):
-    items = seed_item_elements(
-        article_div,
-        xpath_expr=f".//tei:lb/following-sibling::text()[{contains_number_xpath}]|.//tei:p/node()[1][self::text() and {contains_number_xpath}]",
-        regex_test=r"^ *[(\]]* ?[0-9]{1,2} *[.)\]]*.*?[a-zA-Z].*",
-    )
-    for item in items:
-        expand_item_element(item)
-    for item in items:
-        make_label(item)
-
-
-def denest_p_elements(article_div: ET._Element, ps_with_subs: list):
-    for p_with_subs in ps_with_subs:
-        sub_ps = reversed(p_with_subs.xpath("./*[local-name()='p']", namespaces=nsmap))
-        for sub_p in sub_ps:
-            following_sibling = sub_p.getnext()
-            if following_sibling is None:
-                p_with_subs.addnext(sub_p)
-    return article_div.xpath(
-        "./tei:p[./tei:p[not(following-sibling::*)]]", namespaces=nsmap
-    )
-
-
-def make_jur_sections_in_article(article_div: ET._Element):
-    reverse_ordered_ps = seed_jur_p_elements(
-        article_div,
-        xpath_expr=f".//tei:lb/following-sibling::text()[{contains_number_xpath}]|.//tei:p/node()[1][self::text() and {contains_number_xpath}]",
-        regex_test=r"^ *[(\]]* ?[0-9]{1,2} *[.)\]]*.*?[a-zA-Z].*",
-    )
+def denest_p_elements(article_div: ET._Element):
+    """
+    moves the p elements closing a p of the article behind it, in one walk
+    over the children of the article: the moved ps are the next children
+    visited, so a chain of nested sections ends up flat without scanning the
+    article again per level; every p of the article gets a type
+    """
+    child = article_div[0] if len(article_div) else None
+    while child is not None:
+        if child.tag == p_tag:
+            # # the last p first, each one right behind child keeps their order
+            while len(child) and child[-1].tag == p_tag:
+                child.addnext(child[-1])
+            if child.get("type") is None:
+                child.set("type", "legal_section")
+        child = child.getnext()
+
+
+def make_jur_sections_in_article(article_div: ET._Element, rule_set):
+    # # one walk over the article classifies every numbered start string
+    start_strings = match_start_strings(article_div, rule_set)
+    reverse_ordered_ps = seed_jur_p_elements(start_strings)
     for p in reverse_ordered_ps:
         expand_jur_p_element(p)
     for p in reverse_ordered_ps:
         make_p_label(p)
-    ps_with_subs = article_div.xpath(
-        "./tei:p[./tei:p[not(following-sibling::*)]]", namespaces=nsmap
-    )
-    while ps_with_subs:
-        ps_with_subs = denest_p_elements(article_div, ps_with_subs)
-    for p in article_div.xpath("./tei:p[not(@type)]", namespaces=nsmap):
-        p.set("type", "legal_section")
+    denest_p_elements(article_div)
 
 
-def substitute_useless_elements(doc: TeiReader, substitution_dict: dict):
+def substitute_useless_elements(rewriter: TreeRewriter, substitution_dict: dict):
     for (
         substituted_element_name,
         substitution_element_name,
     ) in substitution_dict.items():
-        for substituted in doc.any_xpath(f"//tei:{substituted_element_name}"):
+
+        def substitute(
+            substituted,
+            substituted_element_name=substituted_element_name,
+            substitution_element_name=substitution_element_name,
+        ):
             substituted.tag = (
                 substituted.tag.rstrip(substituted_element_name)
                 + substitution_element_name
             )
 
+        rewriter.register(f"{{{nsmap['tei']}}}{substituted_element_name}", substitute)
 
-def remove_useless_atributes(doc: TeiReader):
-    elements = doc.any_xpath(
-        ".//*[local-name()='lb' or local-name()='p' or local-name()='head']"
-    )
-    for element in elements:
-        element.attrib.clear()
+
+def clear_attributes(element: ET._Element):
+    element.attrib.clear()
+
+
+def remove_useless_atributes(rewriter: TreeRewriter):
+    for local_name in ("lb", "p", "head"):
+        rewriter.register(local_name, clear_attributes)
 
 
 def remove_lb_preserve_text(new_text: str, prev_element, parent_element, lb):
@@ -436,221 +487,514 @@ def remove_lb_preserve_text(new_text: str, prev_element, parent_element, lb):
     parent_element.remove(lb)
 
 
-def replace_unleserlichs(doc):
-    for text_node in doc.any_xpath(
-        '//tei:div[@type="main"]//text()[normalize-space()="unleserlich" or normalize-space()="Unleserlich"]'
-    ):
+def is_unleserlich(text):
+    return (
+        text is not None
+        and "nleserlich" in text
+        and text.strip(xml_whitespace) in ("unleserlich", "Unleserlich")
+    )
+
+
+def replace_unleserlich_text_nodes(element: ET._Element):
+    if is_unleserlich(element.tail):
+        element.tail = ""
+        element.addnext(teiMaker.gap(reason="illegible"))
+    if is_unleserlich(element.text):
         gap = teiMaker.gap(reason="illegible")
-        parent = text_node.getparent()
-        if text_node.is_text:
-            if len(parent) == 0 and parent.xpath("local-name()") == "hi":
-                parent.addnext(gap)
-                parent.getparent().remove(parent)
-            else:
-                gap.tail = ""
-                parent.text = ""
-                parent.insert(0, gap)
-        else:
-            parent.tail = ""
-            parent.addnext(gap)
+        if len(element) == 0 and ET.QName(element).localname == "hi":
+            element.addnext(gap)
+            element.getparent().remove(element)
+            return True
+        gap.tail = ""
+        element.text = ""
+        element.insert(0, gap)
+    return False
+
+
+main_divs_xpath = register_xpath("main_divs", '//tei:div[@type="main"]')
+
+
+def replace_unleserlichs(doc):
+    rewriter = TreeRewriter()
+    rewriter.register("*", replace_unleserlich_text_nodes)
+    for main_div in main_divs_xpath(doc.tree):
+        # # the tail of the main div itself is not inside of it
+        main_div_tail, main_div.tail = main_div.tail, None
+        rewriter.rewrite(main_div)
+        main_div.tail = main_div_tail
+
+
+def rename_hi(hi_element: ET._Element):
+    #     span.attrib["rend"] = ""
+    hi_element.attrib.clear()
+    hi_element.tag = f"{{{nsmap['tei']}}}emph"
 
 
-def replace_hi(doc: TeiReader):
-    for hi_element in doc.any_xpath("//tei:hi"):
-        #     span.attrib["rend"] = ""
-        hi_element.attrib.clear()
-        hi_element.tag = f"{{{nsmap['tei']}}}emph"
+def replace_hi(rewriter: TreeRewriter):
+    rewriter.register(f"{{{nsmap['tei']}}}hi", rename_hi)
 
 
 lb_encoders = ["-", "¬"]
+wordbreak_pattern = re.compile(r"[\¬\-](\s*)$")
+not_sign_pattern = re.compile(r"\¬")
+
+
+def get_lb_parents(doc: TeiReader):
+    """the elements with lb children, in document order"""
+    return list(dict.fromkeys(lb.getparent() for lb in doc.tree.iter(lb_tag)))
+
+
+def type_lb_element(lb: ET._Element, prev_element, parent_element: ET._Element):
+    lb_tail = lb.tail
+    test_tail: str = lb_tail.strip() if lb_tail else ""
+    prev_text_node = (
+        prev_element.tail if prev_element is not None else parent_element.text
+    )
+    if prev_text_node is None:
+        # # fails for an lb without any text before it, like it always did
+        prev_element.tail = prev_text_node = ""
+    prev_text: str = prev_text_node.rstrip()
+    previous_text_node_implies_wordbreak = (
+        bool(prev_text)
+        and prev_text[-1] in lb_encoders
+        and (not prev_text[-2].isnumeric() if len(prev_text) > 1 else True)
+    )
+    lb_sibling_text_node_implies_no_wordbreak = test_tail.startswith(("und", "oder"))
+    if (
+        previous_text_node_implies_wordbreak
+        and not lb_sibling_text_node_implies_no_wordbreak
+    ):
+        # seems to break in word
+        new_text_node = wordbreak_pattern.sub("\n", prev_text_node)
+        lb.set("break", "no")
+    elif lb_sibling_text_node_implies_no_wordbreak:
+        new_text_node = not_sign_pattern.sub("-", prev_text_node)
+        lb.set("break", "yes")
+    else:
+        lb.set("break", "yes")
+        return
+    if prev_element is not None:
+        prev_element.tail = new_text_node
+    else:
+        parent_element.text = new_text_node
 
 
 def type_lb_elements(doc: TeiReader):
-    lb_elements = doc.any_xpath("//tei:lb")
-    for lb in lb_elements:
-        prev_element = lb.getprevious()
-        parent_element = lb.getparent()
-        test_tail: str = lb.tail.strip() if lb.tail else ""
-        try:
-            prev_text: str = (
-                prev_element.tail.rstrip()
-                if prev_element is not None
-                else parent_element.text.rstrip()
-            )
-        except AttributeError:
-            prev_text = ""
-            prev_element.tail = prev_text
-        previous_text_node_implies_wordbreak = (
-            bool(prev_text)
-            and prev_text[-1] in lb_encoders
-            and (not prev_text[-2].isnumeric() if len(prev_text) > 1 else True)
-        )
-        lb_sibling_text_node_implies_no_wordbreak = bool(test_tail) and (
-            test_tail.startswith("und") or test_tail.startswith("oder")
-        )
-        if (
-            previous_text_node_implies_wordbreak
-            and not lb_sibling_text_node_implies_no_wordbreak
-        ):
-            # seems to break in word
-            pattern = r"[\¬\-](\s*)$"
-            if prev_element is not None:
-                textnode = prev_element.tail
-                new_textnode = re.sub(pattern, "\n", textnode)
-                prev_element.tail = new_textnode
-            else:
-                textnode = parent_element.text
-                parent_element.text = re.sub(pattern, "\n", textnode)
-            lb.attrib["break"] = "no"
-        elif lb_sibling_text_node_implies_no_wordbreak:
-            pattern = r"\¬"
-            if prev_element is not None:
-                prev_element.tail = re.sub(pattern, "-", prev_element.tail)
-            else:
-                parent_element.text = re.sub(pattern, "-", parent_element.text)
-            lb.attrib["break"] = "yes"
+    """
+    sets break on every lb, walking the children of each parent once and
+    handing the previous sibling (or none) to type_lb_element
+    """
+    for parent_element in get_lb_parents(doc):
+        prev_element = None
+        for child in parent_element:
+            if child.tag == lb_tag:
+                type_lb_element(child, prev_element, parent_element)
+            prev_element = child
+
+
+def rstrip_segments(segments: list):
+    """rstrip of the joined segments, without joining them"""
+    while segments:
+        last_segment = segments[-1].rstrip()
+        if last_segment:
+            segments[-1] = last_segment
+            return
+        segments.pop()
+
+
+def remove_lb_elements_of(parent_element: ET._Element):
+    """
+    removes the lb children of parent_element, each one joins the text node
+    before it (if there is one) with its tail, " " between words for
+    break="yes"; the pieces of every text node are joined once at the end
+    """
+    # # sibling holding the current text node as tail, None for parent_element.text
+    text_holder = None
+    # # pieces of the current text node, None while there is no text node
+    segments = None if parent_element.text is None else [parent_element.text]
+    changed = False
+
+    def store_text():
+        if not changed:
+            return
+        joined_text = None if segments is None else "".join(segments)
+        if text_holder is None:
+            parent_element.text = joined_text
         else:
-            lb.attrib["break"] = "yes"
+            text_holder.tail = joined_text
+
+    for child in list(parent_element):
+        if child.tag != lb_tag:
+            store_text()
+            text_holder = child
+            segments = None if child.tail is None else [child.tail]
+            changed = False
+            continue
+        lb_tail = child.tail
+        if segments is not None:
+            rstrip_segments(segments)
+            if child.attrib["break"] == "yes":
+                # between words
+                segments.append(" ")
+            segments.append((lb_tail or "").lstrip())
+        elif lb_tail is not None:
+            # # no text node before the lb, its tail takes that place
+            segments = [lb_tail]
+        changed = True
+        parent_element.remove(child)
+    store_text()
 
 
 def remove_all_lb_elements(doc: TeiReader):
-    lb_elements = doc.any_xpath("//tei:lb")
-    for lb in lb_elements:
-        prev_textnode_result = lb.xpath(
-            "./preceding-sibling::node()[1][boolean(self::text())]"
-        )
-        prev_textnode = prev_textnode_result[0] if prev_textnode_result else None
-        lb_parent = lb.getparent()
-        if prev_textnode is not None:
-            spacer = ""
-            if lb.tail is None:
-                lb.tail = ""
-            if lb.attrib["break"] == "yes":
-                # between words
-                spacer = " "
-            new_prev_textnode = prev_textnode.rstrip() + spacer + lb.tail.lstrip()
-            parent = prev_textnode.getparent()
-            if prev_textnode.is_tail:
-                parent.tail = new_prev_textnode
-            else:
-                parent.text = new_prev_textnode
-            lb.tail = ""
-        else:
-            prev = lb.getprevious()
-            if prev is not None:
-                prev.tail = lb.tail
-            else:
-                lb_parent.text = lb.tail
-        lb_parent.remove(lb)
+    for parent_element in get_lb_parents(doc):
+        remove_lb_elements_of(parent_element)
+
+
+removeable_pb_xpath = register_xpath(
+    "removeable_pb", "//tei:pb[1][following-sibling::*[1][local-name()='pb']]"
+)
+first_surface_xpath = register_xpath("first_surface", "//tei:surface[1]")
 
 
 def remove_calibration_page(doc: TeiReader):
-    removeable_pb_xpath = "//tei:pb[1][following-sibling::*[1][local-name()='pb']]"
-    removeable_first_pb = doc.any_xpath(removeable_pb_xpath)
+    removeable_first_pb = removeable_pb_xpath(doc.tree)
     if removeable_first_pb:
         calibration_pb = removeable_first_pb[0]
         if calibration_pb.tail is None or not calibration_pb.tail.strip():
             calibration_pb.getparent().remove(calibration_pb)
-            first_surface = doc.any_xpath("//tei:surface[1]")[0]
+            first_surface = first_surface_xpath(doc.tree)[0]
             first_surface.getparent().remove(first_surface)
 
 
-def remove_empty_paras(doc):
-    for empty_p in doc.any_xpath("//tei:p[not(*) and normalize-space()='']"):
-        if empty_p.tail is None or not empty_p.tail.strip():
-            empty_p.getparent().remove(empty_p)
+def string_value(node):
+    if isinstance(node.tag, str):
+        return "".join(node.itertext())
+    return node.text or ""
 
 
-def remove_lbs_as_first_child_of_p_without_text(doc):
-    for parent in doc.any_xpath(
-        "//tei:*[(local-name()='p' or local-name()='ab') and ./node()[1][normalize-space(.)=''] and ./*[1][local-name()='lb']]"
-    ):
+def remove_empty_para(p: ET._Element):
+    if any(isinstance(child.tag, str) for child in p):
+        return False
+    if string_value(p).strip(xml_whitespace):
+        return False
+    if p.tail is None or not p.tail.strip():
+        p.getparent().remove(p)
+        return True
+    return False
+
+
+def remove_empty_paras(rewriter: TreeRewriter):
+    rewriter.register(f"{{{nsmap['tei']}}}p", remove_empty_para)
+
+
+def remove_first_lb_without_text(parent: ET._Element):
+    first_element = next((child for child in parent if isinstance(child.tag, str)), None)
+    if first_element is None or ET.QName(first_element).localname != "lb":
+        return
+    first_text = parent.text if parent.text is not None else string_value(parent[0])
+    if not first_text.strip(xml_whitespace):
         parent.text = parent[0].tail
         parent.remove(parent[0])
 
 
+def remove_lbs_as_first_child_of_p_without_text(rewriter: TreeRewriter):
+    for local_name in ("p", "ab"):
+        rewriter.register(f"{{{nsmap['tei']}}}{local_name}", remove_first_lb_without_text)
+
+
+paras_with_only_list_xpath = register_xpath(
+    "paras_with_only_list",
+    "//tei:body//tei:p[count(node()[not(boolean(self::text() and normalize-space(.)='')or local-name()='list')])=0]",
+)
+
+
 def remove_paras_with_only_list(doc):
-    for p in doc.any_xpath(
-        "//tei:body//tei:p[count(node()[not(boolean(self::text() and normalize-space(.)='')or local-name()='list')])=0]"
-    ):
+    for p in paras_with_only_list_xpath(doc.tree):
         for child in p:
             p.addprevious(child)
         p.getparent().remove(p)
 
 
-def remove_useless_elements(doc: TeiReader):
+def remove_useless_elements(doc: TeiReader, rewriter: TreeRewriter, lb_rewriter: TreeRewriter):
+    # # the calibration page goes right away, before any empty para is looked for
     remove_calibration_page(doc)
-    remove_empty_paras(doc)
+    remove_empty_paras(rewriter)
     # remove_paras_with_only_list(doc)
-    remove_lbs_as_first_child_of_p_without_text(doc)
+    # # a walk visits a p before the empty p inside of it, its leading lb is
+    # # only looked at in the next walk, once every empty p is gone
+    remove_lbs_as_first_child_of_p_without_text(lb_rewriter)
+
+
+root_element_xpath = register_xpath("root_element", "/*")
+
 
-def get_graphic_elements(doc: TeiReader):
-    if doc.any_xpath(".//tei:graphic[contains(@url, '/')]"):
-        for graph_el in doc.any_xpath(".//tei:graphic[not(contains(@url, '/'))]"):
+def get_root_element(doc: TeiReader):
+    return root_element_xpath(doc.tree)[0]
+
+
+def get_graphic_elements(rewriter: TreeRewriter, graphic_elements: list):
+    """graphic elements are collected into graphic_elements during the rewrite"""
+    rewriter.register(f"{{{nsmap['tei']}}}graphic", graphic_elements.append)
+
+
+def remove_transkribus_graphics(graphic_elements: list):
+    """drops the graphics with a bare file name if there are ones with an url"""
+    url_graphics = [
+        graph_el for graph_el in graphic_elements if "/" in graph_el.get("url", "")
+    ]
+    if not url_graphics:
+        return graphic_elements
+    for graph_el in graphic_elements:
+        if "/" not in graph_el.get("url", ""):
             graph_el.getparent().remove(graph_el)
-    return doc.any_xpath(".//tei:graphic")
+    return url_graphics
+
+
+def remove_zones(element: ET._Element):
+    for child in list(element):
+        if child.tag == f"{{{nsmap['tei']}}}zone":
+            element.remove(child)
+        elif len(child):
+            remove_zones(child)
+
+
+def remove_facsimile_zones(surface: ET._Element):
+    parent_element = surface.getparent()
+    if parent_element is not None and parent_element.tag == f"{{{nsmap['tei']}}}facsimile":
+        remove_zones(surface)
+
+
+facsimile_xpath = register_xpath("facsimile", ".//tei:facsimile")
 
 
 def get_faksimile_element(doc: TeiReader, bv_doc_id: str):
-    graphic_elements = get_graphic_elements(doc)
+    graphic_elements = []
+    rewriter = TreeRewriter()
+    get_graphic_elements(rewriter, graphic_elements)
+    rewriter.register(f"{{{nsmap['tei']}}}surface", remove_facsimile_zones)
+    rewriter.rewrite(get_root_element(doc))
+    graphic_elements = remove_transkribus_graphics(graphic_elements)
     replace_transkribus_images_with_goobi(graphic_elements, bv_doc_id)
     # for graphic_element in graphic_elements:
     #    graphic_element.attrib["url"] = get_goobi_image_url(graphic_element, bv_doc_id)
-    for zone_element in doc.any_xpath(".//tei:facsimile/tei:surface//tei:zone"):
-        zone_element.getparent().remove(zone_element)
-    faksimile_element = doc.any_xpath(".//tei:facsimile")[0]
-    return ET.tostring(faksimile_element).decode("utf-8")
+    return facsimile_xpath(doc.tree)[0]
+
+
+first_body_div_xpath = register_xpath("first_body_div", "//tei:body/tei:div[1]")
 
 
 def create_main_div(doc: TeiReader):
-    parent_div = doc.any_xpath("//tei:body/tei:div[1]")[0]
+    parent_div = first_body_div_xpath(doc.tree)[0]
     parent_div.attrib["type"] = "main"
 
 
-def add_break_attrib_to_pbs(doc):
-    for pb in doc.any_xpath("//tei:pb[not(@break)]"):
+def add_break_attrib(pb: ET._Element):
+    if "break" not in pb.attrib:
         pb.attrib["break"] = "yes"
 
 
+def add_break_attrib_to_pbs(rewriter: TreeRewriter):
+    rewriter.register(f"{{{nsmap['tei']}}}pb", add_break_attrib)
+
+
+def clean_up_elements(doc: TeiReader):
+    """
+    runs the cleanups that only look at one element at a time in two walks
+    over the document, in the order they used to run one after another: the
+    empty paras are removed in the first, the leading lbs in the second
+    """
+    rewriter = TreeRewriter()
+    lb_rewriter = TreeRewriter()
+    substitute_useless_elements(rewriter, substitution_dict={"ab": "p"})
+    remove_useless_atributes(rewriter)
+    remove_useless_elements(doc, rewriter, lb_rewriter)
+    add_break_attrib_to_pbs(lb_rewriter)
+    # # renaming hi does not change what type_lb_elements sees, so it runs here, too
+    replace_hi(lb_rewriter)
+    root_element = get_root_element(doc)
+    rewriter.rewrite(root_element)
+    lb_rewriter.rewrite(root_element)
+
+
+def run_stage(stage_name, stage_func, *args, **kwargs):
+    """
+    runs one step of create_new_xml_data, a STAGE_HOOK set by a benchmark or
+    profiler gets called instead, with the same arguments
+    """
+    if STAGE_HOOK is None:
+        return stage_func(*args, **kwargs)
+    return STAGE_HOOK(stage_name, stage_func, *args, **kwargs)
+
+
+def make_jur_sections(article_divs, rule_set):
+    for article_div in article_divs:
+        make_jur_sections_in_article(article_div, rule_set)
+
+
+def graft_element(placeholder: ET._Element, element: ET._Element):
+    """
+    moves attributes, text and children of element into the placeholder of
+    the rendered template, the tail of element goes in front of the tail the
+    template has after the placeholder
+    """
+    placeholder.attrib.update(element.attrib)
+    placeholder.text = element.text
+    for child in list(element):
+        placeholder.append(child)
+    placeholder.tail = (element.tail or "") + (placeholder.tail or "")
+
+
+def drop_empty_text_nodes(element: ET._Element):
+    """
+    an element holding an empty text node is written as <x></x> instead of
+    <x/>, serializing and parsing the document again used to drop them
+    """
+    for descendant in element.iter():
+        if descendant.text == "" and len(descendant) == 0:
+            descendant.text = None
+
+
+template_facsimile_xpath = register_xpath("template_facsimile", "./tei:facsimile")
+template_body_xpath = register_xpath("template_body", "./tei:text/tei:body")
+
+
+def graft_body_and_faksimile(doc: TeiReader, body_node, faksimile_element):
+    for placeholder, element in (
+        (template_facsimile_xpath(doc.tree)[0], faksimile_element),
+        (template_body_xpath(doc.tree)[0], body_node),
+    ):
+        graft_element(placeholder, element)
+        drop_empty_text_nodes(placeholder)
+
+
+def release_tree(doc: TeiReader):
+    """frees the nodes of doc, whoever still holds the TeiReader"""
+    get_root_element(doc).clear()
+
+
+def trim_memory():
+    """
+    collects the cycles python keeps and returns freed heap memory to the
+    system, glibc keeps it for the process otherwise
+    """
+    global libc_malloc_trim
+    gc.collect()
+    if libc_malloc_trim is None:
+        try:
+            libc_malloc_trim = ctypes.CDLL("libc.so.6").malloc_trim
+        except (OSError, AttributeError):
+            libc_malloc_trim = False
+    if libc_malloc_trim:
+        libc_malloc_trim(0)
+
+
+libc_malloc_trim = None
+# # bytes write_xml_doc wrote per edition, 0 if the file was unchanged
+edition_bytes_written = {}
+
+
+revision_changes_xpath = register_xpath("revision_changes", ".//tei:revisionDesc/tei:change")
+
+
+def read_file(file_path):
+    with open(file_path, "rb") as infile:
+        return infile.read()
+
+
+def keep_change_date(tree, header, content, tei_file_path):
+    """
+    the bytes of the edition with the change date of the edition it replaces
+    (header), if they are then the bytes on disk; an edition whose content did
+    not change keeps its date and its file, content holds the bytes with the
+    new date
+    """
+    changes = revision_changes_xpath(tree)
+    old_changes = revision_changes_xpath(header)
+    if len(changes) != 1 or len(old_changes) != 1:
+        return content
+    change, old_date = changes[0], old_changes[0].get("when")
+    new_date = change.get("when")
+    if old_date is None or old_date == new_date:
+        return content
+    change.set("when", old_date)
+    dated_content = ET.tostring(tree, xml_declaration=True, encoding="UTF-8")
+    if os.path.getsize(tei_file_path) == len(dated_content) and dated_content == read_file(
+        tei_file_path
+    ):
+        return dated_content
+    change.set("when", new_date)
+    return content
+
+
+def write_xml_doc(doc: TeiReader, tei_file_path):
+    old_header = read_existing_header(tei_file_path)
+    keep_series_stmt(doc.tree, old_header)
+    # # the bytes tree_to_file writes, only if they differ from the file on disk
+    content = ET.tostring(doc.tree, xml_declaration=True, encoding="UTF-8")
+    if old_header is not None:
+        content = keep_change_date(doc.tree, old_header, content, tei_file_path)
+    bytes_written = write_if_changed(tei_file_path, content)
+    print("writing" if bytes_written else "unchanged", tei_file_path)
+    edition_bytes_written[tei_file_path] = bytes_written
+
+
 def create_new_xml_data(
     doc: TeiReader,
     doc_metadata: dict,
+    change_date=None,
 ):
     # # get body & filename
     bv_doc_id = doc_metadata["bv_id"]
     print(f"processing {bv_doc_id}")
-    body_node = doc.any_xpath(".//tei:body")[0]
-    article_divs = make_article_divs(doc)
-    substitute_useless_elements(doc=doc, substitution_dict={"ab": "p"})
-    remove_useless_atributes(doc)
-    remove_useless_elements(doc)
-    add_break_attrib_to_pbs(doc)
-    create_main_div(doc)
-    type_lb_elements(doc)
-    replace_hi(doc)
-    replace_unleserlichs(doc)
-    place_the_goddam_pb_inside_of_last_p_sibling_element_if_there_is_one(doc)
-    for article_div in article_divs:
-        make_jur_sections_in_article(article_div)
-    remove_all_lb_elements(doc)
-    body_string = ET.tostring(body_node).decode("utf-8")
-    body_string = body_string.replace('xmlns="http://www.tei-c.org/ns/1.0"', "")
+    body_node = body_xpath(doc.tree)[0]
+    article_divs = run_stage("make_article_divs", make_article_divs, doc, RULE_SET)
+    run_stage("clean_up_elements", clean_up_elements, doc)
+    run_stage("create_main_div", create_main_div, doc)
+    run_stage("type_lb_elements", type_lb_elements, doc)
+    run_stage("replace_unleserlichs", replace_unleserlichs, doc)
+    run_stage(
+        "place_the_goddam_pb_inside_of_last_p_sibling_element_if_there_is_one",
+        place_the_goddam_pb_inside_of_last_p_sibling_element_if_there_is_one,
+        doc,
+    )
+    run_stage("make_jur_sections", make_jur_sections, article_divs, RULE_SET)
+    run_stage("remove_all_lb_elements", remove_all_lb_elements, doc)
     # # get faksimile
-    faksimile = get_faksimile_element(doc, bv_doc_id=bv_doc_id)
-    # # get metadata
+    faksimile_element = run_stage(
+        "get_faksimile_element", get_faksimile_element, doc, bv_doc_id=bv_doc_id
+    )
+    # # get metadata, the template is rendered with empty facsimile and body
+    # # which get the refined elements grafted in after parsing
     context = {
         "project_md": PROJECT_MD,
         "doc_metadata": doc_metadata,
-        "body": body_string,
-        "faksimile": faksimile,
-        "current_date": datetime.date.today().strftime("%Y-%m-%d"),
+        "body": BODY_PLACEHOLDER,
+        "faksimile": FAKSIMILE_PLACEHOLDER,
+        # # the date of the source keeps the output of unchanged documents stable
+        "current_date": change_date or datetime.date.today().strftime("%Y-%m-%d"),
     }
-    xml_data = template.render(context)
-    doc = get_xml_doc(xml_data)
-    if doc is not None:
+    xml_data = run_stage("render_template", template.render, context)
+    new_doc = run_stage("parse_rendered_template", get_xml_doc, xml_data)
+    if LOW_MEMORY:
+        del xml_data, context
+    if new_doc is not None:
+        run_stage(
+            "graft_body_and_faksimile",
+            graft_body_and_faksimile,
+            new_doc,
+            body_node,
+            faksimile_element,
+        )
+        if LOW_MEMORY:
+            # # body and facsimile moved to new_doc, the rest of the source is not needed
+            release_tree(doc)
+            del body_node, faksimile_element, article_divs
         tei_file_path = os.path.join(TEI_DIR, bv_doc_id + ".xml")
-        print("writing", tei_file_path)
-        doc.tree_to_file(tei_file_path)
+        run_stage("write_xml_doc", write_xml_doc, new_doc, tei_file_path)
+        if LOW_MEMORY:
+            release_tree(new_doc)
+        return tei_file_path
+    return None
 
 
 def return_transkribus_doc_id(xml_file_path):
@@ -660,183 +1004,387 @@ def return_transkribus_doc_id(xml_file_path):
 
 def return_mets_doc(transkribus_doc_id: str, transkribus_collection_id: str):
     mets_file_str = f"./mets/{transkribus_collection_id}/{transkribus_doc_id}_mets.xml"
-    return get_xml_doc(mets_file_str)
-
-
-def return_col_id_from_mets_doc(doc: TeiReader):
-    try:
-        return doc.tree.xpath(".//trpDocMetadata/docId/text()")[0]
-    except IndexError:
-        return ""
-
+    # # stored compressed by fetch_mets, libxml2 decompresses while parsing
+    return get_xml_doc(find_artifact(mets_file_str) or mets_file_str)
 
-def fetch_metadata_dump(url, local_filepath):
-    import requests
-
-    print(f"downloading from {url}")
-    results = requests.get(url)
-    json_result = results.json()
-    with open(local_filepath, "w") as outfile:
-        json.dump(json_result, outfile)
-    return json_result
-
-
-class BaseRowTypeResolver:
-    def __init__(self):
-        self.doc_types_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/type_of_document.json"
-        self.manifestation_types_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/type_of_manifestation.json"
-        self.bv_data_sets_url = "https://raw.githubusercontent.com/bundesverfassung-oesterreich/bv-entities/main/json_dumps/data_set.json"
-        self.doc_types_path = project_doc_types_dump
-        self.manifestation_types_path = project_manifestation_types_dump
-        self.data_sets_path = project_data_sets_dump
-        self.doc_types_by_row = fetch_metadata_dump(
-            url=self.doc_types_url, local_filepath=self.doc_types_path
-        )
-        self.manifestation_types_by_row = fetch_metadata_dump(
-            url=self.manifestation_types_url,
-            local_filepath=self.manifestation_types_path,
-        )
-        self.bv_data_sets_by_row = fetch_metadata_dump(
-            url=self.bv_data_sets_url, local_filepath=self.data_sets_path
-        )
-        self.doctype_by_id = None
-        self.manitype_by_id = None
-        self.datasets_by_id = None
-
-    def get_doctype_from_id(self, d_id: str):
-        if self.doctype_by_id is None:
-            self.doctype_by_id = dict(
-                [
-                    (item["bv_id"], item)
-                    for rownmbr, item in self.doc_types_by_row.items()
-                ]
-            )
-        return self.doctype_by_id[d_id]
-
-    def get_manifestationtype_from_id(self, m_id: str):
-        if self.manitype_by_id is None:
-            self.manitype_by_id = dict(
-                [
-                    (item["bv_id"], item)
-                    for rownmbr, item in self.manifestation_types_by_row.items()
-                ]
-            )
-        return self.manitype_by_id[m_id]
-
-    def get_dataset_from_id(self, d_id: str):
-        if self.datasets_by_id is None:
-            self.datasets_by_id = dict(
-                [
-                    (item["bv_id"], item)
-                    for rownmbr, item in self.manifestation_types_by_row.items()
-                ]
-            )
-        return self.datasets_by_id[d_id]
 
-    def get_dataset_from_row(self, row_number: str):
-        return self.bv_data_sets_by_row[row_number]
+mets_doc_id_xpath = register_xpath("mets_doc_id", ".//trpDocMetadata/docId/text()")
+transcript_dates_xpath = register_xpath(
+    "transcript_dates",
+    ".//*[local-name()='fileGrp'][@ID='PAGEXML']/*[local-name()='file']/@CREATED",
+)
+upload_timestamp_xpath = register_xpath(
+    "upload_timestamp", ".//trpDocMetadata/uploadTimestamp/text()"
+)
 
-    def get_manifestationtype_from_row(self, row_number: str):
-        return self.manifestation_types_by_row[row_number]
 
-    def get_doctype_from_row(self, row_number: str):
-        return self.doc_types_by_row[row_number]
+def get_last_change_date(mets_doc: TeiReader):
+    """
+    the day the newest transcript of the document was saved (or the document
+    uploaded, if it has none), None if the METS has neither
+    """
+    transcript_dates = [
+        datetime.datetime.fromisoformat(created) for created in transcript_dates_xpath(mets_doc.tree)
+    ]
+    if transcript_dates:
+        return max(transcript_dates).strftime("%Y-%m-%d")
+    upload_timestamps = upload_timestamp_xpath(mets_doc.tree)
+    if upload_timestamps:
+        return datetime.datetime.fromtimestamp(
+            int(upload_timestamps[0]) / 1000, datetime.timezone.utc
+        ).strftime("%Y-%m-%d")
+    return None
 
 
-baserow_type_resolver = BaseRowTypeResolver()
+def return_col_id_from_mets_doc(doc: TeiReader):
+    try:
+        return mets_doc_id_xpath(doc.tree)[0]
+    except IndexError:
+        return ""
 
 
 def load_metadata_from_dump():
-    json_data = None
-    if not os.path.exists(doc_local_baserow_dump):
-        _ = fetch_metadata_dump(
-            url=doc_base_row_dump_url, local_filepath=doc_local_baserow_dump
-        )
-        json_data = fetch_metadata_dump(
-            url=doc_base_row_dump_url, local_filepath=doc_local_baserow_dump
-        )
-    else:
-        with open(doc_local_baserow_dump, "r") as infile:
-            json_data = json.load(infile)
-    meta_data_objs_by_transkribus_id = {}
-    for row in json_data.values():
-        mets_dict = row
-        transkribus_col_id = mets_dict["transkribus_col_id"]
-        transkribus_doc_id = mets_dict["transkribus_doc_id"]
-        if transkribus_col_id and transkribus_col_id.strip():
-            if transkribus_col_id not in meta_data_objs_by_transkribus_id:
-                meta_data_objs_by_transkribus_id[transkribus_col_id] = {}
-            meta_data_objs_by_transkribus_id[transkribus_col_id][
-                transkribus_doc_id
-            ] = mets_dict
-    return meta_data_objs_by_transkribus_id
+    """document rows by transkribus collection and document id"""
+    return metadata_store.get_documents_by_transkribus_id()
 
 
 def resolve_types(doc_metadata):
     manifestation_types = []
     for entry in doc_metadata["type_of_manifestation"]:
         manifestation_types.append(
-            baserow_type_resolver.get_manifestationtype_from_row(str(entry["id"]))[
+            metadata_store.get_manifestation_type_row(str(entry["id"]))[
                 "name"
             ]
         )
     doc_types = []
     for entry in doc_metadata["type_of_document"]:
         doc_types.append(
-            baserow_type_resolver.get_doctype_from_row(str(entry["id"]))["name"]
+            metadata_store.get_doc_type_row(str(entry["id"]))["name"]
         )
     doc_metadata["type_of_document"] = " ".join(doc_types)
     doc_metadata["type_of_manifestation"] = " ".join(manifestation_types)
     return doc_metadata
 
 
-def process_all_files():
+def refine_file(xml_file_path, transkribus_collection_id, collection_metadata):
+    # # parsing doc to mem
+    doc = get_xml_doc(xml_file_path)
+    if doc is not None:
+        # # important stuff happens here
+        # # organize data yet missing in the final doc
+        transkribus_doc_id = return_transkribus_doc_id(xml_file_path)
+        if transkribus_doc_id not in collection_metadata:
+            print(f"No metadata found for transkribus-doc-id '{transkribus_doc_id}'.")
+        else:
+            # # the row is shared with the metadata store, resolve a copy
+            doc_metadata = resolve_types(dict(collection_metadata[transkribus_doc_id]))
+            print(f"loading {transkribus_doc_id}")
+            mets_doc = return_mets_doc(transkribus_doc_id, transkribus_collection_id)
+            if mets_doc is not None:
+                change_date = get_last_change_date(mets_doc)
+                if LOW_MEMORY:
+                    # # not needed any more
+                    del mets_doc
+                # image_urls = return_image_urls(mets_doc)
+                # # change the doc / write data to it
+                return create_new_xml_data(doc, doc_metadata, change_date)
+    return None
+
+
+def collect_source_files(metadata):
+    jobs = []
+    for transkribus_collection_id in metadata:
+        # # load sourcefiles from fetch / transform job, compressed ones are
+        # # parsed as they are; a file stored both ways is taken once
+        source_files = dict.fromkeys(
+            find_artifact(xml_file_path)
+            for pattern in ("*_tei.xml", "*_tei.xml.gz")
+            for xml_file_path in glob.glob(f"{TMP_DIR}/{transkribus_collection_id}/{pattern}")
+        )
+        for xml_file_path in source_files:
+            jobs.append((xml_file_path, transkribus_collection_id))
+    return jobs
+
+
+def init_worker(project_md, low_memory=False, image_names=None):
+    global PROJECT_MD, LOW_MEMORY
+    PROJECT_MD = project_md
+    LOW_MEMORY = low_memory
+    if export_report.is_enabled():
+        # # a worker that is not forked sends its requests through an unpatched session
+        export_report.install_worker_http_counter()
+    if image_names:
+        # # a worker that is not forked starts without the prefetched goobi lists
+        import_prefetched_img_names(image_names)
+
+
+def create_worker_pool(workers, mp_context=None):
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(PROJECT_MD, LOW_MEMORY, export_prefetched_img_names()),
+    )
+
+
+def refine_file_with_metrics(xml_file_path, transkribus_collection_id, collection_metadata):
+    """
+    runs refine_file, with an export report enabled its stages are measured,
+    returns the written file and the metrics of the document
+    """
+    global STAGE_HOOK
+    if not export_report.is_enabled():
+        tei_file_path = refine_file(xml_file_path, transkribus_collection_id, collection_metadata)
+        if LOW_MEMORY:
+            trim_memory()
+        return tei_file_path, None
+    with export_report.measure_document(os.path.normpath(xml_file_path)) as doc_metrics:
+        STAGE_HOOK = export_report.make_stage_hook(doc_metrics)
+        try:
+            tei_file_path = refine_file(
+                xml_file_path, transkribus_collection_id, collection_metadata
+            )
+            if LOW_MEMORY:
+                trim_memory()
+        finally:
+            STAGE_HOOK = None
+        doc_metrics["bytes_written"] = edition_bytes_written.pop(tei_file_path, 0)
+    return tei_file_path, doc_metrics
+
+
+def get_doc_metadata(metadata, xml_file_path, transkribus_collection_id):
+    """the metadata row of the document of xml_file_path, None if there is none"""
+    return metadata.get(transkribus_collection_id, {}).get(
+        return_transkribus_doc_id(xml_file_path)
+    )
+
+
+def refine_document(xml_file_path, transkribus_collection_id, doc_metadata):
+    """
+    runs refine_file_with_metrics with the metadata of this document only,
+    the same in the parent and in a pool process
+    """
+    collection_metadata = {}
+    if doc_metadata is not None:
+        collection_metadata[return_transkribus_doc_id(xml_file_path)] = doc_metadata
+    return refine_file_with_metrics(xml_file_path, transkribus_collection_id, collection_metadata)
+
+
+def refine_file_in_worker(xml_file_path, transkribus_collection_id, doc_metadata):
+    """
+    runs refine_file in a pool process, returns the written file, the
+    malformed_xml_docs entries of this file so the parent can write one log
+    for all workers, the document metrics, the xpath profile and the http
+    requests of the worker since its last file
+    """
+    malformed_xml_docs.clear()
+    tei_file_path, doc_metrics = refine_document(
+        xml_file_path, transkribus_collection_id, doc_metadata
+    )
+    return (
+        tei_file_path,
+        [
+            {"file_name": entry["file_name"], "error": str(entry["error"])}
+            for entry in malformed_xml_docs
+        ],
+        doc_metrics,
+        take_profile(),
+        export_report.take_http_requests(),
+    )
+
+
+def process_files_in_pool(metadata, jobs, workers, documents):
+    written_files = {}
+    # # largest documents first, so no worker is left with a big one at the end
+    scheduled_jobs = sorted(
+        jobs, key=lambda job: os.path.getsize(job[0]), reverse=True
+    )
+    with create_worker_pool(workers) as executor:
+        futures = {}
+        for xml_file_path, transkribus_collection_id in scheduled_jobs:
+            futures[xml_file_path] = executor.submit(
+                refine_file_in_worker,
+                xml_file_path,
+                transkribus_collection_id,
+                get_doc_metadata(metadata, xml_file_path, transkribus_collection_id),
+            )
+        # # collect in serial order, so the log looks like the one of a serial run
+        for xml_file_path, _ in jobs:
+            tei_file_path, malformed_entries, doc_metrics, xpath_profile, http_requests = futures[
+                xml_file_path
+            ].result()
+            written_files[xml_file_path] = tei_file_path
+            malformed_xml_docs.extend(malformed_entries)
+            merge_profile(xpath_profile)
+            export_report.add_http_requests(http_requests)
+            if doc_metrics is not None:
+                documents.append(doc_metrics)
+    return written_files
+
+
+def get_type_rows(doc_metadata):
+    return {
+        "type_of_manifestation": [
+            metadata_store.get_manifestation_type_row(str(entry["id"]))
+            for entry in doc_metadata["type_of_manifestation"]
+        ],
+        "type_of_document": [
+            metadata_store.get_doc_type_row(str(entry["id"]))
+            for entry in doc_metadata["type_of_document"]
+        ],
+    }
+
+
+def get_hashed_img_names(bv_doc_id):
+    """the goobi image list the facsimile urls are built from, the error if it failed"""
+    try:
+        return get_img_names_from_goobi_mets(bv_doc_id)
+    except Exception as exception:
+        return str(exception)
+
+
+def compute_input_hash(xml_file_path, doc_metadata):
+    """
+    hash over everything the edition of a document is built from,
+    doc_metadata has to be the unresolved baserow row
+    """
+    return hash_inputs(
+        hash_file(xml_file_path),
+        doc_metadata,
+        get_type_rows(doc_metadata),
+        get_hashed_img_names(doc_metadata["bv_id"]),
+        PROJECT_MD,
+        hash_file(os.path.join(TEMPLATE_PATH, "tei_template.j2")),
+        hash_code_files(*CODE_FILES),
+    )
+
+
+def needs_refining(
+    xml_file_path, transkribus_collection_id, metadata, old_manifest, new_manifest, input_hashes
+):
+    """
+    false for an up to date edition (its manifest entry is kept), the input
+    hash of an edition to (re)build is noted in input_hashes
+    """
+    transkribus_doc_id = return_transkribus_doc_id(xml_file_path)
+    doc_metadata = metadata[transkribus_collection_id].get(transkribus_doc_id)
+    if doc_metadata is not None:
+        bv_doc_id = doc_metadata["bv_id"]
+        input_hash = compute_input_hash(xml_file_path, doc_metadata)
+        entry = old_manifest.get(bv_doc_id)
+        tei_file_path = os.path.join(TEI_DIR, bv_doc_id + ".xml")
+        if is_up_to_date(entry, input_hash, tei_file_path):
+            new_manifest[bv_doc_id] = entry
+            return False
+        input_hashes[xml_file_path] = (bv_doc_id, input_hash)
+    return True
+
+
+def update_build_manifest(written_files, input_hashes, old_manifest, new_manifest, prune=True):
+    """
+    records the written editions, an edition that failed to build keeps its
+    old entry and file; without prune (not every document got this far) the
+    old entries are kept as they are and no edition is removed
+    """
+    for xml_file_path, (bv_doc_id, input_hash) in input_hashes.items():
+        if written_files.get(xml_file_path) is not None:
+            new_manifest[bv_doc_id] = {
+                "input_hash": input_hash,
+                "source": os.path.normpath(xml_file_path),
+            }
+        else:
+            keep_old_entry(old_manifest, new_manifest, bv_doc_id)
+    claimed = list(new_manifest)
+    if prune:
+        remove_stale_outputs(TEI_DIR, BUILD_MANIFEST_SECTION, old_manifest, new_manifest)
+    else:
+        new_manifest = dict(old_manifest, **new_manifest)
+    save_build_manifest(BUILD_MANIFEST_SECTION, new_manifest, claimed)
+
+
+def process_all_files(workers=1, full_rebuild=False, documents=None):
     # # load metadata from baserow
     metadata = load_metadata_from_dump()
-    for transkribus_collection_id, collection_metadata in metadata.items():
-        # # load sourcefiles from fetch / transform job
-        source_files = glob.glob(f"{TMP_DIR}/{transkribus_collection_id}/*_tei.xml")
-        for xml_file_path in source_files:
-            # # parsing doc to mem
-            doc = get_xml_doc(xml_file_path)
-            if doc is not None:
-                # # important stuff happens here
-                # # organize data yet missing in the final doc
-                transkribus_doc_id = return_transkribus_doc_id(xml_file_path)
-                if transkribus_doc_id not in collection_metadata:
-                    print(
-                        f"No metadata found for transkribus-doc-id '{transkribus_doc_id}'."
-                    )
-                else:
-                    doc_metadata = resolve_types(
-                        collection_metadata[transkribus_doc_id]
-                    )
-                    print(f"loading {transkribus_doc_id}")
-                    mets_doc = return_mets_doc(
-                        transkribus_doc_id, transkribus_collection_id
-                    )
-                    if mets_doc is not None:
-                        # image_urls = return_image_urls(mets_doc)
-                        # # change the doc / write data to it
-                        create_new_xml_data(doc, doc_metadata)
+    old_manifest = {} if full_rebuild else load_build_manifest(BUILD_MANIFEST_SECTION)
+    new_manifest = {}
+    # # only (re)build documents whose inputs changed since the last run
+    jobs = []
+    input_hashes = {}
+    source_files = collect_source_files(metadata)
+    # # resolve the goobi image lists up front, they are hashed into the input
+    # # hash and the (forked) workers read them from memory
+    prefetch_img_names(
+        doc_metadata["bv_id"]
+        for doc_metadata in (
+            get_doc_metadata(metadata, xml_file_path, transkribus_collection_id)
+            for xml_file_path, transkribus_collection_id in source_files
+        )
+        if doc_metadata is not None
+    )
+    for xml_file_path, transkribus_collection_id in source_files:
+        if needs_refining(
+            xml_file_path, transkribus_collection_id, metadata, old_manifest, new_manifest, input_hashes
+        ):
+            jobs.append((xml_file_path, transkribus_collection_id))
+    print(f"{len(input_hashes)} document(s) to refine, {len(new_manifest)} up to date")
+    if documents is None:
+        documents = []
+    if workers > 1:
+        written_files = process_files_in_pool(metadata, jobs, workers, documents)
+    else:
+        written_files = {}
+        for xml_file_path, transkribus_collection_id in jobs:
+            written_files[xml_file_path], doc_metrics = refine_document(
+                xml_file_path,
+                transkribus_collection_id,
+                get_doc_metadata(metadata, xml_file_path, transkribus_collection_id),
+            )
+            if doc_metrics is not None:
+                documents.append(doc_metrics)
+    update_build_manifest(written_files, input_hashes, old_manifest, new_manifest)
+
+
+def update_search_index():
+    """
+    indexes the refined editions that changed, if a search index is written;
+    called once create_sorter_val.py is done with the editions
+    """
+    if search_index.is_enabled():
+        search_index.update_index(
+            os.path.join(TEI_DIR, bv_doc_id + ".xml")
+            for bv_doc_id in load_build_manifest(BUILD_MANIFEST_SECTION)
+        )
 
 
 if __name__ == "__main__":
-    # # the following is needed, cause you never know if this stuff ist there.
-    if os.path.isfile(project_local_baserow_dump):
-        with open(
-            project_local_baserow_dump, "r", encoding="utf-8"
-        ) as json_metadata_file:
-            PROJECT_MD = json.load(json_metadata_file)["1"]
-    else:
-        PROJECT_MD = fetch_metadata_dump(
-            url=project_base_row_dump_url, local_filepath=project_local_baserow_dump
-        )["1"]
-    # # clear directory for new export
-    shutil.rmtree(TEI_DIR, ignore_errors=True)
+    parser = argparse.ArgumentParser(description="refine the TEIs created by page2tei")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="clear editions_source and rebuild every document, ignoring the build manifest",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes refining documents in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="release every tree as soon as it is used and return freed memory after every document",
+    )
+    args = parser.parse_args()
+    PROJECT_MD = metadata_store.get_project_metadata()
+    LOW_MEMORY = LOW_MEMORY or args.low_memory
+    if args.full:
+        # # clear directory for new export
+        shutil.rmtree(TEI_DIR, ignore_errors=True)
     os.makedirs(TEI_DIR, exist_ok=True)
-    # # load / process all unprocessed files
-    process_all_files()
+    # # load / process all changed files
+    with export_report.measure_stage("refine_tei") as documents:
+        process_all_files(workers=args.workers, full_rebuild=args.full, documents=documents)
+    print_profile("refine_tei")
     log_nonvalid_files()
     if file_rename_errors != 0:
         print(
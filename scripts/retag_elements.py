@@ -1,9 +1,15 @@
 from acdh_tei_pyutils.tei import TeiReader
+from xpath_registry import print_profile, register_xpath
+
+lbs_xpath = register_xpath("lbs", "//tei:lb")
+prev_textnode_xpath = register_xpath(
+    "prev_textnode", "./preceding-sibling::node()[1][boolean(self::text())]"
+)
 
 def remove_all_lb_elements(doc: TeiReader):
-    lb_elements = doc.any_xpath("//tei:lb")
+    lb_elements = lbs_xpath(doc.tree)
     for lb in lb_elements:
-        prev_textnode_result = lb.xpath("./preceding-sibling::node()[1][boolean(self::text())]")
+        prev_textnode_result = prev_textnode_xpath(lb)
         prev_textnode = prev_textnode_result[0] if prev_textnode_result else None
         lb_parent = lb.getparent()
         if prev_textnode is not None:
@@ -35,13 +41,16 @@ preceding_textnode_test = f"preceding-sibling::node()[1][{text_test}]"
 preceding_fw_test = f"preceding-sibling::*[local-name()='fw' and {preceding_textnode_test}]"
 preceding_test = f"({preceding_textnode_test} or {preceding_fw_test})"
 conditions = f"{local_name} and {preceding_test}"
-pbs_xpath = f"//*[{conditions}]"
+pbs_xpath = register_xpath("pbs_after_hyphen", f"//*[{conditions}]")
+previoustext_xpath = register_xpath(
+    "previoustext", "./preceding-sibling::node()[self::text() and normalize-space()!=''][1]"
+)
 
 def set_pb_break_attrib(doc: TeiReader):
-    pbs = doc.any_xpath(pbs_xpath)
+    pbs = pbs_xpath(doc.tree)
     for pb in pbs:
         pb.attrib["break"] = "no"
-        previoustext = pb.xpath("./preceding-sibling::node()[self::text() and normalize-space()!=''][1]")
+        previoustext = previoustext_xpath(pb)
         if previoustext:
             previoustextnode = previoustext[0]
             textparent = previoustextnode.getparent()
@@ -61,4 +70,5 @@ if __name__ == "__main__":
         doc = refine_tei.TeiReader(fp)
         #remove_all_lb_elements(doc)
         if set_pb_break_attrib(doc):
-            doc.tree_to_file(fp)
\ No newline at end of file
+            doc.tree_to_file(fp)
+    print_profile("retag_elements")
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""SQLite FTS5 index of the articles and legal sections of the editions.
+
+Every div[@type='article'] of an edition gets a row (its head and its whole
+text), every p[@type='legal_section'] in it one more (its label and its text),
+each with the bv_id, data set and date of the edition. The text and the
+article heads are searchable through the FTS5 table passages_fts, the rest
+are plain columns of passages.
+
+The index is kept at SEARCH_INDEX_PATH and is only written if that is set
+(create_sorter_val.py and pipeline.py set it with --search-index and update it
+once the sorter values are written, as they change the files). The export
+workflow keeps it in ./cache/search_index.sqlite. It is updated
+edition by edition: the hash of every indexed file is stored, an edition is
+only read again if it changed, editions gone from editions_source are dropped.
+
+Usage:
+    python search_index.py build [--index PATH]             # index all of editions_source
+    python search_index.py search "query" [--index PATH] [--limit N]
+"""
+
+import argparse
+import contextlib
+import glob
+import os
+import sqlite3
+
+import lxml.etree as ET
+
+from build_manifest import hash_file
+from create_sorter_val import data_set_xpath, origin_date_xpath
+from xpath_registry import register_xpath
+
+TEI_DIR = "./editions_source"
+SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH", "")
+tei_label_tag = "{http://www.tei-c.org/ns/1.0}label"
+
+articles_xpath = register_xpath("index_articles", ".//tei:body//tei:div[@type='article']")
+article_head_xpath = register_xpath("index_article_head", "./tei:head")
+legal_sections_xpath = register_xpath("index_legal_sections", ".//tei:p[@type='legal_section']")
+section_label_xpath = register_xpath("index_section_label", "./tei:label")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS editions (
+    bv_id TEXT PRIMARY KEY,
+    file_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS passages (
+    id INTEGER PRIMARY KEY,
+    bv_id TEXT NOT NULL,
+    data_set TEXT,
+    date TEXT,
+    kind TEXT NOT NULL,
+    article_head TEXT,
+    section_label TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS passages_bv_id ON passages (bv_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+    article_head, text, content='passages', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS passages_insert AFTER INSERT ON passages BEGIN
+    INSERT INTO passages_fts (rowid, article_head, text)
+    VALUES (new.id, new.article_head, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS passages_delete AFTER DELETE ON passages BEGIN
+    INSERT INTO passages_fts (passages_fts, rowid, article_head, text)
+    VALUES ('delete', old.id, old.article_head, old.text);
+END;
+"""
+
+
+def is_enabled():
+    return bool(SEARCH_INDEX_PATH)
+
+
+def connect(index_path=None):
+    index_path = index_path or SEARCH_INDEX_PATH
+    index_directory = os.path.dirname(index_path)
+    if index_directory:
+        os.makedirs(index_directory, exist_ok=True)
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def normalize_text(texts):
+    return " ".join(" ".join(texts).split())
+
+
+def first_value(values):
+    return values[0].strip() if values else None
+
+
+def get_section_text(section):
+    """the text of a legal section without its label"""
+    texts = [section.text or ""]
+    for child in section:
+        if child.tag != tei_label_tag:
+            texts.extend(child.itertext())
+        texts.append(child.tail or "")
+    return normalize_text(texts)
+
+
+def read_passages(tei_file_path):
+    """the rows of the articles and legal sections of an edition"""
+    tree = ET.parse(tei_file_path)
+    bv_id = os.path.splitext(os.path.basename(tei_file_path))[0]
+    data_set = first_value(data_set_xpath(tree))
+    date = first_value(origin_date_xpath(tree))
+    passages = []
+    for article in articles_xpath(tree):
+        heads = article_head_xpath(article)
+        article_head = normalize_text(heads[0].itertext()) if heads else None
+        article_texts = []
+        for child in article:
+            if child not in heads:
+                article_texts.extend(child.itertext())
+            article_texts.append(child.tail or "")
+        passages.append(
+            (bv_id, data_set, date, "article", article_head, None, normalize_text(article_texts))
+        )
+        for section in legal_sections_xpath(article):
+            labels = section_label_xpath(section)
+            passages.append(
+                (
+                    bv_id,
+                    data_set,
+                    date,
+                    "legal_section",
+                    article_head,
+                    normalize_text(labels[0].itertext()) if labels else None,
+                    get_section_text(section),
+                )
+            )
+    return bv_id, passages
+
+
+def remove_edition(connection, bv_id):
+    connection.execute("DELETE FROM passages WHERE bv_id = ?", (bv_id,))
+    connection.execute("DELETE FROM editions WHERE bv_id = ?", (bv_id,))
+
+
+def update_index(tei_file_paths, index_path=None):
+    """
+    (re)indexes the given editions that changed since they were indexed and
+    drops the indexed editions whose file is gone
+    """
+    updated = 0
+    unchanged = 0
+    # # used as a context manager the connection commits, closing() closes it
+    with contextlib.closing(connect(index_path)) as connection, connection:
+        file_hashes = dict(connection.execute("SELECT bv_id, file_hash FROM editions"))
+        for tei_file_path in tei_file_paths:
+            if not os.path.isfile(tei_file_path):
+                continue
+            file_hash = hash_file(tei_file_path)
+            bv_id = os.path.splitext(os.path.basename(tei_file_path))[0]
+            if file_hashes.get(bv_id) == file_hash:
+                unchanged += 1
+                continue
+            bv_id, passages = read_passages(tei_file_path)
+            remove_edition(connection, bv_id)
+            connection.executemany(
+                "INSERT INTO passages (bv_id, data_set, date, kind, article_head, section_label, text)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                passages,
+            )
+            connection.execute(
+                "INSERT INTO editions (bv_id, file_hash) VALUES (?, ?)", (bv_id, file_hash)
+            )
+            updated += 1
+        removed = [
+            bv_id
+            for bv_id in file_hashes
+            if not os.path.isfile(os.path.join(TEI_DIR, bv_id + ".xml"))
+        ]
+        for bv_id in removed:
+            remove_edition(connection, bv_id)
+    print(f"search index: {updated} edition(s) indexed, {unchanged} unchanged, {len(removed)} removed")
+
+
+def search(query, index_path=None, limit=20):
+    """the passages matching an FTS5 query, best first"""
+    with contextlib.closing(connect(index_path)) as connection:
+        return connection.execute(
+            "SELECT passages.bv_id, passages.date, passages.kind, passages.article_head,"
+            " passages.section_label, snippet(passages_fts, 1, '[', ']', '...', 12)"
+            " FROM passages_fts JOIN passages ON passages.id = passages_fts.rowid"
+            " WHERE passages_fts MATCH ? ORDER BY rank LIMIT ?",
+            (query, limit),
+        ).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="full text index of articles and legal sections")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index every edition in editions_source")
+    build_parser.add_argument("--index", default=SEARCH_INDEX_PATH or "./search_index.sqlite")
+    search_parser = subparsers.add_parser("search", help="run an FTS5 query")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--index", default=SEARCH_INDEX_PATH or "./search_index.sqlite")
+    search_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    if args.command == "build":
+        update_index(sorted(glob.glob(os.path.join(TEI_DIR, "*.xml"))), args.index)
+    else:
+        for bv_id, date, kind, article_head, section_label, snippet in search(
+            args.query, args.index, args.limit
+        ):
+            print(f"{bv_id} ({date}) {article_head or ''} {section_label or ''} [{kind}]: {snippet}")
@@ -0,0 +1,76 @@
+"""Rules recognizing the structure of a draft in its transcribed text.
+
+A rule is a compiled pattern and the structure made of a text matching it:
+
+    SECTION_HEAD    a line starting after an lb becomes the head of a new
+                    div[@type=type_val] (articles)
+    LEGAL_SECTION   a numbered text becomes a p[@type='legal_section']
+
+refine_tei collects the candidate text nodes of a document (or article) in one
+walk and asks the rule set which rule, if any, each of them matches, so adding
+a rule does not add a pass over the tree. The drafts of all data sets are
+written the same way, so RULE_SET is used for every document.
+"""
+
+import re
+
+SECTION_HEAD = "section_head"
+LEGAL_SECTION = "legal_section"
+
+
+class StructureRule:
+    """a compiled pattern and what is made of a text matching it"""
+
+    def __init__(self, name, action, pattern, marker=None, type_val=None):
+        self.name = name
+        self.action = action
+        self.pattern = re.compile(pattern)
+        # # cheap substring test done before the pattern
+        self.marker = marker
+        self.type_val = type_val
+
+    def matches(self, text):
+        if self.marker is not None and self.marker not in text:
+            return False
+        return self.pattern.match(text.strip()) is not None
+
+
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.head_rules = tuple(rule for rule in rules if rule.action == SECTION_HEAD)
+        self.start_rules = tuple(rule for rule in rules if rule.action != SECTION_HEAD)
+
+    def match_head(self, text):
+        """the first section head rule text matches, None if there is none"""
+        for rule in self.head_rules:
+            if rule.matches(text):
+                return rule
+        return None
+
+    def match_start(self, text):
+        """the first legal section rule text matches, None if there is none"""
+        for rule in self.start_rules:
+            if rule.matches(text):
+                return rule
+        return None
+
+
+NUMBERED_TEXT_PATTERN = r"^ *[(\]]* ?[0-9]{1,2} *[.)\]]*.*?[a-zA-Z].*"
+# # the number (with brackets and dots) in front of an item or legal section
+LABEL_PATTERN = re.compile(r"^([ \[\]().0-9]+)(.*)")
+# # what contains-number in refine_tei's candidate texts tests
+DIGIT_PATTERN = re.compile(r"[0-9]")
+
+ARTICLE_RULE = StructureRule(
+    "article",
+    SECTION_HEAD,
+    r"Art(?:ikel|\.)?(?: *[0-9]+| *[iIVvXxCcDdMmLl]+) *\.* *$",
+    marker="Art",
+    type_val="article",
+)
+LEGAL_SECTION_RULE = StructureRule(
+    "legal_section", LEGAL_SECTION, NUMBERED_TEXT_PATTERN, type_val="legal_section"
+)
+
+RULE_SET = RuleSet((ARTICLE_RULE, LEGAL_SECTION_RULE))
@@ -1,37 +1,96 @@
 xsl_path="./page2tei/page2tei-0.xsl"
 
-# Space-separated list of IDs to patch before transformation (format: collection-docid)
-# e.g. PATCH_IDS="196428-10582280 196428-1529214"
-PATCH_IDS="196429-10582300 196429-10582299 196428-10582280 196428-14147345"
-
 pwd
 ls ./
 if [ ! -f  $xsl_path ]; then echo "xsl script $xsl_path not found!" & exit 1; fi
-for file in ./mets/*/*_mets.xml
-  do
-  new=$(echo "$file" | sed "s@_mets.xml@_tei.xml@g")
-  echo "transforming $file to $new"
 
-  # Check if this file is in the patch list
-  collection=$(echo "$file" | sed 's@\./mets/\([^/]*\)/.*@\1@')
-  docid=$(echo "$file" | sed 's@.*/\([^_]*\)_mets.xml@\1@')
-  key="${collection}-${docid}"
+# fetch_mets.py keeps the TEIs of unchanged documents, only METS files without
+# a TEI next to them are patched and transformed; both are kept gzip compressed
+# by artifact_store.py (<name>.gz), uncompressed ones are handled the same way
+has_artifact() {
+  [ -f "$1" ] || [ -f "$1.gz" ]
+}
 
-  needs_patch=false
-  for pid in $PATCH_IDS; do
-    if [ "$pid" = "$key" ]; then needs_patch=true; break; fi
-  done
+pending_mets=()
+for file in ./mets/*/*_mets.xml ./mets/*/*_mets.xml.gz; do
+  if [ ! -f "$file" ]; then continue; fi
+  raw="${file%.gz}"
+  if [[ "$file" != *.gz ]] && [ -f "$raw.gz" ]; then continue; fi
+  if ! has_artifact "${raw%_mets.xml}_tei.xml"; then
+    pending_mets+=("$file")
+  fi
+done
+echo "${#pending_mets[@]} METS file(s) without TEI"
+
+# page2tei fails with a type error on TextRegions without @custom; patch_page_xml.py
+# downloads every PAGE file referenced by the METS files, patches the regions and
+# writes METS files pointing to the local pages, so saxon doesn't download them again,
+# all in one call sharing one connection pool and page cache
+declare -A patched_mets
+patchdir=$(mktemp -d)
+stage_start=$(date +%s.%N)
+echo "  (checking PAGE XML for missing @custom attributes)"
+while IFS=$'\t' read -r original patched regions; do
+  if [ "$regions" != "0" ]; then echo "  (patched missing @custom attributes for $original)"; fi
+  patched_mets["$original"]="$patched"
+done < <(if [ ${#pending_mets[@]} -gt 0 ]; then python ./scripts/patch_page_xml.py --output-dir "$patchdir" "${pending_mets[@]}"; fi)
+python ./scripts/export_report.py record-stage patch_page_xml --started-at "$stage_start"
 
-  if $needs_patch; then
-    echo "  (patching missing @custom attributes for $key)"
-    tmpdir=$(mktemp -d)
-    src=$(python ./scripts/patch_page_xml.py "$file" "$tmpdir")
-    java -jar ./saxon/saxon9he.jar -xsl:$xsl_path -s:$src -o:$new combine='true()'
-    rm -rf "$tmpdir"
-  else
-    java -jar ./saxon/saxon9he.jar -xsl:$xsl_path -s:$file -o:$new combine='true()'
+# one JVM per collection: the stylesheet is compiled once and saxon transforms
+# all METS files of the collection with a pool of SAXON_THREADS threads
+transform_file() {
+  java $SAXON_JAVA_OPTS -jar ./saxon/saxon9he.jar -xsl:$xsl_path -s:"$1" -o:"$2" combine='true()'
+}
+
+transform_collection() {
+  collection_dir=$1
+  stage_in=$(mktemp -d)
+  stage_out=$(mktemp -d)
+  declare -A staged_mets
+  for file in "${pending_mets[@]}"; do
+    if [ "$(dirname "$file")" != "$collection_dir" ]; then continue; fi
+    # keep the (uncompressed) file name, only the directory differs from a single-file run
+    name=$(basename "${file%.gz}")
+    src="${patched_mets[$file]:-$file}"
+    if [[ "$src" == *.gz ]]; then
+      gunzip -c "$src" > "$stage_in/$name"
+    else
+      ln -s "$(realpath "$src")" "$stage_in/$name"
+    fi
+    staged_mets["$file"]="$stage_in/$name"
+  done
+  if [ ${#staged_mets[@]} -eq 0 ]; then
+    echo "no METS file of $collection_dir needs to be transformed"
+    rm -rf "$stage_in" "$stage_out"
+    return
   fi
+  echo "transforming ${#staged_mets[@]} file(s) of $collection_dir with $SAXON_THREADS thread(s)"
+  java $SAXON_JAVA_OPTS -jar ./saxon/saxon9he.jar -xsl:$xsl_path -s:"$stage_in" -o:"$stage_out" -threads:$SAXON_THREADS combine='true()'
+  for file in "${!staged_mets[@]}"; do
+    staged="${staged_mets[$file]}"
+    new=$(echo "${file%.gz}" | sed "s@_mets.xml@_tei.xml@g")
+    result="$stage_out/$(basename "$staged")"
+    if [ -f "$result" ]; then
+      mv "$result" "$new"
+    else
+      # a failing document must not take the rest of the collection down with it
+      echo "no batch result for $file, transforming it on its own to $new"
+      transform_file "$staged" "$new"
+    fi
+  done
+  rm -rf "$stage_in" "$stage_out"
+}
+
+SAXON_THREADS="${SAXON_THREADS:-$(nproc)}"
+stage_start=$(date +%s.%N)
+for collection_dir in ./mets/*/
+  do
+  transform_collection "${collection_dir%/}"
   done
+rm -rf "$patchdir"
+# the new TEIs (and intermediates still written uncompressed) go into the artifact store
+python ./scripts/artifact_store.py store ./mets/*/*_tei.xml ./mets/*/*_mets.xml ./mets/*/*_image_name.xml
+python ./scripts/export_report.py record-stage transform_xslt --started-at "$stage_start"
 echo "done with xslt"
 echo "refining created tei"
-python ./scripts/refine_tei.py
\ No newline at end of file
+python ./scripts/refine_tei.py --workers "$(nproc)"
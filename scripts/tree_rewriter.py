@@ -0,0 +1,87 @@
+"""Many small rewrites of an lxml tree in one walk.
+
+Handlers are registered for a tag in clark notation ("{ns}p"), a local name
+("p"), "*" for every element or a predicate taking the element. They are
+called in registration order for every matching element while the tree is
+walked once in document order. If a handler changes the tag, only handlers
+registered after it are still tried, now for the new tag.
+
+The elements to visit are collected before the walk, like the result of an
+XPath: elements added by handlers are not visited. A handler that removes
+its element from the tree returns True; the element's subtree and the
+remaining handlers are skipped then.
+"""
+
+
+class TreeRewriter:
+    def __init__(self):
+        self.handlers = []
+        self.handlers_by_tag = {}
+
+    def register(self, match, handler):
+        self.handlers.append((len(self.handlers), match, handler))
+        self.handlers_by_tag.clear()
+        return handler
+
+    def get_handlers(self, tag):
+        handlers = self.handlers_by_tag.get(tag)
+        if handlers is None:
+            local_name = tag.rpartition("}")[2]
+            handlers = [
+                (order, match if callable(match) else None, handler)
+                for order, match, handler in self.handlers
+                if callable(match) or match in ("*", tag, local_name)
+            ]
+            self.handlers_by_tag[tag] = handlers
+        return handlers
+
+    def apply_handlers(self, element):
+        """returns True if a handler removed element"""
+        last_order = -1
+        tag = element.tag
+        handlers = self.get_handlers(tag)
+        index = 0
+        while index < len(handlers):
+            order, predicate, handler = handlers[index]
+            index += 1
+            if order <= last_order:
+                continue
+            last_order = order
+            if predicate is not None and not predicate(element):
+                continue
+            if handler(element):
+                return True
+            if element.tag != tag:
+                tag = element.tag
+                handlers = self.get_handlers(tag)
+                index = 0
+        return False
+
+    def get_tag_filter(self):
+        """tags for element.iter(), empty if every element has to be looked at"""
+        tags = []
+        for _, match, _ in self.handlers:
+            if callable(match) or match == "*":
+                return []
+            tags.append(match if match.startswith("{") else f"{{*}}{match}")
+        return tags
+
+    def rewrite(self, element):
+        """walks element and all its descendants"""
+        tags = self.get_tag_filter()
+        nodes = list(element.iter(*tags))
+        handlers_by_tag = self.handlers_by_tag
+        index = 0
+        while index < len(nodes):
+            node = nodes[index]
+            index += 1
+            tag = node.tag
+            # # comments and processing instructions are passed over
+            if not isinstance(tag, str):
+                continue
+            handlers = handlers_by_tag.get(tag)
+            if handlers is None:
+                handlers = self.get_handlers(tag)
+            if handlers and self.apply_handlers(node):
+                index += sum(1 for _ in node.iterdescendants(*tags))
+        return element
@@ -0,0 +1,203 @@
+"""Validates the editions in ./editions_source against the TEI schema.
+
+The RELAX NG schema is ./scripts/schema/bv_tei.rng, tei_all (TEI P5 4.3.0,
+next to it) with the changes for what the template and refine_tei.py write,
+so a run needs no network access; TEI_SCHEMA_PATH points to another one. An ISO
+Schematron given by TEI_SCHEMATRON_PATH is checked after it. Every worker
+process compiles the schemas once (libxml2 takes about 20 seconds for
+bv_tei) and validates its share of the files with them; nothing is compiled
+if no file has to be validated. A missing schema raises an error instead of
+skipping the validation.
+
+The result of every file is kept in ./cache/validation_cache.json by the hash
+of the file and of the schemas, so a run only validates the editions written
+(or changed by create_sorter_val.py) since the last one; use --full to
+validate everything again. Invalid files, cached or not, are written to
+./logs/invalid_tei.csv; ./logs/malformed_files.csv stays the log of the
+documents refine_tei.py and generate_image_only_tei.py could not build.
+
+Usage:
+    python validate_tei.py [--workers N] [--full]
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import lxml.etree as ET
+
+import export_report
+from build_manifest import hash_file, hash_inputs
+
+TEI_DIR = "./editions_source"
+INVALID_FILES_LOGPATH = "./logs/invalid_tei.csv"
+VALIDATION_CACHE_PATH = "./cache/validation_cache.json"
+TEI_SCHEMA_PATH = os.environ.get("TEI_SCHEMA_PATH", "./scripts/schema/bv_tei.rng")
+TEI_SCHEMATRON_PATH = os.environ.get("TEI_SCHEMATRON_PATH", "")
+# # errors of one file written to the log
+MAX_REPORTED_ERRORS = 5
+
+# # (relaxng, schematron) of this process, compiled by init_worker
+validators = None
+
+
+def get_schema_path():
+    """the RELAX NG schema, an error if there is none"""
+    if not os.path.isfile(TEI_SCHEMA_PATH):
+        raise FileNotFoundError(
+            f"TEI schema {TEI_SCHEMA_PATH} not found, the editions cannot be validated"
+        )
+    return TEI_SCHEMA_PATH
+
+
+def get_schemas_hash(schema_path, schematron_path):
+    return hash_inputs(
+        hash_file(schema_path), hash_file(schematron_path) if schematron_path else None
+    )
+
+
+def init_worker(schema_path, schematron_path=""):
+    global validators
+    relaxng = ET.RelaxNG(ET.parse(schema_path))
+    schematron = None
+    if schematron_path:
+        from lxml.isoschematron import Schematron
+
+        schematron = Schematron(ET.parse(schematron_path))
+    validators = (relaxng, schematron)
+
+
+def format_errors(error_log):
+    return [f"line {error.line}: {error.message}" for error in list(error_log)[:MAX_REPORTED_ERRORS]]
+
+
+def validate_file(file_path):
+    """returns the errors found in file_path, an empty list if it is valid"""
+    try:
+        doc = ET.parse(file_path)
+    except ET.XMLSyntaxError as exception:
+        return [str(exception)]
+    errors = []
+    for validator in validators:
+        if validator is not None and not validator.validate(doc):
+            errors.extend(format_errors(validator.error_log))
+    return errors
+
+
+def load_validation_cache():
+    try:
+        with open(VALIDATION_CACHE_PATH, "r", encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validation_cache(cache):
+    os.makedirs(os.path.dirname(VALIDATION_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{VALIDATION_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(cache, outfile, indent=1, sort_keys=True)
+        outfile.write("\n")
+    os.replace(tmp_path, VALIDATION_CACHE_PATH)
+
+
+def validate_files(file_paths, schema_path, schematron_path, workers):
+    if not file_paths:
+        return []
+    if workers > 1 and len(file_paths) > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(schema_path, schematron_path),
+        ) as executor:
+            chunksize = max(1, len(file_paths) // (workers * 4))
+            return list(executor.map(validate_file, file_paths, chunksize=chunksize))
+    init_worker(schema_path, schematron_path)
+    return [validate_file(file_path) for file_path in file_paths]
+
+
+def log_invalid_files(invalid_files):
+    """writes the invalid files of this run, the log of an earlier run goes"""
+    if os.path.isfile(INVALID_FILES_LOGPATH):
+        os.remove(INVALID_FILES_LOGPATH)
+    if not invalid_files:
+        print("no invalid files")
+        return
+    print("Some files are not valid TEI!".upper())
+    log_directory, _ = os.path.split(INVALID_FILES_LOGPATH)
+    if log_directory and not os.path.exists(log_directory):
+        os.makedirs(log_directory)
+    with open(INVALID_FILES_LOGPATH, "w", newline="", encoding="utf-8") as outfile:
+        dict_writer = csv.DictWriter(outfile, ["file_name", "error"])
+        dict_writer.writeheader()
+        dict_writer.writerows(invalid_files)
+
+
+def validate_all_files(workers=1, full=False, documents=None):
+    """
+    validates every edition whose content or schema changed since it was last
+    validated, logs the invalid ones and returns them
+    """
+    schema_path = get_schema_path()
+    schemas_hash = get_schemas_hash(schema_path, TEI_SCHEMATRON_PATH)
+    old_cache = {} if full else load_validation_cache()
+    new_cache = {}
+    pending = []
+    for file_path in sorted(glob.glob(os.path.join(TEI_DIR, "*.xml"))):
+        file_name = os.path.normpath(file_path)
+        entry = {"hash": hash_file(file_path), "schemas": schemas_hash}
+        old_entry = old_cache.get(file_name)
+        if (
+            old_entry is not None
+            and old_entry.get("hash") == entry["hash"]
+            and old_entry.get("schemas") == schemas_hash
+        ):
+            entry["errors"] = old_entry.get("errors", [])
+        else:
+            pending.append(file_name)
+        new_cache[file_name] = entry
+    for file_name, errors in zip(
+        pending, validate_files(pending, schema_path, TEI_SCHEMATRON_PATH, workers)
+    ):
+        new_cache[file_name]["errors"] = errors
+    save_validation_cache(new_cache)
+    pending_files = set(pending)
+    invalid_files = []
+    for file_name, entry in new_cache.items():
+        if documents is not None:
+            documents.append(
+                {
+                    "document": file_name,
+                    "validated": file_name in pending_files,
+                    "errors": len(entry["errors"]),
+                }
+            )
+        if entry["errors"]:
+            invalid_files.append({"file_name": file_name, "error": "; ".join(entry["errors"])})
+    print(
+        f"{len(new_cache)} file(s): {len(pending)} validated, "
+        f"{len(new_cache) - len(pending)} unchanged, {len(invalid_files)} invalid"
+    )
+    log_invalid_files(invalid_files)
+    return invalid_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="validate the editions against the TEI schema")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes validating in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="validate every file again, ignoring the validation cache",
+    )
+    args = parser.parse_args()
+    with export_report.measure_stage("validate_tei") as documents:
+        validate_all_files(workers=args.workers, full=args.full, documents=documents)
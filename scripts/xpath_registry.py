@@ -0,0 +1,113 @@
+"""Named XPath expressions, compiled once with the TEI namespace bound.
+
+Scripts register their queries at import time and call the returned
+lxml.etree.XPath objects instead of passing strings to TeiReader.any_xpath
+or element.xpath, which compile the expression again on every call:
+
+    body_xpath = register_xpath("body", ".//tei:body")
+    body_node = body_xpath(doc.tree)[0]
+
+With XPATH_PROFILE=1 every registered query counts its calls and the time
+spent in them, print_profile() lists the queries by total time (and stores
+them in the export report, if one is written).
+"""
+
+import os
+import time
+
+import lxml.etree as ET
+
+TEI_NS = "http://www.tei-c.org/ns/1.0"
+XPATH_NAMESPACES = {"tei": TEI_NS}
+XPATH_PROFILE = os.environ.get("XPATH_PROFILE", "") not in ("", "0", "false")
+
+registered_xpaths = {}
+# # [calls, seconds] by query name, only filled with XPATH_PROFILE
+xpath_profile = {}
+
+
+class ProfiledXPath:
+    """calls a compiled XPath and adds the call and its time to xpath_profile"""
+
+    def __init__(self, name, xpath):
+        self.name = name
+        self.xpath = xpath
+        self.path = xpath.path
+
+    def __call__(self, node, **variables):
+        start = time.perf_counter()
+        try:
+            return self.xpath(node, **variables)
+        finally:
+            entry = xpath_profile.get(self.name)
+            if entry is None:
+                entry = xpath_profile[self.name] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+
+def register_xpath(name, expression, namespaces=None):
+    """
+    compiles expression under name, registering the same name and expression
+    again returns the already compiled query
+    """
+    xpath = registered_xpaths.get(name)
+    if xpath is not None:
+        if xpath.path != expression:
+            raise ValueError(f"xpath '{name}' is already registered as {xpath.path}")
+        return xpath
+    xpath = ET.XPath(
+        expression, namespaces=XPATH_NAMESPACES if namespaces is None else namespaces
+    )
+    if XPATH_PROFILE:
+        xpath = ProfiledXPath(name, xpath)
+    registered_xpaths[name] = xpath
+    return xpath
+
+
+def get_xpath(name):
+    return registered_xpaths[name]
+
+
+def take_profile():
+    """returns the profile collected so far and starts a new one"""
+    profile = {name: list(entry) for name, entry in xpath_profile.items()}
+    xpath_profile.clear()
+    return profile
+
+
+def merge_profile(profile):
+    """adds a profile taken in another process"""
+    for name, (calls, seconds) in profile.items():
+        entry = xpath_profile.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+
+def format_profile(profile, limit=None):
+    lines = [f"{'xpath':<40} {'calls':>10} {'total':>10} {'per call':>10}"]
+    ranking = sorted(profile.items(), key=lambda item: -item[1][1])
+    for name, (calls, seconds) in ranking[:limit]:
+        lines.append(
+            f"{name:<40} {calls:>10} {seconds * 1000:>8.1f}ms"
+            f" {seconds * 1e6 / calls if calls else 0:>8.1f}us"
+        )
+    return "\n".join(lines)
+
+
+def print_profile(stage_name):
+    """prints the profile of stage_name and adds it to the export report"""
+    if not XPATH_PROFILE:
+        return
+    import export_report
+
+    profile = take_profile()
+    print(f"\nxpath profile of {stage_name}:")
+    print(format_profile(profile))
+    if export_report.is_enabled():
+        report = export_report.load_report()
+        report.setdefault("xpath_profile", {})[stage_name] = {
+            name: {"calls": calls, "seconds": round(seconds, 6)}
+            for name, (calls, seconds) in profile.items()
+        }
+        export_report.save_report(report)
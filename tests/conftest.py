@@ -0,0 +1,73 @@
+import gzip
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(REPO_DIR, "tests", "fixtures")
+CORPUS_DIR = os.path.join(FIXTURES_DIR, "corpus")
+# # the editions the refine_tei of the baseline commit made of the corpus, dated
+# # CHANGE_DATE and with the image names of get_fake_img_names
+EXPECTED_DIR = os.path.join(FIXTURES_DIR, "corpus_expected")
+CHANGE_DATE = "2020-01-01"
+CORPUS_DOCUMENTS = [
+    ("195363", "1529221"),
+    ("195363", "1529230"),
+    ("195363", "9217644"),
+    ("196428", "1529250"),
+    ("196428", "1529262"),
+    ("196428", "9217598"),
+    ("196429", "1529271"),
+    ("196429", "1850528"),
+    ("196429", "9217697"),
+]
+
+# # the scripts import each other by module name and read ./scripts/templates
+sys.path.insert(0, os.path.join(REPO_DIR, "scripts"))
+os.chdir(REPO_DIR)
+
+
+def get_fake_img_names(bv_doc_id):
+    return [f"IMG_{number}" for number in range(1, 1000)]
+
+
+def read_expected_edition(bv_doc_id):
+    with gzip.open(os.path.join(EXPECTED_DIR, f"{bv_doc_id}.xml.gz"), "rb") as infile:
+        return infile.read()
+
+
+@pytest.fixture
+def corpus_metadata(monkeypatch):
+    """the baserow dumps next to the fixture corpus, read without network access"""
+    import metadata_store
+
+    monkeypatch.setattr(metadata_store, "METADATA_DIR", CORPUS_DIR)
+    monkeypatch.setattr(metadata_store, "METADATA_OFFLINE", True)
+    monkeypatch.setattr(metadata_store, "loaded_dumps", {})
+    monkeypatch.setattr(metadata_store, "built_indexes", {})
+    return metadata_store.get_documents_by_transkribus_id()
+
+
+@pytest.fixture
+def refine_corpus(corpus_metadata, tmp_path, monkeypatch):
+    """
+    refine_tei set up to refine the corpus into tmp_path/editions_source with
+    its build manifest next to it, the METS of every document is dated
+    CHANGE_DATE; returns the metadata
+    """
+    import build_manifest
+    import metadata_store
+    import refine_tei
+
+    tei_dir = tmp_path / "editions_source"
+    tei_dir.mkdir()
+    monkeypatch.setattr(build_manifest, "BUILD_MANIFEST_PATH", str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(refine_tei, "TMP_DIR", CORPUS_DIR)
+    monkeypatch.setattr(refine_tei, "TEI_DIR", str(tei_dir))
+    monkeypatch.setattr(refine_tei, "get_img_names_from_goobi_mets", get_fake_img_names)
+    monkeypatch.setattr(refine_tei, "PROJECT_MD", metadata_store.get_project_metadata())
+    # # the corpus has no METS files
+    monkeypatch.setattr(refine_tei, "return_mets_doc", lambda *args: object())
+    monkeypatch.setattr(refine_tei, "get_last_change_date", lambda mets_doc: CHANGE_DATE)
+    return corpus_metadata
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import build_manifest
+
+
+@pytest.fixture
+def tei_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_manifest, "BUILD_MANIFEST_PATH", str(tmp_path / "manifest.json"))
+    tei_dir = tmp_path / "editions_source"
+    tei_dir.mkdir()
+    for bv_doc_id in ("kept", "moved", "gone"):
+        (tei_dir / f"{bv_doc_id}.xml").write_text("<TEI/>")
+    return str(tei_dir)
+
+
+def entry(input_hash="old"):
+    return {"input_hash": input_hash}
+
+
+def test_only_editions_not_built_or_kept_are_deleted(tei_dir):
+    old_entries = {"kept": entry(), "gone": entry()}
+    new_entries = {}
+    # # not built in this run, e.g. the download failed: the generator keeps it
+    build_manifest.keep_old_entry(old_entries, new_entries, "kept")
+    # # the row lost its transkribus id, nothing builds or keeps the edition
+    removed = build_manifest.remove_stale_outputs(tei_dir, "refine_tei", old_entries, new_entries)
+    assert removed == ["gone"]
+    assert not os.path.isfile(os.path.join(tei_dir, "gone.xml"))
+    assert os.path.isfile(os.path.join(tei_dir, "kept.xml"))
+    assert new_entries == {"kept": entry()}
+
+
+def test_edition_moved_to_the_other_generator_is_kept(tei_dir):
+    build_manifest.save_build_manifest("refine_tei", {"moved": entry()})
+    # # skip_transcription was set, the image-only generator writes the edition now
+    new_entries = {"moved": entry("new")}
+    build_manifest.remove_stale_outputs(tei_dir, "generate_image_only_tei", {}, new_entries)
+    build_manifest.save_build_manifest("generate_image_only_tei", new_entries, list(new_entries))
+    assert build_manifest.load_build_manifest("refine_tei") == {}
+    new_entries = {}
+    assert build_manifest.remove_stale_outputs(
+        tei_dir, "refine_tei", {"moved": entry()}, new_entries
+    ) == []
+    assert new_entries == {}
+    assert os.path.isfile(os.path.join(tei_dir, "moved.xml"))
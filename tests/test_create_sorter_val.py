@@ -0,0 +1,95 @@
+import os
+import re
+
+import lxml.etree as ET
+import pytest
+from acdh_tei_pyutils.tei import TeiReader
+
+import create_sorter_val
+from conftest import read_expected_edition
+
+# # data set and date of the corpus editions decide their order numbers
+ORDER_NUMBERS = {
+    "bv_doc_id__99": ("Datenset A", "0100"),
+    "bv_doc_id__32": ("Datenset A", "0200"),
+    "bv_doc_id__23": ("Datenset A", "0300"),
+    "bv_doc_id__54": ("Datenset B", "0100"),
+    "bv_doc_id__87": ("Datenset B", "0200"),
+    "bv_doc_id__43": ("Datenset B", "0300"),
+    "bv_doc_id__75": ("Datenset C", "0100"),
+    "bv_doc_id__95": ("Datenset C", "0200"),
+    "bv_doc_id__65": ("Datenset C", "0300"),
+}
+
+
+@pytest.fixture
+def editions(tmp_path):
+    for bv_doc_id in ORDER_NUMBERS:
+        (tmp_path / f"{bv_doc_id}.xml").write_bytes(read_expected_edition(bv_doc_id))
+    return str(tmp_path / "*.xml")
+
+
+def write_baseline_edition(file_path, dataset, ordernumber):
+    """what create_sorter_val.py of the baseline commit wrote"""
+    xmldoc = TeiReader(file_path)
+    series_stmt = ET.fromstring(
+        f'<seriesStmt xmlns="http://www.tei-c.org/ns/1.0">\n<title>{dataset}</title>\n'
+        f'<biblScope unit="part">{ordernumber}</biblScope>\n</seriesStmt>'
+    )
+    series_stmt.tail = "\n"
+    xmldoc.any_xpath("//tei:fileDesc/tei:publicationStmt")[0].addnext(series_stmt)
+    xmldoc.tree_to_file(file_path)
+    with open(file_path, "rb") as infile:
+        return infile.read()
+
+
+def sort_editions(inputpath, workers=1):
+    documents = []
+    catalogue, headers = create_sorter_val.make_catalogue(inputpath)
+    create_sorter_val.sort_and_update_catalogue(catalogue, headers, workers, documents)
+    return documents
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_editions_are_numbered_as_the_baseline_did(editions, tmp_path, workers):
+    documents = sort_editions(editions, workers)
+    assert len(documents) == len(ORDER_NUMBERS)
+    (tmp_path / "baseline").mkdir()
+    baseline_path = str(tmp_path / "baseline" / "edition.xml")
+    for bv_doc_id, (dataset, ordernumber) in ORDER_NUMBERS.items():
+        with open(baseline_path, "wb") as outfile:
+            outfile.write(read_expected_edition(bv_doc_id))
+        with open(tmp_path / f"{bv_doc_id}.xml", "rb") as infile:
+            assert infile.read() == write_baseline_edition(baseline_path, dataset, ordernumber)
+
+
+def test_only_renumbered_editions_are_rewritten(editions, tmp_path):
+    sort_editions(editions)
+    modified_at = {
+        bv_doc_id: os.stat(tmp_path / f"{bv_doc_id}.xml").st_mtime_ns for bv_doc_id in ORDER_NUMBERS
+    }
+    assert sort_editions(editions) == []
+    # # a new edition of data set A sorts in second, the ones after it move
+    edition = read_expected_edition("bv_doc_id__32").replace(b"1920-02-07", b"1920-01-01")
+    (tmp_path / "bv_doc_id__10.xml").write_bytes(edition)
+    documents = sort_editions(editions)
+    assert sorted(os.path.basename(doc["document"]) for doc in documents) == [
+        "bv_doc_id__10.xml",
+        "bv_doc_id__23.xml",
+        "bv_doc_id__32.xml",
+    ]
+    for bv_doc_id in ORDER_NUMBERS:
+        if bv_doc_id not in ("bv_doc_id__23", "bv_doc_id__32"):
+            assert os.stat(tmp_path / f"{bv_doc_id}.xml").st_mtime_ns == modified_at[bv_doc_id]
+    header = create_sorter_val.read_header(str(tmp_path / "bv_doc_id__23.xml"))
+    assert create_sorter_val.has_series_stmt(header, "Datenset A", "0400")
+
+
+def test_undated_edition_goes_last(editions, tmp_path):
+    # # the template leaves the dates out if baserow has none
+    edition = re.sub(rb' notBefore-iso="[^"]*"', b"", read_expected_edition("bv_doc_id__99"))
+    (tmp_path / "bv_doc_id__99.xml").write_bytes(edition)
+    sort_editions(editions)
+    for bv_doc_id, ordernumber in (("bv_doc_id__32", "0100"), ("bv_doc_id__23", "0200"), ("bv_doc_id__99", "0300")):
+        header = create_sorter_val.read_header(str(tmp_path / f"{bv_doc_id}.xml"))
+        assert create_sorter_val.has_series_stmt(header, "Datenset A", ordernumber)
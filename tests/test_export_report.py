@@ -0,0 +1,59 @@
+import requests
+
+import export_report
+import refine_tei
+
+
+def test_refine_run_records_the_stage_and_every_document(refine_corpus, tmp_path, monkeypatch):
+    monkeypatch.setattr(export_report, "REPORT_PATH", str(tmp_path / "report" / "export_report.json"))
+    monkeypatch.setattr(refine_tei, "prefetch_img_names", lambda bv_doc_ids: None)
+    with export_report.measure_stage("refine_tei") as documents:
+        refine_tei.process_all_files(documents=documents)
+    report = export_report.load_report()
+    stage_metrics = report["stages"]["refine_tei"]
+    assert stage_metrics["documents"] == len(report["documents"]["refine_tei"]) == 9
+    assert stage_metrics["http_requests"] == 0
+    assert stage_metrics["bytes_written"] == sum(
+        doc["bytes_written"] for doc in report["documents"]["refine_tei"]
+    ) > 0
+    for doc in report["documents"]["refine_tei"]:
+        assert {"write_xml_doc", "clean_up_elements"} <= set(doc["stages"])
+    summary = export_report.format_summary(report)
+    assert "| refine_tei |" in summary
+    assert "### Slowest documents" in summary
+    # # a second run writes nothing and records no documents
+    with export_report.measure_stage("refine_tei") as documents:
+        refine_tei.process_all_files(documents=documents)
+    assert export_report.load_report()["stages"]["refine_tei"]["documents"] == 0
+
+
+def test_nothing_is_recorded_without_a_report_path(monkeypatch):
+    saved_reports = []
+    monkeypatch.setattr(export_report, "REPORT_PATH", "")
+    monkeypatch.setattr(export_report, "save_report", saved_reports.append)
+    with export_report.measure_stage("refine_tei") as documents:
+        documents.append({"document": "a", "bytes_written": 1})
+    assert saved_reports == []
+
+
+def test_requests_of_a_pool_process_are_counted_in_the_parent(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_report, "REPORT_PATH", str(tmp_path / "export_report.json"))
+    # # a process that is not forked starts with the requests.Session.send of the library
+    monkeypatch.setattr(requests.Session, "send", lambda session, request, **kwargs: requests.Response())
+    monkeypatch.setattr(export_report, "http_requests", 3)
+    refine_tei.init_worker(refine_tei.PROJECT_MD)
+    assert export_report.http_requests == 0
+
+    def refine_with_request(xml_file_path, transkribus_collection_id, doc_metadata):
+        with export_report.measure_document(xml_file_path) as doc_metrics:
+            requests.Session().get("https://viewer.acdh.oeaw.ac.at/viewer/sourcefile?id=bv_doc_id__1")
+        return "bv_doc_id__1.xml", doc_metrics
+
+    monkeypatch.setattr(refine_tei, "refine_document", refine_with_request)
+    tei_file_path, _, doc_metrics, _, http_requests = refine_tei.refine_file_in_worker("1_tei.xml", "7", {})
+    assert doc_metrics["http_requests"] == http_requests == 1
+    assert export_report.take_http_requests() == 0
+    with export_report.measure_stage("refine_tei") as documents:
+        documents.append(doc_metrics)
+        export_report.add_http_requests(http_requests)
+    assert export_report.load_report()["stages"]["refine_tei"]["http_requests"] == 1
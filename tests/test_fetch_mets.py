@@ -0,0 +1,204 @@
+import json
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+import requests
+
+import artifact_store
+import fetch_mets
+
+
+SESSION_ID = "F00D"
+LOGIN_RESPONSE = f"<trpUserLogin><sessionId>{SESSION_ID}</sessionId></trpUserLogin>".encode("utf-8")
+
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+
+    def __init__(self, body):
+        self.content = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTranskribus:
+    """answers the requests of fetch_mets for one collection of documents"""
+
+    def __init__(self, documents):
+        # # doc_id -> transcript timestamp
+        self.documents = documents
+        self.listed = {}
+        self.paths = []
+        self.failing = set()
+
+    def get(self, url, cookies=None, **kwargs):
+        path = url.removeprefix(fetch_mets.TRANSKRIBUS_BASE_URL)
+        # # the session id of the login is the only way in
+        if (cookies or {}).get("JSESSIONID") != SESSION_ID:
+            raise requests.HTTPError(f"401 Client Error: Unauthorized for {path}")
+        self.paths.append(path)
+        parts = path.strip("/").split("/")
+        if parts[-1] == "list":
+            return FakeResponse(
+                [
+                    {"docId": int(doc_id), "title": f"doc {doc_id}", **self.listed.get(doc_id, {})}
+                    for doc_id in self.documents
+                ]
+            )
+        doc_id = parts[2]
+        if doc_id in self.failing:
+            raise requests.ConnectionError(path)
+        if parts[-1] == "fulldoc":
+            transcript = {"tsId": 1, "timestamp": self.documents[doc_id]}
+            return FakeResponse(
+                {
+                    "md": {"docId": int(doc_id)},
+                    "pageList": {
+                        "pages": [
+                            {"pageId": 1, "pageNr": 1, "imgFileName": "a.jpg", "tsList": {"transcripts": [transcript]}}
+                        ]
+                    },
+                }
+            )
+        if parts[-1] == "imageNames":
+            return FakeResponse(b"a.jpg\nb.jpg")
+        return FakeResponse(
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<mets OBJID="{doc_id}" v="{self.documents[doc_id]}"/>'.encode(
+                "utf-8"
+            )
+        )
+
+    def fulldoc_requests(self):
+        return sorted(path.split("/")[3] for path in self.paths if path.endswith("/fulldoc"))
+
+
+
+
+@pytest.fixture
+def transkribus(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_mets, "METS_DIR", str(tmp_path / "mets"))
+    monkeypatch.setattr(fetch_mets, "FETCH_STATE_PATH", str(tmp_path / "mets" / "fetch_state.json"))
+    monkeypatch.setattr(artifact_store, "ARTIFACT_STORE_DIR", str(tmp_path / "artifacts"))
+    monkeypatch.setattr(fetch_mets.transkribus_rate_limiter, "interval", 0.0)
+    fake = FakeTranskribus({"1": 100, "2": 200})
+    with mock.patch.object(
+        requests.Session, "get", lambda session, url, **kwargs: fake.get(url, cookies=session.cookies, **kwargs)
+    ), mock.patch.object(
+        requests.Session, "post", lambda session, url, **kwargs: FakeResponse(LOGIN_RESPONSE)
+    ):
+        yield fake
+
+
+def fetch(collection_ids=("7",)):
+    state = fetch_mets.load_fetch_state()
+    fetch_mets.fetch_changed_documents(list(collection_ids), state, workers=2)
+    return fetch_mets.load_fetch_state()
+
+
+def test_requests_send_the_session_id_of_the_login(transkribus):
+    session = fetch_mets.login(requests.Session())
+    assert session.cookies.get("JSESSIONID") == SESSION_ID
+    fetch_mets.list_documents(session, "7")
+    with pytest.raises(requests.HTTPError, match="401"):
+        fetch_mets.list_documents(requests.Session(), "7")
+
+
+def test_unchanged_listing_skips_fulldoc(transkribus):
+    fetch()
+    assert transkribus.fulldoc_requests() == ["1", "2"]
+    transkribus.paths.clear()
+    fetch()
+    assert transkribus.fulldoc_requests() == []
+
+
+def test_changed_listing_fetches_changed_document(transkribus):
+    fetch()
+    transkribus.paths.clear()
+    transkribus.documents["2"] = 300
+    transkribus.listed["2"] = {"nrOfTranscribedLines": 5}
+    state = fetch()
+    assert transkribus.fulldoc_requests() == ["2"]
+    assert "/collections/7/2/mets" in transkribus.paths
+    assert "/collections/7/1/mets" not in transkribus.paths
+    assert state["7"]["2"]["last_modified"] == 300
+
+
+def test_old_check_requests_fulldoc_again(transkribus, monkeypatch):
+    fetch()
+    transkribus.paths.clear()
+    monkeypatch.setattr(fetch_mets, "FULLDOC_RECHECK_AGE", 0)
+    fetch()
+    assert transkribus.fulldoc_requests() == ["1", "2"]
+    assert not any(path.endswith("/mets") for path in transkribus.paths)
+
+
+def test_failed_document_keeps_the_state_of_the_others(transkribus):
+    transkribus.failing.add("2")
+    with pytest.raises(requests.ConnectionError):
+        fetch()
+    state = fetch_mets.load_fetch_state()
+    assert list(state["7"]) == ["1"]
+    transkribus.failing.clear()
+    transkribus.paths.clear()
+    fetch()
+    assert transkribus.fulldoc_requests() == ["2"]
+
+
+def test_full_download_replaces_stale_files(transkribus, monkeypatch):
+    fetch()
+    stale_tei = fetch_mets.get_document_path("7", "1", "_tei.xml")
+    artifact_store.write_artifact(stale_tei, b"<TEI/>")
+
+    class FakeClient:
+        def __init__(self, **kwargs):
+            pass
+
+        def collection_to_mets(self, collection_id, file_path):
+            os.makedirs(os.path.join(file_path, collection_id), exist_ok=True)
+            with open(os.path.join(file_path, collection_id, "1_mets.xml"), "wb") as outfile:
+                outfile.write(b'<mets v="new"/>')
+
+    module = types.ModuleType("transkribus_utils.transkribus_utils")
+    module.ACDHTranskribusUtils = FakeClient
+    monkeypatch.setitem(sys.modules, "transkribus_utils", types.ModuleType("transkribus_utils"))
+    monkeypatch.setitem(sys.modules, "transkribus_utils.transkribus_utils", module)
+    fetch_mets.fetch_all_collections(["7"])
+    assert not artifact_store.artifact_exists(stale_tei)
+    assert not artifact_store.artifact_exists(fetch_mets.get_document_path("7", "2", "_mets.xml"))
+    mets_path = fetch_mets.get_document_path("7", "1", "_mets.xml")
+    assert artifact_store.find_artifact(mets_path) == mets_path + ".gz"
+    with artifact_store.open_artifact(mets_path) as infile:
+        assert infile.read() == b'<mets v="new"/>'
+
+
+def read_document_files(collection_id, doc_id):
+    files = {}
+    for suffix in ("_mets.xml", "_image_name.xml"):
+        with artifact_store.open_artifact(fetch_mets.get_document_path(collection_id, doc_id, suffix)) as infile:
+            files[suffix] = infile.read()
+    return files
+
+
+def test_full_and_delta_downloads_write_the_same_files(transkribus, monkeypatch):
+    fetch()
+    delta_files = [read_document_files("7", doc_id) for doc_id in ("1", "2")]
+    monkeypatch.setattr(fetch_mets, "user", "user")
+    monkeypatch.setattr(fetch_mets, "pw", "pw")
+    # # collection_to_mets requests through requests.get and requests.post
+    with mock.patch.object(requests, "get", transkribus.get), mock.patch.object(
+        requests, "post", lambda url, **kwargs: FakeResponse(LOGIN_RESPONSE)
+    ):
+        fetch_mets.fetch_all_collections(["7"])
+    assert [read_document_files("7", doc_id) for doc_id in ("1", "2")] == delta_files
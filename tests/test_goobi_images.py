@@ -0,0 +1,111 @@
+import io
+import pickle
+
+import pytest
+
+import goobi_images
+
+GOOBI_METS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <mets:fileSec>
+    <mets:fileGrp USE="DEFAULT">
+      <mets:file><mets:FLocat LOCTYPE="URL" xlink:href="https://viewer/IMG_10.jpg"/></mets:file>
+      <mets:file><mets:FLocat LOCTYPE="URL" xlink:href="https://viewer/IMG_2.jpg"/></mets:file>
+      <mets:file><mets:FLocat LOCTYPE="OTHER" xlink:href="https://viewer/IMG_3.jpg"/></mets:file>
+    </mets:fileGrp>
+    <mets:fileGrp USE="THUMBS">
+      <mets:file><mets:FLocat LOCTYPE="URL" xlink:href="https://viewer/IMG_4.jpg"/></mets:file>
+    </mets:fileGrp>
+  </mets:fileSec>
+</mets:mets>
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None):
+        self.status_code = status_code
+        self.raw = io.BytesIO(body)
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise ValueError(f"status {self.status_code}")
+
+
+class FakeGoobi:
+    """answers the METS requests of goobi_images, 304 if the etag matches"""
+
+    def __init__(self, failing=()):
+        self.requests = []
+        self.failing = set(failing)
+
+    def get(self, url, headers=None, **kwargs):
+        bv_doc_id = url.split("id=")[-1]
+        self.requests.append((bv_doc_id, dict(headers or {})))
+        if bv_doc_id in self.failing:
+            return FakeResponse(500)
+        if (headers or {}).get("If-None-Match") == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, GOOBI_METS, {"ETag": '"v1"'})
+
+
+@pytest.fixture
+def goobi(tmp_path, monkeypatch):
+    fake_goobi = FakeGoobi()
+    monkeypatch.setattr(goobi_images, "GOOBI_CACHE_DIR", str(tmp_path / "goobi"))
+    monkeypatch.setattr(goobi_images, "GOOBI_OFFLINE", False)
+    monkeypatch.setattr(goobi_images, "prefetched_image_names", {})
+    monkeypatch.setattr(goobi_images, "get_goobi_session", lambda: fake_goobi)
+    monkeypatch.setattr(goobi_images.goobi_rate_limiter, "wait", lambda url: None)
+    return fake_goobi
+
+
+def test_parse_image_names_reads_the_url_links_of_the_default_group():
+    image_names = goobi_images.parse_image_names(io.BytesIO(GOOBI_METS))
+    assert goobi_images.sort_image_names(image_names) == ["IMG_2", "IMG_10"]
+
+
+def test_cached_list_is_served_without_a_request_until_it_expires(goobi, monkeypatch):
+    assert goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1") == ["IMG_2", "IMG_10"]
+    assert goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1") == ["IMG_2", "IMG_10"]
+    assert goobi.requests == [("bv_doc_id__1", {})]
+    # # an expired entry is revalidated, the 304 keeps the cached list
+    checked_at = goobi_images.read_cache_entry("bv_doc_id__1")["checked_at"]
+    monkeypatch.setattr(goobi_images, "GOOBI_CACHE_TTL", 0)
+    assert goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1") == ["IMG_2", "IMG_10"]
+    assert goobi.requests[1] == ("bv_doc_id__1", {"If-None-Match": '"v1"'})
+    assert goobi_images.read_cache_entry("bv_doc_id__1")["checked_at"] >= checked_at
+
+
+def test_offline_mode_uses_only_the_cache(goobi, monkeypatch):
+    goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1")
+    monkeypatch.setattr(goobi_images, "GOOBI_OFFLINE", True)
+    monkeypatch.setattr(goobi_images, "GOOBI_CACHE_TTL", 0)
+    assert goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1") == ["IMG_2", "IMG_10"]
+    with pytest.raises(ValueError, match="offline mode"):
+        goobi_images.get_img_names_from_goobi_mets("bv_doc_id__2")
+    assert len(goobi.requests) == 1
+
+
+def test_prefetch_keeps_errors_and_answers_later_calls_from_memory(goobi):
+    goobi.failing.add("bv_doc_id__2")
+    goobi_images.prefetch_img_names(["bv_doc_id__1", "bv_doc_id__2", "bv_doc_id__1", None], workers=2)
+    assert sorted(bv_doc_id for bv_doc_id, headers in goobi.requests) == [
+        "bv_doc_id__1",
+        "bv_doc_id__2",
+    ]
+    assert goobi_images.get_img_names_from_goobi_mets("bv_doc_id__1") == ["IMG_2", "IMG_10"]
+    with pytest.raises(ValueError, match="status 500"):
+        goobi_images.get_img_names_from_goobi_mets("bv_doc_id__2")
+    # # a second prefetch and the pool processes need no further request
+    goobi_images.prefetch_img_names(["bv_doc_id__1", "bv_doc_id__2"])
+    assert len(goobi.requests) == 2
+    exported = pickle.loads(pickle.dumps(goobi_images.export_prefetched_img_names()))
+    assert exported["bv_doc_id__1"] == ["IMG_2", "IMG_10"]
+    assert isinstance(exported["bv_doc_id__2"], ValueError)
@@ -0,0 +1,18 @@
+import http_utils
+
+
+def test_rate_limiter_spaces_requests_per_host(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(http_utils.time, "monotonic", lambda: 100.0)
+    monkeypatch.setattr(http_utils.time, "sleep", sleeps.append)
+    rate_limiter = http_utils.HostRateLimiter(4)
+    for url in ("https://a/1", "https://a/2", "https://b/1", "https://a/3"):
+        rate_limiter.wait(url)
+    assert sleeps == [0.25, 0.5]
+
+
+def test_session_pools_connections_and_retries():
+    adapter = http_utils.build_session(pool_size=8, retries=2).get_adapter("https://viewer/")
+    assert adapter._pool_maxsize == 8
+    assert adapter.max_retries.total == 2
+    assert 503 in adapter.max_retries.status_forcelist
@@ -0,0 +1,101 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import http_utils
+import metadata_store
+from conftest import REPO_DIR
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(data).encode("utf-8")
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeGithub:
+    """serves the dumps, 304 for a request with the current etag"""
+
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append((url.rsplit("/", 1)[-1], dict(headers or {})))
+        if (headers or {}).get("If-None-Match") == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, self.dumps[url.rsplit("/", 1)[-1]], {"ETag": '"v1"'})
+
+
+@pytest.fixture
+def github(tmp_path, monkeypatch):
+    fake_github = FakeGithub({"project_data.json": {"1": {"title": "bv"}}})
+    monkeypatch.setattr(metadata_store, "METADATA_DIR", str(tmp_path))
+    monkeypatch.setattr(metadata_store, "METADATA_OFFLINE", False)
+    monkeypatch.setattr(metadata_store, "loaded_dumps", {})
+    monkeypatch.setattr(metadata_store, "built_indexes", {})
+    monkeypatch.setattr(http_utils, "build_session", lambda **kwargs: fake_github)
+    return fake_github
+
+
+def test_scripts_import_without_reading_a_dump(tmp_path):
+    env = dict(
+        os.environ,
+        METADATA_DIR=str(tmp_path),
+        METADATA_OFFLINE="1",
+        PYTHONPATH=os.path.join(REPO_DIR, "scripts"),
+    )
+    subprocess.run(
+        [sys.executable, "-c", "import refine_tei, generate_image_only_tei, create_sorter_val, pipeline"],
+        cwd=REPO_DIR,
+        env=env,
+        check=True,
+    )
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_dump_is_loaded_once_and_revalidated_after_the_ttl(github, monkeypatch):
+    assert metadata_store.get_project_metadata() == {"title": "bv"}
+    assert metadata_store.get_project_metadata() == {"title": "bv"}
+    assert github.requests == [("project_data.json", {})]
+    # # a new process reads the local copy while it is fresh
+    monkeypatch.setattr(metadata_store, "loaded_dumps", {})
+    assert metadata_store.get_project_metadata() == {"title": "bv"}
+    assert len(github.requests) == 1
+    monkeypatch.setattr(metadata_store, "loaded_dumps", {})
+    monkeypatch.setattr(metadata_store, "METADATA_CACHE_TTL", 0)
+    assert metadata_store.get_project_metadata() == {"title": "bv"}
+    assert github.requests[1] == ("project_data.json", {"If-None-Match": '"v1"'})
+
+
+def test_offline_mode_needs_a_local_copy(github, monkeypatch):
+    monkeypatch.setattr(metadata_store, "METADATA_OFFLINE", True)
+    with pytest.raises(ValueError, match="offline mode"):
+        metadata_store.get_project_metadata()
+    assert github.requests == []
+
+
+def test_documents_are_indexed_by_transkribus_ids(corpus_metadata):
+    rows = metadata_store.get_document_rows().values()
+    assert sum(len(documents) for documents in corpus_metadata.values()) == sum(
+        1 for row in rows if row["transkribus_col_id"] and row["transkribus_col_id"].strip()
+    )
+    row = corpus_metadata["195363"]["1529221"]
+    assert metadata_store.get_document_by_bv_id(row["bv_id"]) is row
+    assert metadata_store.get_documents_by_transkribus_id() is corpus_metadata
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+from lxml import etree
+
+import patch_page_xml
+
+PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<PcGts xmlns="http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15">
+  <Page imageFilename="{name}.jpg">
+    <TextRegion id="r1" custom="readingOrder {{index:0;}}"/>
+    <TextRegion id="r2"><TextLine id="l1"/></TextRegion>
+  </Page>
+</PcGts>
+"""
+
+
+def make_mets(hrefs, mets_version="2020-01-01T00:00:00"):
+    files = "".join(
+        f'<mets:file ID="PAGEXML_{number}" MIMETYPE="application/xml">'
+        f'<mets:FLocat LOCTYPE="URL" xlink:href="{href}"/></mets:file>'
+        for number, href in enumerate(hrefs, 1)
+    )
+    return (
+        '<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">'
+        f'<mets:metsHdr LASTMODDATE="{mets_version}"/>'
+        f'<mets:fileSec><mets:fileGrp ID="PAGEXML">{files}</mets:fileGrp></mets:fileSec>'
+        "</mets:mets>"
+    ).encode("utf-8")
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTranskribus:
+    def __init__(self):
+        self.requests = []
+
+    def get(self, href, **kwargs):
+        self.requests.append(href)
+        return FakeResponse(PAGE.format(name=href.rsplit("/", 1)[-1]).encode("utf-8"))
+
+
+@pytest.fixture
+def transkribus(monkeypatch):
+    fake_transkribus = FakeTranskribus()
+    monkeypatch.setattr(patch_page_xml, "build_session", lambda **kwargs: fake_transkribus)
+    return fake_transkribus
+
+
+def test_patch_adds_custom_only_where_it_is_missing():
+    content = PAGE.format(name="p1").encode("utf-8")
+    patched_content, patched = patch_page_xml.patch_page_xml(content)
+    assert patched == 1
+    assert patched_content == content.replace(b'<TextRegion id="r2"', b'<TextRegion custom="" id="r2"')
+    assert patch_page_xml.patch_page_xml(patched_content) == (patched_content, 0)
+
+
+def test_patch_falls_back_to_the_tree_for_tags_in_comments():
+    content = PAGE.format(name="p1").replace("<Page", '<!-- <TextRegion id="x"> --><Page').encode("utf-8")
+    patched_content, patched = patch_page_xml.patch_page_xml(content)
+    assert patched == 1
+    regions = etree.fromstring(patched_content).iter(f"{{{patch_page_xml.PAGEXML_NS}}}TextRegion")
+    assert [region.get("custom") for region in regions] == ["readingOrder {index:0;}", ""]
+
+
+def test_batch_writes_local_pages_and_reuses_the_page_cache(transkribus, tmp_path):
+    mets_path = tmp_path / "mets" / "196429" / "1529271_mets.xml"
+    mets_path.parent.mkdir(parents=True)
+    mets_path.write_bytes(make_mets(["https://transkribus/p1", "https://transkribus/p2"]))
+    cache_dir = str(tmp_path / "cache")
+    output_dir = tmp_path / "patched"
+    local_mets = patch_page_xml.process_mets_batch([str(mets_path)], str(output_dir), 2, cache_dir)
+    output_mets, patched = local_mets[str(mets_path)]
+    assert patched == 2
+    assert output_mets == str(output_dir / "196429-1529271" / "1529271_mets.xml")
+    hrefs = [
+        flocat.get(f"{{{patch_page_xml.XLINK_NS}}}href")
+        for flocat in etree.parse(output_mets).iter(f"{{{patch_page_xml.METS_NS}}}FLocat")
+    ]
+    assert hrefs == [
+        f"file://{os.path.abspath(output_dir / '196429-1529271' / name)}"
+        for name in ("PAGEXML_1.xml", "PAGEXML_2.xml")
+    ]
+    assert sorted(transkribus.requests) == ["https://transkribus/p1", "https://transkribus/p2"]
+    # # a re-run is served from the cache, a newer METS fetches its pages again
+    assert patch_page_xml.process_mets_batch([str(mets_path)], str(output_dir), 2, cache_dir) == local_mets
+    assert len(transkribus.requests) == 2
+    mets_path.write_bytes(make_mets(["https://transkribus/p1"], "2021-01-01T00:00:00"))
+    patch_page_xml.process_mets_batch([str(mets_path)], str(output_dir), 2, cache_dir)
+    assert transkribus.requests[2:] == ["https://transkribus/p1"]
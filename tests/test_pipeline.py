@@ -0,0 +1,63 @@
+import os
+import queue
+import threading
+
+import pytest
+
+import fetch_mets
+import pipeline
+from conftest import CORPUS_DIR, CORPUS_DOCUMENTS, read_expected_edition
+
+
+def test_refine_stage_refines_the_documents_as_they_arrive(refine_corpus, monkeypatch):
+    monkeypatch.setattr(fetch_mets, "METS_DIR", CORPUS_DIR)
+    monkeypatch.setattr(pipeline, "stage_errors", [])
+    inbox = queue.Queue()
+    for transkribus_collection_id, transkribus_doc_id in CORPUS_DOCUMENTS:
+        inbox.put(pipeline.Document(transkribus_collection_id, transkribus_doc_id))
+    inbox.put(pipeline.DONE)
+    goobi_thread = threading.Thread(target=lambda: None)
+    goobi_thread.start()
+    pipeline.refine_stage(inbox, None, goobi_thread, 1, False, [])
+    for transkribus_collection_id, transkribus_doc_id in CORPUS_DOCUMENTS:
+        bv_doc_id = refine_corpus[transkribus_collection_id][transkribus_doc_id]["bv_id"]
+        with open(os.path.join(pipeline.refine_tei.TEI_DIR, bv_doc_id + ".xml"), "rb") as infile:
+            assert infile.read() == read_expected_edition(bv_doc_id)
+
+
+def test_failed_stage_still_logs_and_validates(monkeypatch):
+    calls = []
+
+    def run_failing_pipeline(*args):
+        raise RuntimeError("stage fetch_mets failed")
+
+    monkeypatch.setattr(pipeline, "run_pipeline", run_failing_pipeline)
+    monkeypatch.setattr(pipeline.refine_tei, "log_nonvalid_files", lambda: calls.append("refine_tei"))
+    monkeypatch.setattr(
+        pipeline.generate_image_only_tei, "log_nonvalid_files", lambda: calls.append("image_only")
+    )
+    monkeypatch.setattr(
+        pipeline.validate_tei, "validate_all_files", lambda **kwargs: calls.append("validate_tei")
+    )
+    with pytest.raises(RuntimeError):
+        pipeline.run_export()
+    assert calls == ["refine_tei", "image_only", "validate_tei"]
+
+
+def test_failed_validation_does_not_hide_the_stage_error(monkeypatch):
+    def run_failing_pipeline(*args):
+        raise RuntimeError("stage fetch_mets failed")
+
+    def validate_missing_schema(**kwargs):
+        raise FileNotFoundError("TEI schema not found")
+
+    monkeypatch.setattr(pipeline, "run_pipeline", run_failing_pipeline)
+    monkeypatch.setattr(pipeline.refine_tei, "log_nonvalid_files", lambda: None)
+    monkeypatch.setattr(pipeline.generate_image_only_tei, "log_nonvalid_files", lambda: None)
+    monkeypatch.setattr(pipeline.validate_tei, "validate_all_files", validate_missing_schema)
+    with pytest.raises(RuntimeError, match="stage fetch_mets failed"):
+        pipeline.run_export()
+    # # after a successful pipeline the error of the validation fails the run
+    monkeypatch.setattr(pipeline, "run_pipeline", lambda *args: None)
+    with pytest.raises(FileNotFoundError):
+        pipeline.run_export()
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+
+from conftest import CORPUS_DIR, CORPUS_DOCUMENTS, REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+
+import refine_stages  # noqa: E402
+import refine_tei  # noqa: E402
+
+
+def test_benchmark_times_the_stages_of_the_baseline(refine_corpus):
+    with open(refine_stages.BASELINE_PATH, "r", encoding="utf-8") as infile:
+        baseline_times = json.load(infile)["seconds"]
+    for transkribus_collection_id, transkribus_doc_id in CORPUS_DOCUMENTS:
+        times = refine_stages.benchmark_document(
+            refine_tei,
+            os.path.join(CORPUS_DIR, transkribus_collection_id, f"{transkribus_doc_id}_tei.xml.gz"),
+            refine_corpus[transkribus_collection_id][transkribus_doc_id],
+            1,
+        )
+        doc_key = f"{transkribus_collection_id}/{transkribus_doc_id}"
+        assert sorted(times) == sorted(baseline_times[doc_key])
+    assert refine_tei.STAGE_HOOK is None
+
+
+def test_share_regression_needs_the_factor_and_the_delta():
+    baseline_times = {"a/1": {"parse": 0.5, "write": 0.5}, "a/2": {"parse": 0.9, "write": 0.1}}
+    # # write: 0.3 -> 0.55 of the document time
+    results = {"a/1": {"parse": 0.4, "write": 0.6}, "a/2": {"parse": 0.5, "write": 0.5}}
+    assert [
+        stage_name
+        for stage_name, _, _ in refine_stages.find_share_regressions(
+            results, baseline_times, ["a/1", "a/2"], 1.5, 0.02
+        )
+    ] == ["write"]
+    assert refine_stages.find_share_regressions(results, baseline_times, ["a/1", "a/2"], 2.0, 0.02) == []
+    assert refine_stages.find_share_regressions(results, baseline_times, ["a/1", "a/2"], 1.5, 0.3) == []
+
+
+def test_time_regression_is_scaled_to_the_machine():
+    baseline_times = {"a/1": {"parse": 0.1, "write": 0.1}}
+    results = {"a/1": {"parse": 0.2, "write": 0.35}}
+    # # a machine half as fast only regresses in write
+    assert [
+        stage_name
+        for stage_name, _, _ in refine_stages.find_time_regressions(
+            results, baseline_times, ["a/1"], 2.0, 1.5, 0.01
+        )
+    ] == ["write"]
+    assert [
+        stage_name
+        for stage_name, _, _ in refine_stages.find_time_regressions(
+            results, baseline_times, ["a/1"], 1.0, 1.5, 0.01
+        )
+    ] == ["parse", "write", "all stages"]
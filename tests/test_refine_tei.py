@@ -0,0 +1,190 @@
+import os
+
+import lxml.etree as ET
+import pytest
+from acdh_tei_pyutils.tei import TeiReader
+
+import refine_tei
+from structure_rules import RULE_SET
+from conftest import (
+    CHANGE_DATE,
+    CORPUS_DIR,
+    CORPUS_DOCUMENTS,
+    FIXTURES_DIR,
+    read_expected_edition,
+)
+
+
+def read_fixture(file_name):
+    with open(os.path.join(FIXTURES_DIR, file_name), "rb") as infile:
+        return infile.read()
+
+
+@pytest.mark.parametrize("transkribus_collection_id,transkribus_doc_id", CORPUS_DOCUMENTS)
+def test_corpus_editions_match_the_baseline(refine_corpus, transkribus_collection_id, transkribus_doc_id):
+    doc_metadata = refine_corpus[transkribus_collection_id][transkribus_doc_id]
+    doc = refine_tei.get_xml_doc(
+        os.path.join(CORPUS_DIR, transkribus_collection_id, f"{transkribus_doc_id}_tei.xml.gz")
+    )
+    tei_file_path = refine_tei.create_new_xml_data(
+        doc, refine_tei.resolve_types(dict(doc_metadata)), CHANGE_DATE
+    )
+    with open(tei_file_path, "rb") as infile:
+        assert infile.read() == read_expected_edition(doc_metadata["bv_id"])
+
+
+def test_clean_up_elements_drops_leading_lb_after_nested_empty_p():
+    # # the empty p inside goes first, then the lb is the first child and goes, too
+    doc = TeiReader(os.path.join(FIXTURES_DIR, "nested_empty_p.xml"))
+    refine_tei.clean_up_elements(doc)
+    assert ET.tostring(doc.tree, xml_declaration=True, encoding="UTF-8") == read_fixture(
+        "nested_empty_p.expected.xml"
+    )
+
+
+def test_input_hash_covers_the_goobi_image_names(corpus_metadata, monkeypatch):
+    doc_metadata = corpus_metadata["195363"]["1529221"]
+    xml_file_path = os.path.join(CORPUS_DIR, "195363", "1529221_tei.xml.gz")
+    monkeypatch.setattr(refine_tei, "get_img_names_from_goobi_mets", lambda bv_doc_id: ["IMG_1"])
+    input_hash = refine_tei.compute_input_hash(xml_file_path, doc_metadata)
+    assert refine_tei.compute_input_hash(xml_file_path, doc_metadata) == input_hash
+    monkeypatch.setattr(
+        refine_tei, "get_img_names_from_goobi_mets", lambda bv_doc_id: ["IMG_1", "IMG_2"]
+    )
+    assert refine_tei.compute_input_hash(xml_file_path, doc_metadata) != input_hash
+
+
+def refine_corpus_document(metadata, change_date):
+    transkribus_collection_id, transkribus_doc_id = CORPUS_DOCUMENTS[0]
+    doc = refine_tei.get_xml_doc(
+        os.path.join(CORPUS_DIR, transkribus_collection_id, f"{transkribus_doc_id}_tei.xml.gz")
+    )
+    doc_metadata = metadata[transkribus_collection_id][transkribus_doc_id]
+    return refine_tei.create_new_xml_data(doc, refine_tei.resolve_types(dict(doc_metadata)), change_date)
+
+
+def test_unchanged_edition_keeps_its_change_date(refine_corpus):
+    transkribus_collection_id, transkribus_doc_id = CORPUS_DOCUMENTS[0]
+    bv_doc_id = refine_corpus[transkribus_collection_id][transkribus_doc_id]["bv_id"]
+    tei_file_path = refine_corpus_document(refine_corpus, CHANGE_DATE)
+    assert refine_corpus_document(refine_corpus, "2024-05-06") == tei_file_path
+    assert refine_tei.edition_bytes_written.pop(tei_file_path) == 0
+    with open(tei_file_path, "rb") as infile:
+        assert infile.read() == read_expected_edition(bv_doc_id)
+
+
+def test_changed_edition_gets_the_new_change_date(refine_corpus):
+    tei_file_path = refine_corpus_document(refine_corpus, CHANGE_DATE)
+    with open(tei_file_path, "rb") as infile:
+        old_content = infile.read()
+    with open(tei_file_path, "wb") as outfile:
+        outfile.write(old_content.replace(b"</body>", b"<p>old text</p></body>"))
+    refine_corpus_document(refine_corpus, "2024-05-06")
+    with open(tei_file_path, "rb") as infile:
+        assert infile.read() == old_content.replace(
+            f'<change when="{CHANGE_DATE}"'.encode(), b'<change when="2024-05-06"'
+        )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_all_files_matches_the_baseline_serial_and_in_a_pool(
+    refine_corpus, monkeypatch, workers
+):
+    # # the image names come from get_fake_img_names, forked workers inherit it
+    monkeypatch.setattr(refine_tei, "prefetch_img_names", lambda bv_doc_ids: None)
+    refine_tei.process_all_files(workers=workers)
+    for transkribus_collection_id, transkribus_doc_id in CORPUS_DOCUMENTS:
+        bv_doc_id = refine_corpus[transkribus_collection_id][transkribus_doc_id]["bv_id"]
+        with open(os.path.join(refine_tei.TEI_DIR, f"{bv_doc_id}.xml"), "rb") as infile:
+            assert infile.read() == read_expected_edition(bv_doc_id)
+    assert sorted(os.listdir(refine_tei.TEI_DIR)) == sorted(
+        f"{refine_corpus[collection_id][doc_id]['bv_id']}.xml"
+        for collection_id, doc_id in CORPUS_DOCUMENTS
+    )
+
+
+def test_make_article_divs_matches_the_baseline_segmentation():
+    # # heads on the level of the main div, nested in an ab, and as first child
+    doc = TeiReader(os.path.join(FIXTURES_DIR, "article_divs.xml"))
+    article_divs = refine_tei.make_article_divs(doc, RULE_SET)
+    assert [div.get("type") for div in article_divs] == ["article"] * 3
+    assert ET.tostring(doc.tree, xml_declaration=True, encoding="UTF-8") == read_fixture(
+        "article_divs.expected.xml"
+    )
+
+
+def test_grafting_gives_the_document_rendering_the_strings_gave(corpus_metadata, monkeypatch):
+    import metadata_store
+
+    monkeypatch.setattr(refine_tei, "PROJECT_MD", metadata_store.get_project_metadata())
+    source = TeiReader(
+        '<TEI xmlns="http://www.tei-c.org/ns/1.0"><facsimile xml:id="f">\n<surface><graphic url="IMG_1"/>'
+        '</surface>\n</facsimile><text><body><div type="main">\n<p>a<lb/>b<hi></hi></p>'
+        '<pb n="1"/>tail\n</div>\n</body></text></TEI>'
+    )
+    body_node = refine_tei.body_xpath(source.tree)[0]
+    faksimile_element = refine_tei.facsimile_xpath(source.tree)[0]
+    # # as the cleanup passes leave it
+    body_node.find(".//{http://www.tei-c.org/ns/1.0}hi").text = ""
+    context = {
+        "project_md": refine_tei.PROJECT_MD,
+        "doc_metadata": refine_tei.resolve_types(dict(corpus_metadata["195363"]["1529221"])),
+        "current_date": CHANGE_DATE,
+    }
+    # # what create_new_xml_data of the baseline commit did
+    rendered_doc = refine_tei.get_xml_doc(
+        refine_tei.template.render(
+            context,
+            body=ET.tostring(body_node).decode("utf-8").replace('xmlns="http://www.tei-c.org/ns/1.0"', ""),
+            faksimile=ET.tostring(faksimile_element).decode("utf-8"),
+        )
+    )
+    grafted_doc = refine_tei.get_xml_doc(
+        refine_tei.template.render(
+            context, body=refine_tei.BODY_PLACEHOLDER, faksimile=refine_tei.FAKSIMILE_PLACEHOLDER
+        )
+    )
+    refine_tei.graft_body_and_faksimile(grafted_doc, body_node, faksimile_element)
+    assert ET.tostring(grafted_doc.tree) == ET.tostring(rendered_doc.tree)
+
+
+def test_low_memory_mode_writes_the_baseline_editions(refine_corpus, monkeypatch):
+    monkeypatch.setattr(refine_tei, "LOW_MEMORY", True)
+    released = []
+    release_tree = refine_tei.release_tree
+    monkeypatch.setattr(refine_tei, "release_tree", lambda doc: released.append(release_tree(doc)))
+    for transkribus_collection_id, transkribus_doc_id in CORPUS_DOCUMENTS:
+        doc_metadata = refine_corpus[transkribus_collection_id][transkribus_doc_id]
+        tei_file_path, _ = refine_tei.refine_document(
+            os.path.join(CORPUS_DIR, transkribus_collection_id, f"{transkribus_doc_id}_tei.xml.gz"),
+            transkribus_collection_id,
+            doc_metadata,
+        )
+        with open(tei_file_path, "rb") as infile:
+            assert infile.read() == read_expected_edition(doc_metadata["bv_id"])
+    # # the source and the new tree of every document
+    assert len(released) == 2 * len(CORPUS_DOCUMENTS)
+
+
+def test_memory_profile_records_the_peak_of_every_stage(refine_corpus, tmp_path, monkeypatch):
+    import tracemalloc
+
+    import export_report
+
+    monkeypatch.setattr(export_report, "REPORT_PATH", str(tmp_path / "export_report.json"))
+    monkeypatch.setattr(export_report, "MEMORY_PROFILE", True)
+    transkribus_collection_id, transkribus_doc_id = CORPUS_DOCUMENTS[0]
+    try:
+        _, doc_metrics = refine_tei.refine_document(
+            os.path.join(CORPUS_DIR, transkribus_collection_id, f"{transkribus_doc_id}_tei.xml.gz"),
+            transkribus_collection_id,
+            refine_corpus[transkribus_collection_id][transkribus_doc_id],
+        )
+    finally:
+        tracemalloc.stop()
+    assert "write_xml_doc" in doc_metrics["stages"]
+    assert doc_metrics["peak_traced_kb"] >= max(
+        stage["peak_traced_kb"] for stage in doc_metrics["stages"].values()
+    ) > 0
+    for stage_metrics in doc_metrics["stages"].values():
+        assert stage_metrics["rss_kb"] > 0
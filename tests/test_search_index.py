@@ -0,0 +1,95 @@
+import sqlite3
+
+import pytest
+
+import search_index
+
+EDITION = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+<teiHeader><fileDesc><publicationStmt><idno type="bv_data_set">Datenset A</idno></publicationStmt>
+<sourceDesc><msDesc><history><origin notBefore-iso="1920-10-01"/></history></msDesc></sourceDesc>
+</fileDesc></teiHeader>
+<text><body><div type="main">
+<p>Präambel</p>
+<div type="article">
+<head>Artikel 1.</head>
+<p type="legal_section"><label>(1)</label> Österreich ist eine <hi>demokratische</hi> Republik.</p>
+<p type="legal_section"><label>(2)</label> Ihr Recht geht vom {word} aus.</p>
+</div>
+</div></body></text>
+</TEI>
+"""
+
+
+@pytest.fixture
+def editions(tmp_path, monkeypatch):
+    tei_dir = tmp_path / "editions_source"
+    tei_dir.mkdir()
+    monkeypatch.setattr(search_index, "TEI_DIR", str(tei_dir))
+    return tei_dir
+
+
+def write_edition(tei_dir, bv_id, word="Volk"):
+    tei_file_path = tei_dir / f"{bv_id}.xml"
+    tei_file_path.write_text(EDITION.format(word=word), encoding="utf-8")
+    return str(tei_file_path)
+
+
+def count_passages(index_path):
+    with sqlite3.connect(index_path) as connection:
+        return dict(connection.execute("SELECT bv_id, count(*) FROM passages GROUP BY bv_id"))
+
+
+def test_articles_and_legal_sections_are_read_with_the_edition_data(editions):
+    bv_id, passages = search_index.read_passages(write_edition(editions, "bv_doc_id__1"))
+    assert bv_id == "bv_doc_id__1"
+    assert passages == [
+        (
+            "bv_doc_id__1",
+            "Datenset A",
+            "1920-10-01",
+            "article",
+            "Artikel 1.",
+            None,
+            "(1) Österreich ist eine demokratische Republik. (2) Ihr Recht geht vom Volk aus.",
+        ),
+        (
+            "bv_doc_id__1",
+            "Datenset A",
+            "1920-10-01",
+            "legal_section",
+            "Artikel 1.",
+            "(1)",
+            "Österreich ist eine demokratische Republik.",
+        ),
+        ("bv_doc_id__1", "Datenset A", "1920-10-01", "legal_section", "Artikel 1.", "(2)", "Ihr Recht geht vom Volk aus."),
+    ]
+
+
+def test_index_follows_changed_and_removed_editions(editions, tmp_path, monkeypatch):
+    # # the folder of the index is created with it, like ./cache in the workflow
+    index_path = str(tmp_path / "cache" / "search_index.sqlite")
+    tei_file_paths = [write_edition(editions, "bv_doc_id__1"), write_edition(editions, "bv_doc_id__2")]
+    search_index.update_index(tei_file_paths, index_path)
+    assert count_passages(index_path) == {"bv_doc_id__1": 3, "bv_doc_id__2": 3}
+    results = search_index.search("demokratisch*", index_path)
+    assert sorted((bv_id, kind, section_label) for bv_id, _, kind, _, section_label, _ in results) == [
+        ("bv_doc_id__1", "article", None),
+        ("bv_doc_id__1", "legal_section", "(1)"),
+        ("bv_doc_id__2", "article", None),
+        ("bv_doc_id__2", "legal_section", "(1)"),
+    ]
+    read_editions = []
+    read_passages = search_index.read_passages
+    monkeypatch.setattr(
+        search_index,
+        "read_passages",
+        lambda tei_file_path: read_editions.append(tei_file_path) or read_passages(tei_file_path),
+    )
+    write_edition(editions, "bv_doc_id__2", "Bund")
+    (editions / "bv_doc_id__1.xml").unlink()
+    search_index.update_index(tei_file_paths, index_path)
+    assert read_editions == [tei_file_paths[1]]
+    assert count_passages(index_path) == {"bv_doc_id__2": 3}
+    assert search_index.search("Volk", index_path) == []
+    assert [row[0] for row in search_index.search('"vom Bund"', index_path)] == ["bv_doc_id__2"] * 2
@@ -0,0 +1,31 @@
+import pytest
+
+import structure_rules
+
+
+def test_rule_set_matches_heads_and_legal_sections():
+    rule_set = structure_rules.RuleSet(
+        (
+            structure_rules.StructureRule(
+                "paragraph", structure_rules.SECTION_HEAD, r"§ *[0-9]+\.?$", marker="§", type_val="paragraph"
+            ),
+            structure_rules.LEGAL_SECTION_RULE,
+        )
+    )
+    assert rule_set.match_head("§ 4.").name == "paragraph"
+    assert rule_set.match_head("Art. 4") is None
+    assert rule_set.match_start("3. Die Länder").name == "legal_section"
+
+
+@pytest.mark.parametrize(
+    "text, rule_name",
+    [("Art. 4", "article"), ("Artikel IV.", "article"), ("Artikel 4 der Verfassung", None), ("Beschluss", None)],
+)
+def test_article_heads(text, rule_name):
+    rule = structure_rules.RULE_SET.match_head(text)
+    assert (rule.name if rule else None) == rule_name
+
+
+def test_numbered_text_starts_a_legal_section():
+    assert structure_rules.RULE_SET.match_start("(2) Die Länder").name == "legal_section"
+    assert structure_rules.RULE_SET.match_start("1920") is None
@@ -0,0 +1,73 @@
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import REPO_DIR
+
+# # stands in for saxon: transforms a file or a directory of files, records its
+# # calls and, in a batch, fails the METS files named in FAILING_IN_BATCH
+FAKE_JAVA = """#!{python}
+import json, os, sys
+args = dict(arg[1:].split(":", 1) for arg in sys.argv[1:] if arg.startswith(("-s:", "-o:", "-threads:")))
+with open(os.environ["JAVA_LOG"], "a") as log:
+    log.write(json.dumps(args) + "\\n")
+def transform(source, output):
+    with open(source) as infile, open(output, "w") as outfile:
+        outfile.write("<TEI>" + infile.read() + "</TEI>")
+if os.path.isdir(args["s"]):
+    for name in os.listdir(args["s"]):
+        if name not in os.environ["FAILING_IN_BATCH"].split():
+            transform(os.path.join(args["s"], name), os.path.join(args["o"], name))
+else:
+    transform(args["s"], args["o"])
+"""
+
+
+def write_mets(path, doc_id):
+    with open(path, "w", encoding="utf-8") as outfile:
+        outfile.write(f'<mets xmlns="http://www.loc.gov/METS/" OBJID="{doc_id}"/>')
+
+
+def read_tei(path):
+    with gzip.open(path, "rt", encoding="utf-8") as infile:
+        return infile.read()
+
+
+def test_one_saxon_call_per_collection_and_single_runs_for_failures(tmp_path):
+    shutil.copytree(os.path.join(REPO_DIR, "scripts"), tmp_path / "scripts")
+    # # only the xslt stage is looked at
+    (tmp_path / "scripts" / "refine_tei.py").write_text("")
+    (tmp_path / "page2tei").mkdir()
+    (tmp_path / "page2tei" / "page2tei-0.xsl").write_text("<xsl/>")
+    for collection_id, doc_ids in (("100", ("1", "2", "3")), ("200", ("4",))):
+        (tmp_path / "mets" / collection_id).mkdir(parents=True)
+        for doc_id in doc_ids:
+            write_mets(tmp_path / "mets" / collection_id / f"{doc_id}_mets.xml", doc_id)
+    # # document 3 was transformed before, its TEI is in the artifact store
+    with gzip.open(tmp_path / "mets" / "100" / "3_tei.xml.gz", "wt") as outfile:
+        outfile.write("<TEI>old</TEI>")
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "java").write_text(FAKE_JAVA.format(python=sys.executable))
+    (bin_dir / "java").chmod(0o755)
+    java_log = tmp_path / "java_log.jsonl"
+    env = dict(
+        os.environ,
+        PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+        JAVA_LOG=str(java_log),
+        FAILING_IN_BATCH="2_mets.xml",
+        SAXON_THREADS="2",
+        EXPORT_REPORT_PATH="",
+    )
+    subprocess.run(["bash", "scripts/transform.sh"], cwd=tmp_path, env=env, check=True, capture_output=True)
+    calls = [json.loads(line) for line in java_log.read_text().splitlines()]
+    assert [call.get("threads") for call in calls] == ["2", None, "2"]
+    assert calls[1]["o"] == "./mets/100/2_tei.xml"
+    for collection_id, doc_id in (("100", "1"), ("100", "2"), ("200", "4")):
+        # # the METS as patch_page_xml.py wrote it, transformed
+        tei = read_tei(tmp_path / "mets" / collection_id / f"{doc_id}_tei.xml.gz")
+        assert tei.startswith("<TEI>") and f'OBJID="{doc_id}"' in tei
+    assert read_tei(tmp_path / "mets" / "100" / "3_tei.xml.gz") == "<TEI>old</TEI>"
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+import validate_tei
+from conftest import EXPECTED_DIR, read_expected_edition
+
+SCHEMA = b"""<grammar xmlns="http://relaxng.org/ns/structure/1.0" ns="http://www.tei-c.org/ns/1.0">
+  <start><element name="TEI"><element name="text"><text/></element></element></start>
+</grammar>
+"""
+VALID_EDITION = b'<TEI xmlns="http://www.tei-c.org/ns/1.0"><text>Art. 1</text></TEI>'
+INVALID_EDITION = b'<TEI xmlns="http://www.tei-c.org/ns/1.0"><body/></TEI>'
+
+
+@pytest.fixture
+def editions(tmp_path, monkeypatch):
+    schema_path = tmp_path / "schema.rng"
+    schema_path.write_bytes(SCHEMA)
+    tei_dir = tmp_path / "editions_source"
+    tei_dir.mkdir()
+    (tei_dir / "valid.xml").write_bytes(VALID_EDITION)
+    (tei_dir / "invalid.xml").write_bytes(INVALID_EDITION)
+    monkeypatch.setattr(validate_tei, "TEI_DIR", str(tei_dir))
+    monkeypatch.setattr(validate_tei, "TEI_SCHEMA_PATH", str(schema_path))
+    monkeypatch.setattr(validate_tei, "INVALID_FILES_LOGPATH", str(tmp_path / "logs" / "invalid_tei.csv"))
+    monkeypatch.setattr(validate_tei, "VALIDATION_CACHE_PATH", str(tmp_path / "validation_cache.json"))
+    return tmp_path
+
+
+def test_invalid_editions_are_logged_and_unchanged_ones_not_validated_again(editions, monkeypatch):
+    invalid_files = validate_tei.validate_all_files()
+    assert [entry["file_name"].rsplit("/", 1)[-1] for entry in invalid_files] == ["invalid.xml"]
+    assert "invalid.xml" in (editions / "logs" / "invalid_tei.csv").read_text()
+    compiled = []
+    monkeypatch.setattr(validate_tei, "init_worker", lambda *args: compiled.append(args))
+    documents = []
+    assert len(validate_tei.validate_all_files(documents=documents)) == 1
+    assert compiled == []
+    assert not any(document["validated"] for document in documents)
+    # # the log is of the last run only
+    (editions / "editions_source" / "invalid.xml").write_bytes(VALID_EDITION)
+    assert validate_tei.validate_all_files() == []
+    assert not (editions / "logs" / "invalid_tei.csv").exists()
+
+
+def test_missing_schema_fails_the_run(editions, monkeypatch):
+    monkeypatch.setattr(validate_tei, "TEI_SCHEMA_PATH", str(editions / "missing.rng"))
+    with pytest.raises(FileNotFoundError):
+        validate_tei.validate_all_files()
+
+
+def test_corpus_is_valid_against_the_project_schema(editions, monkeypatch):
+    monkeypatch.setattr(validate_tei, "TEI_SCHEMA_PATH", "./scripts/schema/bv_tei.rng")
+    tei_dir = editions / "editions_source"
+    for file_path in tei_dir.iterdir():
+        file_path.unlink()
+    for file_name in os.listdir(EXPECTED_DIR):
+        bv_doc_id = file_name.split(".")[0]
+        (tei_dir / f"{bv_doc_id}.xml").write_bytes(read_expected_edition(bv_doc_id))
+    invalid_files = validate_tei.validate_all_files()
+    # # refine_tei.py puts a legal section into an emph of bv_doc_id__32
+    assert [entry["file_name"].rsplit("/", 1)[-1] for entry in invalid_files] == ["bv_doc_id__32.xml"]
+    assert "Did not expect element p there" in invalid_files[0]["error"]
@@ -0,0 +1,37 @@
+import lxml.etree as ET
+import pytest
+
+import xpath_registry
+
+TEI = '<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><p n="1"/><p n="2"/></body></text></TEI>'
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(xpath_registry, "registered_xpaths", {})
+    monkeypatch.setattr(xpath_registry, "xpath_profile", {})
+
+
+def test_registering_again_returns_the_compiled_query(registry):
+    p_xpath = xpath_registry.register_xpath("test_p", ".//tei:p/@n")
+    assert xpath_registry.register_xpath("test_p", ".//tei:p/@n") is p_xpath
+    assert xpath_registry.get_xpath("test_p") is p_xpath
+    assert p_xpath(ET.fromstring(TEI)) == ["1", "2"]
+    with pytest.raises(ValueError, match="already registered"):
+        xpath_registry.register_xpath("test_p", ".//tei:p")
+
+
+def test_profiled_queries_count_calls_and_merge(registry, monkeypatch):
+    monkeypatch.setattr(xpath_registry, "XPATH_PROFILE", True)
+    p_xpath = xpath_registry.register_xpath("test_p", ".//tei:p[@n=$n]")
+    root = ET.fromstring(TEI)
+    assert [p.get("n") for p in p_xpath(root, n="2")] == ["2"]
+    p_xpath(root, n="1")
+    profile = xpath_registry.take_profile()
+    assert profile["test_p"][0] == 2
+    assert xpath_registry.xpath_profile == {}
+    # # the profile of a pool process is added to the one of the parent
+    xpath_registry.merge_profile(profile)
+    xpath_registry.merge_profile(profile)
+    assert xpath_registry.xpath_profile["test_p"][0] == 4
+    assert xpath_registry.format_profile(xpath_registry.take_profile()).splitlines()[1].startswith("test_p")